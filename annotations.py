@@ -0,0 +1,293 @@
+"""
+正解アノテーション（category / attribute / visibility / instance / sample_annotation）の生成。
+
+撮影中は ActorBoxBuffer が車両・歩行者の姿勢と箱を tick ごとに配列へ追記し、
+出力時に各サンプル時刻に最も近い tick の箱をまとめて nuScenes のグローバル座標へ変換する。
+num_lidar_pts / num_radar_pts はキーフレームの点群を global へ移して、
+全箱 × 全点を一度に箱座標へ落とす（箱ごとの Python ループはしない）。
+"""
+import fnmatch
+import numpy as np
+import config
+from utils import make_token
+from ego_pose import ColumnBuffer, carla_rpy_to_nus_quat, quat_to_rotmat
+from timeline import nearest_indices, sample_path_for
+from radar_bin2pcd import read_nuscenes_radar_pcd
+
+# 速度がこれ以上なら moving [m/s]
+MOVING_SPEED_MPS = 0.5
+
+ATTRIBUTES = {
+    "vehicle.moving": "Vehicle is moving.",
+    "vehicle.stopped": "Vehicle, with a driver/rider in/on it, is currently stationary but has an intent to move.",
+    "pedestrian.moving": "The human is moving.",
+    "pedestrian.standing": "The human is standing.",
+}
+
+# nuScenes 本家と同じ visibility の4段階（token も本家と同じ "1"〜"4"）
+VISIBILITY_LEVELS = [
+    ("1", "v0-40", "visibility of whole object is between 0 and 40%"),
+    ("2", "v40-60", "visibility of whole object is between 40 and 60%"),
+    ("3", "v60-80", "visibility of whole object is between 60 and 80%"),
+    ("4", "v80-100", "visibility of whole object is between 80 and 100%"),
+]
+
+
+def category_for(type_id, rules=None):
+    """CARLA type_id → nuScenes category 名（config.ANNOTATION_CATEGORIES の先勝ち。該当なしは None）"""
+    rules = rules if rules is not None else config.ANNOTATION_CATEGORIES
+    for pattern, name in rules.items():
+        if fnmatch.fnmatch(type_id, pattern):
+            return name
+    return None
+
+
+class ActorBoxBuffer(ColumnBuffer):
+    """
+    注釈対象アクター（ANNOTATION_CATEGORIES に当たるもの）の箱を tick ごとに追記するバッファ。
+    1行 = 1 tick × 1 アクター。値は CARLA 座標のまま持つ（変換は出力時にまとめて）。
+    アクター一覧は snapshot のアクター数が変わったときだけ取り直す。
+    """
+
+    _COLUMNS = ("_ts", "_id", "_xyz", "_rpy", "_center", "_extent", "_vel")
+
+    def __init__(self, world, exclude_ids=(), capacity=1024):
+        self.world = world
+        self.exclude_ids = set(exclude_ids)
+        self.type_ids = {}      # actor id -> type_id
+        self._actors = []
+        self._seen_ids = None
+        self._alloc(capacity, {
+            "_ts": ((), np.int64),
+            "_id": ((), np.int64),
+            "_xyz": ((3,), np.float64),     # アクター原点
+            "_rpy": ((3,), np.float64),     # roll, pitch, yaw [deg]
+            "_center": ((3,), np.float64),  # bounding_box.location（アクター座標）
+            "_extent": ((3,), np.float64),  # 半分の長さ x, y, z
+            "_vel": ((3,), np.float64),
+        })
+
+    def _refresh_actors(self):
+        self._actors = []
+        for a in self.world.get_actors():
+            if a.id in self.exclude_ids or category_for(a.type_id) is None:
+                continue
+            self._actors.append(a)
+            self.type_ids[a.id] = a.type_id
+
+    def record(self, snapshot):
+        """
+        world.on_tick / run_sync_capture の on_tick から呼ぶ。
+        位置・速度は snapshot の状態から取る（アクター自身の get_transform() はコールバック時点の値）。
+        アクター一覧は snapshot に居るアクターの id が変わったときだけ引き直す
+        （数だけ見ていると、1台消えて1台出た tick を見逃す）。
+        """
+        seen_ids = {s.id for s in snapshot}
+        if seen_ids != self._seen_ids:
+            self._refresh_actors()
+            self._seen_ids = seen_ids
+        states = [(a, snapshot.find(a.id)) for a in self._actors if a.id in seen_ids]
+        if not states:
+            return
+        if self.n + len(states) > self._ts.shape[0]:
+            self._grow(self.n + len(states))
+        ts = int(snapshot.timestamp.elapsed_seconds * 1e6)
+        i = self.n
+        for a, state in states:
+            tf = state.get_transform()
+            bb = a.bounding_box
+            v = state.get_velocity()
+            self._id[i] = a.id
+            self._xyz[i] = (tf.location.x, tf.location.y, tf.location.z)
+            self._rpy[i] = (tf.rotation.roll, tf.rotation.pitch, tf.rotation.yaw)
+            self._center[i] = (bb.location.x, bb.location.y, bb.location.z)
+            self._extent[i] = (bb.extent.x, bb.extent.y, bb.extent.z)
+            self._vel[i] = (v.x, v.y, v.z)
+            i += 1
+        self._ts[self.n:i] = ts
+        self.n = i
+
+    def boxes_at(self, timestamps, max_dist_us=None):
+        """
+        各 timestamp[us] に最も近い tick の箱を nuScenes global 座標で返す。
+        戻り値 dict（全部 1行=1箱 の配列）:
+          sample_idx (M,), actor_id (M,), center (M,3), size [w,l,h] (M,3),
+          rotation [w,x,y,z] (M,4), rotmat (M,3,3), velocity (M,3)
+        """
+        ts = self._ts[:self.n]
+        ticks = np.unique(ts)
+        pick = nearest_indices(ticks, timestamps, max_dist_us)
+        starts = np.searchsorted(ts, ticks[np.maximum(pick, 0)], side="left")
+        ends = np.searchsorted(ts, ticks[np.maximum(pick, 0)], side="right")
+        rows, sample_idx = [], []
+        for i, (s, e) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if pick[i] < 0:
+                continue
+            rows.append(np.arange(s, e))
+            sample_idx.append(np.full(e - s, i, dtype=np.int64))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        sample_idx = np.concatenate(sample_idx) if sample_idx else np.zeros(0, dtype=np.int64)
+
+        quat = carla_rpy_to_nus_quat(*self._rpy[rows].T)
+        R = quat_to_rotmat(quat)
+        # CARLA (y右+) → nuScenes (y左+)。箱中心 = 原点 + R @ bounding_box.location
+        flip = np.array([1.0, -1.0, 1.0])
+        center = self._xyz[rows] * flip + np.einsum("mij,mj->mi", R, self._center[rows] * flip)
+        ext = self._extent[rows]
+        return {
+            "sample_idx": sample_idx,
+            "actor_id": self._id[rows],
+            "center": center,
+            "size": np.stack([ext[:, 1], ext[:, 0], ext[:, 2]], axis=1) * 2,
+            "rotation": quat,
+            "rotmat": R,
+            "velocity": self._vel[rows] * flip,
+        }
+
+
+def count_points_in_boxes(points, centers, rotmats, sizes, chunk_elems=2_000_000):
+    """
+    points (N,3) のうち各箱 (B) に入る点の数を返す（B,）。
+    箱座標への変換と判定を全箱まとめて行い、メモリは B×chunk 点ずつに抑える。
+    sizes は nuScenes の [w, l, h]（箱座標の x=長さ, y=幅）。
+    """
+    B = centers.shape[0]
+    counts = np.zeros(B, dtype=np.int64)
+    if B == 0 or points.shape[0] == 0:
+        return counts
+    half = np.stack([sizes[:, 1], sizes[:, 0], sizes[:, 2]], axis=1) / 2
+    # どの箱からも遠い点は先に落とす（全箱を囲む AABB の外）
+    radius = np.linalg.norm(half, axis=1)[:, None]
+    lo = (centers - radius).min(axis=0)
+    hi = (centers + radius).max(axis=0)
+    pts = points[np.all((points >= lo) & (points <= hi), axis=1)]
+    step = max(1, chunk_elems // B)
+    for s in range(0, pts.shape[0], step):
+        d = pts[None, s:s + step, :] - centers[:, None, :]   # (B, n, 3)
+        local = np.matmul(d, rotmats)                          # 行ベクトル × R = R^T d（global → 箱）
+        inside = np.all(np.abs(local) <= half[:, None, :], axis=2)
+        counts += inside.sum(axis=1)
+    return counts
+
+
+def _to_global(points, cs_t, cs_R, ego_t, ego_R):
+    """センサ座標 (N,3) → global（calibrated_sensor → ego_pose の順）"""
+    return (points @ cs_R.T + cs_t) @ ego_R.T + ego_t
+
+
+def _calib(cal):
+    t = np.asarray(cal["translation"], dtype=np.float64)
+    R = quat_to_rotmat(np.asarray(cal["rotation_wxyz"], dtype=np.float64))
+    return t, R
+
+
+def build_annotation_tables(scene_name, sample_json, sample_times, actor_boxes, ego_poses,
+                            key_lidar_for_idx, key_radar_for_idx, key_timestamps=None):
+    """
+    category / attribute / visibility / instance / sample_annotation の行リストを返す。
+    遮蔽は計算しないので visibility_token は全部 config.ANNOTATION_VISIBILITY（既定 "4" = v80-100）。
+    箱はサンプル時刻で揃える。num_lidar_pts / num_radar_pts を数えるキーフレーム点群は、
+    key_timestamps（元パス → 撮影時刻 [us]）にあればその時刻の自車姿勢で global へ移す（無ければサンプル時刻）。
+    """
+    categories = {name: make_token("category", name) for name in dict.fromkeys(config.ANNOTATION_CATEGORIES.values())}
+    category_json = [{"token": tok, "name": name, "description": ""} for name, tok in categories.items()]
+    attributes = {name: make_token("attribute", name) for name in ATTRIBUTES}
+    attribute_json = [{"token": tok, "name": name, "description": ATTRIBUTES[name]}
+                      for name, tok in attributes.items()]
+    visibility_json = [{"token": tok, "level": level, "description": desc} for tok, level, desc in VISIBILITY_LEVELS]
+    visibility_token = str(getattr(config, "ANNOTATION_VISIBILITY", "4"))
+    if visibility_token not in {tok for tok, _, _ in VISIBILITY_LEVELS}:
+        raise ValueError(f"unknown ANNOTATION_VISIBILITY: {visibility_token} (choose from 1-4)")
+    if actor_boxes is None or len(actor_boxes) == 0 or ego_poses is None or len(ego_poses) == 0:
+        return category_json, attribute_json, visibility_json, [], []
+
+    sample_ts = np.asarray(sample_times, dtype=np.int64)
+    boxes = actor_boxes.boxes_at(sample_ts, getattr(config, "ANNOTATION_MAX_OFFSET_US", None))
+    ego_xyz, ego_quat, _ = ego_poses.interpolate(sample_ts)
+    ego_R = quat_to_rotmat(ego_quat)
+
+    # 自車から遠い物体は出さない
+    max_dist = getattr(config, "ANNOTATION_MAX_DIST_M", None)
+    if max_dist is not None:
+        dist = np.linalg.norm(boxes["center"][:, :2] - ego_xyz[boxes["sample_idx"], :2], axis=1)
+        keep = dist <= max_dist
+        boxes = {k: v[keep] for k, v in boxes.items()}
+
+    # キーフレーム点群ごとに、そのサンプルの箱だけ数える
+    n_boxes = boxes["sample_idx"].shape[0]
+    num_lidar = np.zeros(n_boxes, dtype=np.int64)
+    num_radar = np.zeros(n_boxes, dtype=np.int64)
+    order = np.argsort(boxes["sample_idx"], kind="stable")
+    bounds = np.searchsorted(boxes["sample_idx"][order], np.arange(len(sample_ts) + 1))
+    key_timestamps = key_timestamps or {}
+
+    def ego_at(src, idx):
+        ts = key_timestamps.get(src)
+        if ts is None:
+            return ego_xyz[idx], ego_R[idx]
+        xyz, quat, _ = ego_poses.interpolate([ts])
+        return xyz[0], quat_to_rotmat(quat)[0]
+
+    lidar_cs = _calib(config.LIDAR_CONFIGS[config.LIDAR_NAME])
+    radar_cs = {r: _calib(config.RADAR_CONFIGS[r]) for r in config.RADAR_NAMES}
+    for idx in range(len(sample_ts)):
+        sel = order[bounds[idx]:bounds[idx + 1]]
+        if sel.size == 0:
+            continue
+        args = (boxes["center"][sel], boxes["rotmat"][sel], boxes["size"][sel])
+        src = key_lidar_for_idx.get(idx)
+        if src:
+            pts = np.fromfile(sample_path_for(src), dtype=np.float32).reshape(-1, 5)[:, :3]
+            pts = _to_global(pts.astype(np.float64), *lidar_cs, *ego_at(src, idx))
+            num_lidar[sel] += count_points_in_boxes(pts, *args)
+        for rname, key_for_idx in key_radar_for_idx.items():
+            src = key_for_idx.get(idx)
+            if not src:
+                continue
+            det = read_nuscenes_radar_pcd(sample_path_for(src))
+            pts = np.stack([det["x"], det["y"], det["z"]], axis=1).astype(np.float64)
+            pts = _to_global(pts, *radar_cs[rname], *ego_at(src, idx))
+            num_radar[sel] += count_points_in_boxes(pts, *args)
+
+    # instance ごとに sample 順で並べて prev/next をつなぐ
+    order = np.lexsort((boxes["sample_idx"], boxes["actor_id"]))
+    speed = np.linalg.norm(boxes["velocity"][:, :2], axis=1)
+    instance_json, ann_json = [], []
+    sorted_ids = boxes["actor_id"][order]
+    _, run_starts = np.unique(sorted_ids, return_index=True)
+    for run in np.split(order, run_starts[1:]):
+        if run.size == 0:
+            continue
+        actor_id = int(boxes["actor_id"][run[0]])
+        cat = category_for(actor_boxes.type_ids[actor_id])
+        kind = "pedestrian" if cat.startswith("human.") else "vehicle"
+        inst_token = make_token(scene_name, "instance", actor_id)
+        tokens = [make_token(scene_name, "sample_annotation", actor_id, int(sample_ts[boxes["sample_idx"][m]]))
+                  for m in run]
+        for j, m in enumerate(run.tolist()):
+            if speed[m] >= MOVING_SPEED_MPS:
+                attr = f"{kind}.moving"
+            else:
+                attr = "pedestrian.standing" if kind == "pedestrian" else "vehicle.stopped"
+            ann_json.append({
+                "token": tokens[j],
+                "sample_token": sample_json[boxes["sample_idx"][m]]["token"],
+                "instance_token": inst_token,
+                "visibility_token": visibility_token,
+                "attribute_tokens": [attributes[attr]],
+                "translation": boxes["center"][m].tolist(),
+                "size": boxes["size"][m].tolist(),
+                "rotation": boxes["rotation"][m].tolist(),
+                "prev": tokens[j - 1] if j > 0 else "",
+                "next": tokens[j + 1] if j + 1 < len(tokens) else "",
+                "num_lidar_pts": int(num_lidar[m]),
+                "num_radar_pts": int(num_radar[m]),
+            })
+        instance_json.append({
+            "token": inst_token,
+            "category_token": categories[cat],
+            "nbr_annotations": len(tokens),
+            "first_annotation_token": tokens[0],
+            "last_annotation_token": tokens[-1],
+        })
+    return category_json, attribute_json, visibility_json, instance_json, ann_json
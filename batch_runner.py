@@ -0,0 +1,231 @@
+"""
+複数の CARLA サーバでシーンを並列に撮るバッチ実行。
+
+  python batch_runner.py specs.json --servers 192.168.11.20:2000 192.168.11.21:2000 --out ./data/batch
+
+specs.json はシーン仕様のリスト（省略したキーは config.py の値）:
+  [
+    {"name": "scene_0001", "town": "Town02", "weather": "ClearNoon", "duration": 20,
+     "spawn_index": 0, "npc_enabled": true, "npc_ahead_m": 15.0, "npc_autopilot": false},
+    {"name": "scene_0002", "town": "Town03", "weather": "WetSunset", "spawn_index": 5,
+     "config": {"CAM_ENCODER": "jpg"}}
+  ]
+
+サーバ1台につきワーカープロセス1つ。各ワーカーは空くたびに親から仕様を1つ受け取り、
+config を書き換えて main.main() を呼ぶ（出力は <out>/<name>/）。失敗したシーンは --retries 回まで積み直す。
+ワーカーが落ちたり --scene-timeout を超えたりしたら、そのシーンを失敗として積み直し、ワーカーを立て直す。
+--fake で fake_carla を使う（サーバ無しでの動作確認用）。
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import traceback
+import itertools
+import multiprocessing as mp
+from queue import Empty
+from collections import deque
+
+# シーン仕様のキー → config の変数名
+SPEC_KEYS = {
+    "town": "TOWN",
+    "weather": "WEATHER",
+    "duration": "DURATION_SEC",
+    "spawn_index": "EGO_SPAWN_INDEX",
+    "npc_enabled": "NPC_ENABLED",
+    "npc_model": "NPC_MODEL",
+    "npc_ahead_m": "NPC_AHEAD_METERS",
+    "npc_autopilot": "NPC_AUTOPILOT",
+}
+
+
+def parse_endpoint(s):
+    host, _, port = s.rpartition(":")
+    return (host or "127.0.0.1"), int(port)
+
+
+def load_specs(path):
+    with open(path) as f:
+        specs = json.load(f)
+    for i, spec in enumerate(specs):
+        spec.setdefault("name", f"scene_{i + 1:04d}")
+        unknown = set(spec) - set(SPEC_KEYS) - {"name", "config"}
+        if unknown:
+            raise ValueError(f"{spec['name']}: 不明なキー {sorted(unknown)}")
+    names = [s["name"] for s in specs]
+    if len(set(names)) != len(names):
+        raise ValueError("シーン名が重複しています")
+    return specs
+
+
+def _apply_spec(config, defaults, spec, endpoint, out_root):
+    """config を既定値に戻してから spec の値で上書きする。"""
+    for k, v in defaults.items():
+        setattr(config, k, v)
+    for key, attr in SPEC_KEYS.items():
+        if key in spec:
+            setattr(config, attr, spec[key])
+    for attr, v in spec.get("config", {}).items():
+        setattr(config, attr, v)
+    config.CARLA_HOST, config.CARLA_PORT = endpoint
+    config.BASE_DIR = os.path.join(out_root, spec["name"])
+    config.SCENE_NAME = spec["name"]
+
+
+def _server_worker(endpoint, inbox, results, out_root, use_fake):
+    if use_fake:
+        import fake_carla
+        fake_carla.install()
+    import config
+    import main
+    # 上書き対象になり得る config の既定値を覚えておく（シーンごとに戻す）
+    defaults = {k: v for k, v in vars(config).items() if k.isupper()}
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        job_id, spec = item
+        _apply_spec(config, defaults, spec, endpoint, out_root)
+        t0 = time.time()
+        try:
+            main.main()
+            results.put((endpoint, job_id, True, time.time() - t0, ""))
+        except Exception:
+            results.put((endpoint, job_id, False, time.time() - t0, traceback.format_exc()))
+
+
+class _ServerSlot:
+    """サーバ1台分のワーカープロセスと、いま渡しているシーン。"""
+
+    def __init__(self, endpoint, results, out_root, use_fake, worker=None):
+        self.endpoint = endpoint
+        self.label = f"{endpoint[0]}:{endpoint[1]}"
+        self._worker = worker or _server_worker
+        self._args = (results, out_root, use_fake)
+        self.job = None         # (spec, attempt)
+        self.job_id = None      # 渡すたびに変わる id（結果と突き合わせる）
+        self.started = 0.0
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        # シーンはワーカーごとの inbox で渡す（落ちたときに何を持っていたか親で分かるように）
+        self.inbox = mp.Queue()
+        self.proc = mp.Process(target=self._worker, args=(self.endpoint, self.inbox) + self._args,
+                               name=f"carla-{self.label}", daemon=True)
+        self.proc.start()
+
+    def assign(self, job, job_id):
+        self.job = job
+        self.job_id = job_id
+        self.started = time.time()
+        self.inbox.put((job_id, job[0]))
+
+    def restart(self):
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.proc.join()
+        self.restarts += 1
+        self.start()
+
+
+def run_batch(specs, endpoints, out_root, retries=1, use_fake=False, poll_sec=1.0, scene_timeout=None,
+              worker=None):
+    """
+    specs を endpoints のサーバで並列に撮る。
+    ワーカーが落ちた（segfault・kill など）か scene_timeout 秒を超えたら、持っていたシーンを失敗として
+    積み直し、そのサーバのワーカーを立て直す。
+    シーンは渡すたびに新しい job id を付け、結果はその id で突き合わせる（止めたワーカーが最後に出した
+    結果が、同じシーンの次の試行の結果として数えられないように）。
+    worker: ワーカープロセスの関数（既定は _server_worker。テスト用）
+    戻り値: {name: {"ok", "attempts", "endpoint", "seconds", "error"}}
+    """
+    os.makedirs(out_root, exist_ok=True)
+    results = mp.Queue()
+    queue = deque((spec, 1) for spec in specs)
+    slots = {ep: _ServerSlot(ep, results, out_root, use_fake, worker) for ep in endpoints}
+    job_ids = itertools.count(1)
+
+    t0 = time.time()
+    summary, pending, done = {}, len(specs), 0
+
+    def finish(slot, ok, seconds, err):
+        nonlocal pending, done
+        spec, attempt = slot.job
+        slot.job = slot.job_id = None
+        name = spec["name"]
+        if not ok and attempt <= retries:
+            print(f"[BATCH] {name} failed on {slot.label} (attempt {attempt}), retrying\n{err}")
+            queue.append((spec, attempt + 1))
+            return
+        pending -= 1
+        done += 1
+        summary[name] = {"ok": ok, "attempts": attempt, "endpoint": slot.label, "seconds": seconds, "error": err}
+        elapsed = time.time() - t0
+        print(f"[BATCH] [{done}/{len(specs)}] {name} {'ok' if ok else 'FAILED'} on {slot.label} "
+              f"in {seconds:.1f}s (elapsed {elapsed:.1f}s)")
+        if not ok:
+            print(err)
+
+    while pending:
+        for slot in slots.values():
+            if slot.job is None and queue:
+                slot.assign(queue.popleft(), next(job_ids))
+        try:
+            endpoint, job_id, ok, seconds, err = results.get(timeout=poll_sec)
+        except Empty:
+            # 結果が来ない間に、落ちた・止まったワーカーが無いか見る
+            now = time.time()
+            for slot in slots.values():
+                if slot.proc.is_alive() and not (slot.job is not None and scene_timeout
+                                                 and now - slot.started > scene_timeout):
+                    continue
+                if slot.proc.is_alive():
+                    err = f"timed out after {scene_timeout:.0f}s"
+                else:
+                    err = f"worker died (exitcode {slot.proc.exitcode})"
+                print(f"[BATCH] {slot.label}: {err}, restarting worker")
+                slot.restart()
+                if slot.job is not None:
+                    finish(slot, False, now - slot.started, err)
+            continue
+        slot = slots[endpoint]
+        if job_id != slot.job_id:
+            # 止めたワーカーが止まる直前に出していた結果（そのシーンはもう失敗として積み直し済み）
+            continue
+        finish(slot, ok, seconds, err)
+
+    for slot in slots.values():
+        slot.inbox.put(None)
+    for slot in slots.values():
+        slot.proc.join()
+
+    wall = max(time.time() - t0, 1e-9)
+    n_ok = sum(1 for r in summary.values() if r["ok"])
+    restarts = sum(slot.restarts for slot in slots.values())
+    print(f"[BATCH] {n_ok}/{len(specs)} scenes ok on {len(endpoints)} servers in {wall:.1f}s "
+          f"({n_ok / wall * 3600:.1f} scenes/h)" + (f", {restarts} worker restarts" if restarts else ""))
+    return summary
+
+
+def main():
+    ap = argparse.ArgumentParser(description="複数 CARLA サーバでのシーン並列撮影")
+    ap.add_argument("specs", help="シーン仕様の JSON ファイル")
+    ap.add_argument("--servers", nargs="+", required=True, help="host:port をサーバの数だけ")
+    ap.add_argument("--out", default="./data/batch", help="出力ルート（シーンごとに <out>/<name>/）")
+    ap.add_argument("--retries", type=int, default=1, help="失敗したシーンを積み直す回数")
+    ap.add_argument("--scene-timeout", type=float, default=None,
+                    help="1シーンがこの秒数を超えたらワーカーを止めて失敗扱いにする")
+    ap.add_argument("--fake", action="store_true", help="fake_carla で実行する")
+    args = ap.parse_args()
+
+    summary = run_batch(load_specs(args.specs), [parse_endpoint(s) for s in args.servers],
+                        args.out, retries=args.retries, use_fake=args.fake, scene_timeout=args.scene_timeout)
+    with open(os.path.join(args.out, "batch_summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    sys.exit(0 if all(r["ok"] for r in summary.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+カメラエンコーダ別のスループット計測。
+  python benchmarks/bench_camera_encoders.py [--frames 30] [--width 1600] [--height 900]
+config.IMG_W x IMG_H の合成 BGRA フレームを encode_camera_frame で書き、frames/s と 1枚あたりのサイズを出す。
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_carla
+fake_carla.install()  # sensors は import 時に carla を要求する
+
+import numpy as np
+import config
+from sensors import encode_camera_frame
+from utils import camera_fileformat
+
+# (表示名, encoder, 上書きする config)
+CASES = [
+    ("png level 1", "png", {"CAM_PNG_COMPRESS_LEVEL": 1}),
+    ("png level 6", "png", {"CAM_PNG_COMPRESS_LEVEL": 6}),
+    ("png level 9", "png", {"CAM_PNG_COMPRESS_LEVEL": 9}),
+    ("jpg q95", "jpg", {"CAM_JPEG_QUALITY": 95}),
+    ("jpg q85", "jpg", {"CAM_JPEG_QUALITY": 85}),
+    ("npy (raw)", "npy", {}),
+]
+
+
+def synthetic_frame(w, h, seed=0):
+    rng = np.random.default_rng(seed)
+    bgra = np.empty((h, w, 4), dtype=np.uint8)
+    bgra[:, :, 0] = np.linspace(0, 255, w, dtype=np.uint8)[None, :]
+    bgra[:, :, 1] = np.linspace(0, 255, h, dtype=np.uint8)[:, None]
+    bgra[:, :, 2] = rng.integers(0, 64, size=(h, w), dtype=np.uint8)
+    bgra[:, :, 3] = 255
+    return bgra
+
+
+def bench(frames, w, h):
+    bgra = synthetic_frame(w, h)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, enc, overrides in CASES:
+            saved = {k: getattr(config, k) for k in overrides}
+            for k, v in overrides.items():
+                setattr(config, k, v)
+            ext = camera_fileformat(enc)
+            t0 = time.perf_counter()
+            total = 0
+            for i in range(frames):
+                path = os.path.join(tmp, f"f{i}.{ext}")
+                encode_camera_frame(bgra, path, enc)
+                total += os.path.getsize(path)
+            dt = time.perf_counter() - t0
+            for k, v in saved.items():
+                setattr(config, k, v)
+            results.append((label, frames / dt, total / frames))
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--frames", type=int, default=30)
+    ap.add_argument("--width", type=int, default=config.IMG_W)
+    ap.add_argument("--height", type=int, default=config.IMG_H)
+    args = ap.parse_args()
+    print(f"{args.width}x{args.height}, {args.frames} frames / encoder")
+    print(f"{'encoder':<14} {'frames/s':>10} {'KB/frame':>10}")
+    for label, fps, size in bench(args.frames, args.width, args.height):
+        print(f"{label:<14} {fps:>10.1f} {size / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+LiDAR スイープの保存形式の計測（float .pcd.bin / compact .pcd.q16、voxel 間引きあり・なし）。
+  python benchmarks/bench_lidar_storage.py [--sweeps 50] [--points 10000] [--voxel 0 0.1 0.2]
+1スイープあたりのバイト数、書き出し（間引き + エンコード + 書き込み）と読み込み（decode）の
+スループット、decode 後の xyz の最大誤差を出す。点は LIDAR_CHANNELS 本のビームで LIDAR_RANGE 内に合成する。
+"""
+import os
+import sys
+import time
+import math
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import config
+from lidar_codec import (ENCODINGS, sweep_ext, compact_scale, voxel_downsample, write_compact, read_lidar)
+
+
+def synthetic_sweep(n, seed=0):
+    """(x, y, z, intensity, ring) の (n, 5) float32。地面と周りの壁っぽい距離分布"""
+    rng = np.random.default_rng(seed)
+    ch = config.LIDAR_CHANNELS
+    ring = rng.integers(0, ch, n)
+    elev = np.radians(config.LIDAR_LOWER_FOV + (config.LIDAR_UPPER_FOV - config.LIDAR_LOWER_FOV) * ring / (ch - 1))
+    az = rng.uniform(-math.pi, math.pi, n)
+    # 下向きのビームは地面（高さ 1.8m）まで、それ以外は 5〜LIDAR_RANGE の壁
+    ground = np.where(elev < 0, 1.8 / np.maximum(np.sin(-elev), 1e-3), np.inf)
+    rng_m = np.minimum(ground, rng.uniform(5.0, config.LIDAR_RANGE, n))
+    rng_m = np.minimum(rng_m, config.LIDAR_RANGE)
+    pts = np.empty((n, 5), dtype=np.float32)
+    pts[:, 0] = rng_m * np.cos(elev) * np.cos(az)
+    pts[:, 1] = rng_m * np.cos(elev) * np.sin(az)
+    pts[:, 2] = rng_m * np.sin(elev)
+    pts[:, 3] = rng.uniform(0.0, 1.0, n)
+    pts[:, 4] = ring
+    return pts
+
+
+def bench(encoding, voxel, clouds, tmp):
+    ext = sweep_ext(encoding)
+    scale = compact_scale()
+    sweeps = len(clouds)
+    paths = [os.path.join(tmp, f"{encoding}_{voxel}_{i}{ext}") for i in range(sweeps)]
+    n_in = sum(c.shape[0] for c in clouds)
+
+    t0 = time.perf_counter()
+    kept = []
+    for pts, path in zip(clouds, paths):
+        if voxel:
+            pts = voxel_downsample(pts, voxel)
+        if encoding == "compact":
+            write_compact(path, pts, scale)
+        else:
+            pts.tofile(path)
+        kept.append(pts)
+    t_enc = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    # .pcd.bin は memmap なので np.array で実際に読ませる
+    decoded = [np.array(read_lidar(p)) for p in paths]
+    t_dec = time.perf_counter() - t0
+
+    err = max(float(np.abs(d[:, :3] - k[:, :3]).max()) if k.shape[0] else 0.0 for d, k in zip(decoded, kept))
+    n_out = sum(k.shape[0] for k in kept)
+    size = sum(os.path.getsize(p) for p in paths)
+    return {
+        "bytes_per_sweep": size / sweeps,
+        "points_kept": n_out / n_in,
+        "encode_mpts_s": n_in / t_enc / 1e6,
+        "decode_mpts_s": n_out / t_dec / 1e6,
+        "max_xyz_err_mm": err * 1e3,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sweeps", type=int, default=50)
+    ap.add_argument("--points", type=int, default=math.ceil(config.LIDAR_PPS / config.LIDAR_ROTATION_HZ))
+    ap.add_argument("--voxel", type=float, nargs="+", default=[0.0, 0.1, 0.2])
+    args = ap.parse_args()
+    clouds = [synthetic_sweep(args.points, seed=i) for i in range(args.sweeps)]
+    print(f"{args.points} points/sweep, {args.sweeps} sweeps, compact scale {compact_scale() * 1e3:.2f} mm")
+    print(f"{'encoding':<8} {'voxel m':>7} {'KB/sweep':>9} {'kept':>6} {'enc Mpt/s':>10} {'dec Mpt/s':>10} "
+          f"{'err mm':>7}")
+    base = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for voxel in args.voxel:
+            for encoding in ENCODINGS:
+                r = bench(encoding, voxel, clouds, tmp)
+                if base is None:
+                    base = r["bytes_per_sweep"]
+                print(f"{encoding:<8} {voxel:>7.2f} {r['bytes_per_sweep'] / 1024:>9.1f} {r['points_kept']:>6.1%} "
+                      f"{r['encode_mpts_s']:>10.1f} {r['decode_mpts_s']:>10.1f} {r['max_xyz_err_mm']:>7.2f}"
+                      f"  ({r['bytes_per_sweep'] / base:.0%} of float)")
+
+
+if __name__ == "__main__":
+    main()
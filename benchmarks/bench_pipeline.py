@@ -0,0 +1,192 @@
+"""
+CARLA サーバ無しでの取得〜出力パイプライン全体の計測。
+  python benchmarks/bench_pipeline.py [--duration 5] [--width 1600] [--height 900] [--sync | --async]
+                                      [--set WRITER_WORKERS=8 --set CAM_ENCODER='"jpg"'] [--out result.json]
+                                      [--compare old.json]
+fake_carla を carla として入れ、config のレート・解像度で合成カメラ / LiDAR / レーダを発生させて
+本物の sensors のコールバックと export の出力処理を通す。
+計測: コールバック時間のパーセンタイル（センサ種別ごと）、チャンネルごとの frames/s、
+撮影と出力（キーフレーム + JSON）の wall 時間、ピーク RSS。結果は JSON に書く（--compare で前回と比べる）。
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_carla
+fake_carla.install()
+
+import numpy as np
+import config
+import main
+import export
+from dataset_reader import NuScenesLite
+
+# sensor type_id → 種別名
+SENSOR_KINDS = {"sensor.camera.rgb": "camera", "sensor.lidar.ray_cast": "lidar", "sensor.other.radar": "radar"}
+PERCENTILES = (50, 90, 99)
+# --compare で並べる値（小さいほど良いもの）
+COMPARE_KEYS = ["capture_wall_s", "export_wall_s", "peak_rss_mb"]
+
+
+class PipelineProbe:
+    """fake_carla のセンサと export の出力関数に時間計測を差し込む。"""
+
+    def __init__(self):
+        self.callback_s = defaultdict(list)
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    def install(self):
+        probe = self
+        orig_listen = fake_carla.Sensor.listen
+
+        def listen(sensor, callback):
+            kind = SENSOR_KINDS.get(sensor.type_id, sensor.type_id)
+
+            def timed(data):
+                t0 = time.perf_counter()
+                callback(data)
+                dt = time.perf_counter() - t0
+                with probe._lock:
+                    probe.callback_s[kind].append(dt)
+            orig_listen(sensor, timed)
+        fake_carla.Sensor.listen = listen
+
+        orig_sample_times = export.plan_sample_times
+        orig_write = export.write_nuscenes_jsons
+
+        def plan_sample_times(*args, **kwargs):
+            # ここから後ろ（キーフレーム選択 + JSON 出力）を export とみなす
+            self.marks["export_start"] = time.perf_counter()
+            return orig_sample_times(*args, **kwargs)
+
+        def write_nuscenes_jsons(*args, **kwargs):
+            try:
+                return orig_write(*args, **kwargs)
+            finally:
+                self.marks["export_end"] = time.perf_counter()
+        export.plan_sample_times = plan_sample_times
+        export.write_nuscenes_jsons = write_nuscenes_jsons
+
+
+def _percentiles(values):
+    a = np.asarray(values, dtype=np.float64) * 1e3
+    out = {f"p{p}_ms": float(np.percentile(a, p)) for p in PERCENTILES}
+    out.update(count=int(a.size), mean_ms=float(a.mean()), max_ms=float(a.max()))
+    return out
+
+
+def run(out_dir):
+    probe = PipelineProbe()
+    probe.install()
+    config.BASE_DIR = out_dir
+    t0 = time.perf_counter()
+    main.main()
+    t_end = time.perf_counter()
+
+    capture_wall = probe.marks["export_start"] - t0
+    nusc = NuScenesLite(out_dir, config.VERSION, cache=False)
+    frames = defaultdict(int)
+    for sd in nusc.sample_data:
+        frames[nusc.channel_of(sd)] += 1
+    return {
+        "config": {
+            "duration_sec": config.DURATION_SEC,
+            "sync_mode": bool(getattr(config, "SYNC_MODE", False)),
+            "image_size": [config.IMG_W, config.IMG_H],
+            "cam_encoder": getattr(config, "CAM_ENCODER", "png"),
+            "writer_workers": getattr(config, "WRITER_WORKERS", 0),
+            "writer_policy": getattr(config, "WRITER_FULL_POLICY", "block"),
+            "lidar_pps": config.LIDAR_PPS,
+        },
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "capture_wall_s": capture_wall,
+        "export_wall_s": probe.marks["export_end"] - probe.marks["export_start"],
+        "total_wall_s": t_end - t0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "callback_latency": {k: _percentiles(v) for k, v in sorted(probe.callback_s.items())},
+        "frames": dict(sorted(frames.items())),
+        "frames_per_s": {ch: n / capture_wall for ch, n in sorted(frames.items())},
+    }
+
+
+def _print(result):
+    c = result["config"]
+    print(f"{c['image_size'][0]}x{c['image_size'][1]} {c['cam_encoder']}, {c['duration_sec']}s sim, "
+          f"{'sync' if c['sync_mode'] else 'async'}, writers={c['writer_workers']}")
+    print(f"capture {result['capture_wall_s']:.2f}s  export {result['export_wall_s']:.2f}s  "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    print(f"{'callback':<8} " + " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES) + f" {'max ms':>9} {'count':>7}")
+    for kind, s in result["callback_latency"].items():
+        print(f"{kind:<8} " + " ".join(f"{s[f'p{p}_ms']:>9.2f}" for p in PERCENTILES)
+              + f" {s['max_ms']:>9.2f} {s['count']:>7}")
+    print(f"{'channel':<18} {'frames':>7} {'frames/s':>9}")
+    for ch, n in result["frames"].items():
+        print(f"{ch:<18} {n:>7} {result['frames_per_s'][ch]:>9.1f}")
+
+
+def _compare(result, old):
+    print(f"{'metric':<24} {'old':>9} {'new':>9} {'change':>8}")
+    rows = [(k, old.get(k), result.get(k)) for k in COMPARE_KEYS]
+    for kind, s in result["callback_latency"].items():
+        o = old.get("callback_latency", {}).get(kind, {})
+        rows.append((f"{kind} p99 ms", o.get("p99_ms"), s["p99_ms"]))
+    for label, a, b in rows:
+        if a is None or b is None:
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "-"
+        print(f"{label:<24} {a:>9.2f} {b:>9.2f} {change:>8}")
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="fake_carla でのパイプライン全体の計測")
+    ap.add_argument("--duration", type=float, default=config.DURATION_SEC)
+    ap.add_argument("--width", type=int, default=config.IMG_W)
+    ap.add_argument("--height", type=int, default=config.IMG_H)
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--sync", dest="sync", action="store_true", help="同期モードで撮る（既定は config.SYNC_MODE）")
+    mode.add_argument("--async", dest="sync", action="store_false", help="非同期モードで撮る")
+    ap.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                    help="config を上書き（VALUE は JSON として解釈）")
+    ap.add_argument("--out", default=None, help="結果 JSON の出力先")
+    ap.add_argument("--compare", default=None, help="前回の結果 JSON と比べる")
+    ap.add_argument("--keep", default=None, help="出力データセットをここに残す（既定は一時ディレクトリ）")
+    ap.set_defaults(sync=getattr(config, "SYNC_MODE", False))
+    args = ap.parse_args()
+
+    config.DURATION_SEC = args.duration
+    config.IMG_W, config.IMG_H = args.width, args.height
+    config.SYNC_MODE = args.sync
+    for item in args.set:
+        key, _, value = item.partition("=")
+        try:
+            setattr(config, key, json.loads(value))
+        except json.JSONDecodeError:
+            setattr(config, key, value)
+
+    if args.keep:
+        result = run(args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run(tmp)
+    result["created"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    _print(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"→ {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,116 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+import config
+
+
+class FrameSync:
+    """
+    同期モード用の集計器。
+    センサのコールバックから notify(name, frame, ts_us) を受け取り、
+    world.tick() で進めたフレームについて「出るはずのセンサ」が全部届くまで待つ。
+
+    出るはずかどうかは CARLA の sensor_tick と同じ考え方で判定する:
+      直前に届いた時刻から sensor_tick 以上経っていればこの tick で出る。
+    """
+    _EPS_SEC = 1e-4
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._ticks = {}       # name -> sensor_tick[s]
+        self._last_frame = {}  # name -> 最後に届いた frame
+        self._last_sec = {}    # name -> 最後に届いた時刻[s]
+        self.missed = Counter()
+
+    def register(self, name, sensor_tick):
+        with self._cond:
+            self._ticks[name] = float(sensor_tick or 0.0)
+
+    def notify(self, name, frame, timestamp_us):
+        with self._cond:
+            self._last_frame[name] = frame
+            self._last_sec[name] = timestamp_us * 1e-6
+            self._cond.notify_all()
+
+    def _pending(self, frame, elapsed):
+        pending = []
+        for name, tick in self._ticks.items():
+            last_frame = self._last_frame.get(name)
+            if last_frame is not None and last_frame >= frame:
+                continue
+            last_sec = self._last_sec.get(name)
+            if last_sec is None or elapsed - last_sec >= tick - self._EPS_SEC:
+                pending.append(name)
+        return pending
+
+    def wait(self, frame, elapsed, timeout):
+        """frame で出るはずのセンサが揃うまで待つ。タイムアウトしたセンサ名を返す。"""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending(frame, elapsed), timeout=timeout)
+            missing = self._pending(frame, elapsed)
+        for name in missing:
+            self.missed[name] += 1
+        return missing
+
+
+def sensor_tick_for(name):
+    """attach_cameras / attach_radars / attach_lidar がそのチャンネルに設定する sensor_tick[s]。"""
+    if name in config.CAM_NAMES:
+        return config.CAM_CONFIGS.get(name, {}).get("sensor_tick", config.CAM_SENSOR_TICK)
+    if name in config.RADAR_NAMES:
+        # レーダーは sensor_tick 未設定（= 毎 tick）
+        return 0.0
+    if name == config.LIDAR_NAME:
+        return config.LIDAR_SENSOR_TICK
+    raise KeyError(name)
+
+
+def register_default_sensors(frame_sync):
+    """attach_cameras / attach_radars / attach_lidar が作るセンサを登録する。"""
+    for name in config.CAM_NAMES + config.RADAR_NAMES + [config.LIDAR_NAME]:
+        frame_sync.register(name, sensor_tick_for(name))
+    return frame_sync
+
+
+@contextmanager
+def synchronous_mode(client, world, fixed_delta_seconds):
+    """
+    world を固定刻みの同期モードにし、抜けるときに元の設定へ戻す。
+    Traffic Manager も同期させないとオートパイロット車が動かない。
+    """
+    original = world.get_settings()
+    settings = world.get_settings()
+    settings.synchronous_mode = True
+    settings.fixed_delta_seconds = fixed_delta_seconds
+    world.apply_settings(settings)
+    tm = client.get_trafficmanager(getattr(config, "TM_PORT", 8000)) if client is not None else None
+    if tm is not None:
+        tm.set_synchronous_mode(True)
+    try:
+        yield world
+    finally:
+        if tm is not None:
+            tm.set_synchronous_mode(False)
+        world.apply_settings(original)
+
+
+def run_sync_capture(world, frame_sync, duration_sec, fixed_delta_seconds,
+                     timeout_sec=None, on_tick=None):
+    """
+    world.tick() を duration_sec / fixed_delta_seconds 回まわす。
+    各 tick で出るはずのセンサが全部届いてから次へ進むので、
+    実時間ではなくサーバが回せる最大速度で進み、フレームの揃い方も毎回同じになる。
+    戻り値: 回した tick 数
+    """
+    if timeout_sec is None:
+        timeout_sec = getattr(config, "SYNC_TIMEOUT_SEC", 2.0)
+    n_ticks = int(round(duration_sec / fixed_delta_seconds))
+    for _ in range(n_ticks):
+        frame = world.tick()
+        snapshot = world.get_snapshot()
+        if on_tick is not None:
+            on_tick(snapshot)
+        missing = frame_sync.wait(frame, snapshot.timestamp.elapsed_seconds, timeout_sec)
+        if missing:
+            print(f"[SYNC] frame {frame}: timeout waiting for {', '.join(missing)}")
+    return n_ticks
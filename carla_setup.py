@@ -5,13 +5,14 @@ def init_world():
     client = carla.Client(config.CARLA_HOST, config.CARLA_PORT)
     client.set_timeout(10.0)
     world = client.load_world(config.TOWN)
-    world.set_weather(carla.WeatherParameters.ClearNoon)
+    world.set_weather(getattr(carla.WeatherParameters, getattr(config, "WEATHER", "ClearNoon")))
     bl = world.get_blueprint_library()
     return client, world, bl
 
 def spawn_vehicle(world, bl):
     prius_bp = bl.find("vehicle.audi.tt")
-    spawn = world.get_map().get_spawn_points()[0]
+    spawn_points = world.get_map().get_spawn_points()
+    spawn = spawn_points[getattr(config, "EGO_SPAWN_INDEX", 0) % len(spawn_points)]
     prius = world.spawn_actor(prius_bp, spawn)
     # loc = prius.get_transform().location
     # print(f"[EGO] spawned at x={loc.x:.2f}, y={loc.y:.2f}, z={loc.z:.2f}")
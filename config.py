@@ -2,17 +2,40 @@
 CARLA_HOST = "192.168.11.20"
 CARLA_PORT = 2000
 TOWN = "Town02"
+WEATHER = "ClearNoon"     # carla.WeatherParameters のプリセット名
+EGO_SPAWN_INDEX = 0       # map.get_spawn_points() の何番目に自車を置くか
 DURATION_SEC = 20
 
+# 区切り撮影（長時間用）。SEGMENT_SEC ごとに別シーンとして書き出し、記録をメモリから外す（None で区切らない）
+SEGMENT_SEC = None
+SEGMENT_GRACE_SEC = 1.0          # 区切りからこれだけ待ってから切る（書き出しワーカーの遅れ分）
+SEGMENT_EXPORT_WORKERS = 1       # 区間の出力（キーフレーム + JSON）を撮影と並行に走らせるスレッド数
+SEGMENT_KEEP_PARTS = False       # True で最後にまとめた後も区間ごとの v1.0-*-segNNNN を残す
+
+# 同期モード（world.tick() をクライアントから駆動して全センサの到着を待つ）
+SYNC_MODE = False                 # True で同期モード（False は従来どおり非同期で実時間撮影）
+SYNC_FIXED_DELTA = 1.0 / 60      # LIDAR_ROTATION_HZ と合わせて 1 tick = 1 回転
+SYNC_TIMEOUT_SEC = 2.0           # 1 tick でセンサ到着を待つ上限
+TM_PORT = 8000
+
+# センサ書き出しプール（コールバックはキューに積むだけ。0 でコールバック内で直接書く）
+WRITER_WORKERS = 0               # 既定は従来どおり直接書く（4 などでプールを使う）
+WRITER_QUEUE_SIZE = 64
+WRITER_FULL_POLICY = "block"     # "block" / "drop_oldest" / "drop_newest"
+
 # 画像
 IMG_W = 1600
 IMG_H = 900
 CAM_SENSOR_TICK = 0.0666667  # 15 Hz程度
+CAM_ENCODER = "png"          # "png" / "jpg" / "npy"（npy は BGRA のまま保存し後でエンコード）
+CAM_PNG_COMPRESS_LEVEL = 6   # 0(速い)〜9(小さい)
+CAM_JPEG_QUALITY = 95
 
 # レーダー
 RADAR_HFOV = 20
 RADAR_VFOV = 5
 RADAR_RANGE = 250
+RADAR_WRITE_BIN = False   # True で PCD に加えて旧形式の .bin も残す（radar_bin2pcd.py 用）
 
 # LIDAR
 LIDAR_RANGE = 120
@@ -22,10 +45,24 @@ LIDAR_ROTATION_HZ = 60
 LIDAR_UPPER_FOV = 10
 LIDAR_LOWER_FOV = -30
 LIDAR_SENSOR_TICK = 1.0 / LIDAR_ROTATION_HZ
+# スイープの保存形式: "float" = nuScenes 標準 .pcd.bin（20B/点）/ "compact" = .pcd.q16（int16 xyz + uint8、8B/点）
+# キーフレームは samples/ に置くとき標準の .pcd.bin に戻す
+LIDAR_SWEEP_ENCODING = "float"
+LIDAR_COMPACT_SCALE = None       # compact の xyz の刻み[m]（None なら LIDAR_RANGE が int16 に収まる刻み）
+LIDAR_VOXEL_SIZE = None          # [m] この格子で間引いてから保存（None で間引かない。キーフレームも間引かれる）
 
 # 出力
 BASE_DIR = "./data/nuScenes"
 VERSION = "v1.0-test"
+JSON_COMPACT = False       # True: インデント無しで書く（False は従来どおり indent=2）
+JSON_BACKEND = "auto"      # "auto"（orjson があれば使う）/ "orjson" / "json"
+SCENE_NAME = "scene_1"     # token は scene名・チャンネル・timestamp などから uuid5 で決定的に作る
+MANIFEST_ENABLED = False   # True で書き終えたフレームと自車姿勢を BASE_DIR/MANIFEST_NAME に追記（落ちても export.py で出力し直せる）
+MANIFEST_NAME = "capture_manifest.jsonl"
+MANIFEST_FLUSH_RECORDS = 256   # これだけ溜まるか
+MANIFEST_FLUSH_SEC = 1.0       # これだけ経ったら write + fsync
+EXPORT_WORKERS = 4          # キーフレームを samples/ に置く・sweeps/ を走査するスレッド数
+EXPORT_INCREMENTAL = False # True で既存の v1.0-* と比べて中身が変わったテーブルだけ書き換える
 
 # カメラ（元コードのまま）
 CAM_NAMES = [
@@ -142,6 +179,44 @@ LIDAR_CONFIGS = {
 
 # サンプル時刻
 SAMPLE_INTERVAL_US = 500_000  # 0.5s
+# 最近傍フレームの許容ずれ（None で無制限）
+KEYFRAME_MAX_OFFSET_US = None    # これより離れたフレームはキーフレームにしない
+SWEEP_MAX_OFFSET_US = None       # これよりどのサンプルからも離れた sweep は sample_data に含めない
+# サンプル時刻の決め方: "lidar" = LiDAR スイープに合わせる（本家 nuScenes と同じ）/ "grid" = 先頭から固定格子
+KEYFRAME_PLANNER = "lidar"
+# モダリティごとのキーフレーム許容ずれ（同期窓）[us]。超えたものは KEYFRAME_TOLERANCE_ACTION に従う
+KEYFRAME_TOLERANCE_US = {"camera": 50_000, "radar": 50_000, "lidar": 50_000}
+KEYFRAME_TOLERANCE_ACTION = "flag"   # "flag": 残して報告だけ / "reject": キーフレームにしない
+# キーフレームを samples/ に置く方法: "copy" / "hardlink" / "reflink" / "move"
+# move は本家 nuScenes と同じく samples/ にだけ残す（sweeps/ からは消える）
+KEYFRAME_MATERIALIZE = "copy"
+# キーフレームごとに直前のスイープを自車運動で補正して重ねた点群を samples/LIDAR_TOP に置く（0 で作らない）
+# SEGMENT_SEC で区切ったときは、セグメント先頭のキーフレームは前のセグメントのスイープを含まない
+LIDAR_AGGREGATE_SWEEPS = 0
+
+# ===== 計測 =====
+METRICS_ENABLED = False           # True でコールバック / 書き出し / 出力段階の時間を計り、最後にレポートを書く
+METRICS_DIR = None                # metrics.json / metrics.prom の出力先（None なら BASE_DIR）
+
+# ===== アノテーション（sample_annotation / instance）=====
+ANNOTATION_ENABLED = True
+ANNOTATION_MAX_DIST_M = 50.0      # 自車からこの距離[m]までの物体だけ出す（None で全部）
+ANNOTATION_MAX_OFFSET_US = None   # サンプル時刻からこれより離れた tick の箱は使わない
+ANNOTATION_VISIBILITY = "4"       # 遮蔽は計算しないので全部この visibility（"1"=v0-40 … "4"=v80-100）
+# CARLA type_id のパターン → nuScenes category（上から順に最初に当たったもの）
+ANNOTATION_CATEGORIES = {
+    "vehicle.bh.crossbike": "vehicle.bicycle",
+    "vehicle.diamondback.century": "vehicle.bicycle",
+    "vehicle.gazelle.omafiets": "vehicle.bicycle",
+    "vehicle.harley-davidson.*": "vehicle.motorcycle",
+    "vehicle.kawasaki.*": "vehicle.motorcycle",
+    "vehicle.yamaha.*": "vehicle.motorcycle",
+    "vehicle.vespa.*": "vehicle.motorcycle",
+    "vehicle.carlamotors.*": "vehicle.truck",
+    "vehicle.mitsubishi.fusorosa": "vehicle.bus.rigid",
+    "vehicle.*": "vehicle.car",
+    "walker.pedestrian.*": "human.pedestrian.adult",
+}
 
 # ===== NPC (前方に置く車) =====
 NPC_ENABLED = True               # 置きたいとき True
@@ -0,0 +1,172 @@
+"""
+write_nuscenes_jsons の出力を軽く読むためのリーダー（nuscenes-devkit 無しで確認する用）。
+
+  from dataset_reader import NuScenesLite
+  nusc = NuScenesLite("./data/nuScenes", "v1.0-test")
+  sample = nusc.get("sample", nusc.scene[0]["first_sample_token"])
+  pts = nusc.load_lidar(nusc.sample_data_for(sample["token"])["LIDAR_TOP"]["token"])
+
+- テーブルは最初に触ったときに読む（nusc.sample / nusc.table("sample")）。token → 行の索引も同時に1回だけ作る
+- cache=True なら <version>/.cache/ に pickle（テーブル）と npz（センサごとの時刻列）を置き、
+  元 JSON の mtime と size が変わっていなければ次回はそちらを読む
+- LiDAR (.pcd.bin) とレーダ (.pcd) は np.memmap で返す（読み込み専用・コピーなし）。compact の LiDAR は decode する
+"""
+import os
+import json
+import pickle
+import numpy as np
+import config
+from radar_bin2pcd import memmap_nuscenes_radar_pcd
+from lidar_codec import read_lidar
+from utils import CACHE_DIRNAME
+
+try:  # あれば速い JSON 実装を使う
+    import orjson
+except ImportError:
+    orjson = None
+
+TABLES = ["log", "scene", "sample", "sample_data", "ego_pose", "sensor", "calibrated_sensor",
+          "category", "attribute", "visibility", "instance", "sample_annotation", "map"]
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class NuScenesLite:
+    def __init__(self, dataroot=None, version=None, cache=True):
+        self.dataroot = dataroot or config.BASE_DIR
+        self.version = version or config.VERSION
+        self.table_root = os.path.join(self.dataroot, self.version)
+        if not os.path.isdir(self.table_root):
+            raise FileNotFoundError(f"{self.table_root} がありません")
+        self.cache_dir = os.path.join(self.table_root, CACHE_DIRNAME) if cache else None
+        self._tables = {}    # name -> rows
+        self._index = {}     # name -> {token: row 位置}
+        self._timelines = {}
+        self._sensor_channel = None
+        self._sample_data_by_sample = None
+
+    # ---- テーブル ----
+    def _cache_path(self, name, ext):
+        return os.path.join(self.cache_dir, f"{name}.{ext}")
+
+    def _load(self, name):
+        path = os.path.join(self.table_root, name + ".json")
+        key = _file_key(path)
+        if self.cache_dir is not None:
+            try:
+                with open(self._cache_path(name, "pkl"), "rb") as f:
+                    cached_key, rows, index = pickle.load(f)
+                if cached_key == key:
+                    return rows, index
+            except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+                pass
+        with open(path, "rb") as f:
+            rows = orjson.loads(f.read()) if orjson is not None else json.load(f)
+        index = {r["token"]: i for i, r in enumerate(rows)}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._cache_path(name, "pkl.tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump((key, rows, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._cache_path(name, "pkl"))
+        return rows, index
+
+    def table(self, name):
+        if name not in self._tables:
+            self._tables[name], self._index[name] = self._load(name)
+        return self._tables[name]
+
+    def __getattr__(self, name):
+        # nusc.sample のように devkit と同じ書き方で引けるように
+        if name in TABLES:
+            return self.table(name)
+        raise AttributeError(name)
+
+    def get(self, table, token):
+        self.table(table)
+        return self._tables[table][self._index[table][token]]
+
+    def getind(self, table, token):
+        self.table(table)
+        return self._index[table][token]
+
+    # ---- sample_data の索引 ----
+    def channel_of(self, sample_data):
+        if self._sensor_channel is None:
+            calib = {c["token"]: c["sensor_token"] for c in self.table("calibrated_sensor")}
+            channels = {s["token"]: s["channel"] for s in self.table("sensor")}
+            self._sensor_channel = {c: channels[s] for c, s in calib.items()}
+        return self._sensor_channel[sample_data["calibrated_sensor_token"]]
+
+    def sample_data_for(self, sample_token):
+        """sample token → {channel: キーフレームの sample_data}"""
+        if self._sample_data_by_sample is None:
+            by_sample = {}
+            for sd in self.table("sample_data"):
+                if sd["is_key_frame"]:
+                    by_sample.setdefault(sd["sample_token"], {})[self.channel_of(sd)] = sd
+            self._sample_data_by_sample = by_sample
+        return self._sample_data_by_sample.get(sample_token, {})
+
+    def timeline(self, channel):
+        """
+        channel の sample_data を時刻順に並べた (timestamps int64, sample_data の行位置 int64)。
+        npz にキャッシュする（sample_data.json の mtime/size が同じ間だけ有効）。
+        """
+        if channel in self._timelines:
+            return self._timelines[channel]
+        key = np.array(_file_key(os.path.join(self.table_root, "sample_data.json")), dtype=np.int64)
+        npz = self._cache_path(f"timeline_{channel}", "npz") if self.cache_dir is not None else None
+        if npz is not None and os.path.exists(npz):
+            with np.load(npz) as z:
+                if np.array_equal(z["key"], key):
+                    self._timelines[channel] = (z["timestamps"], z["rows"])
+                    return self._timelines[channel]
+        sd = self.table("sample_data")
+        rows = np.array([i for i, r in enumerate(sd) if self.channel_of(r) == channel], dtype=np.int64)
+        ts = np.fromiter((sd[i]["timestamp"] for i in rows), dtype=np.int64, count=len(rows))
+        order = np.argsort(ts, kind="stable")
+        ts, rows = ts[order], rows[order]
+        if npz is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(npz, key=key, timestamps=ts, rows=rows)
+        self._timelines[channel] = (ts, rows)
+        return ts, rows
+
+    def sample_data_between(self, channel, t0_us, t1_us):
+        """channel の sample_data のうち t0 <= timestamp < t1 のもの（時刻順）"""
+        ts, rows = self.timeline(channel)
+        lo, hi = np.searchsorted(ts, [t0_us, t1_us], side="left")
+        sd = self.table("sample_data")
+        return [sd[i] for i in rows[lo:hi].tolist()]
+
+    # ---- ファイル ----
+    def get_sample_data_path(self, sample_data_token):
+        return os.path.join(self.dataroot, self.get("sample_data", sample_data_token)["filename"])
+
+    def load_lidar(self, sample_data_token):
+        """
+        LiDAR (x, y, z, intensity, ring)[float32] を (N, 5) で返す。
+        .pcd.bin は memmap、compact のスイープ（.pcd.q16）は decode した配列。
+        """
+        return read_lidar(self.get_sample_data_path(sample_data_token))
+
+    def load_lidar_sweeps(self, sample_data_token, nsweeps=None):
+        """
+        キーフレームのマルチスイープ点群（lidar_sweeps.py で作ったもの）を
+        (x, y, z, intensity, ring, time_lag)[float32] の (N, 6) memmap で返す。
+        """
+        from lidar_sweeps import aggregate_filename, AGG_COLUMNS
+        nsweeps = nsweeps or getattr(config, "LIDAR_AGGREGATE_SWEEPS", 10)
+        path = os.path.join(self.dataroot, aggregate_filename(
+            self.get("sample_data", sample_data_token)["filename"], nsweeps))
+        if os.path.getsize(path) == 0:
+            return np.zeros((0, AGG_COLUMNS), dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, AGG_COLUMNS)
+
+    def load_radar(self, sample_data_token):
+        """レーダ PCD を RADAR_PCD_DTYPE の memmap（構造化配列）で返す。"""
+        return memmap_nuscenes_radar_pcd(self.get_sample_data_path(sample_data_token))
@@ -0,0 +1,213 @@
+import copy
+import numpy as np
+import config
+
+
+def carla_rpy_to_nus_quat(roll_deg, pitch_deg, yaw_deg):
+    """
+    CARLA の roll/pitch/yaw[deg]（配列可）→ nuScenes 座標系の四元数 [w, x, y, z]（(N, 4)）。
+    sensors.py と同じく R_car = Rz(yaw) Ry(pitch) Rx(roll) とみなし、
+    y 反転 S = diag(1,-1,1) で R_nus = S R_car S。四元数では (w, x, y, z) → (w, -x, y, -z)。
+    """
+    r = np.radians(np.asarray(roll_deg, dtype=np.float64)) / 2
+    p = np.radians(np.asarray(pitch_deg, dtype=np.float64)) / 2
+    y = np.radians(np.asarray(yaw_deg, dtype=np.float64)) / 2
+    cr, sr = np.cos(r), np.sin(r)
+    cp, sp = np.cos(p), np.sin(p)
+    cy, sy = np.cos(y), np.sin(y)
+    q = np.empty(r.shape + (4,), dtype=np.float64)
+    q[..., 0] = cr * cp * cy + sr * sp * sy
+    q[..., 1] = -(sr * cp * cy - cr * sp * sy)
+    q[..., 2] = cr * sp * cy + sr * cp * sy
+    q[..., 3] = -(cr * cp * sy - sr * sp * cy)
+    return q
+
+
+def nus_quat_to_carla_rpy(q):
+    """carla_rpy_to_nus_quat の逆。nuScenes の四元数 [w, x, y, z] (N,4) → CARLA の roll, pitch, yaw[deg]（各 (N,)）。"""
+    q = np.asarray(q, dtype=np.float64)
+    # (w, x, y, z) → (w, -x, y, -z) で CARLA 座標の四元数に戻してから Z-Y-X のオイラー角へ
+    w, x, y, z = q[..., 0], -q[..., 1], q[..., 2], -q[..., 3]
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return np.degrees(roll), np.degrees(pitch), np.degrees(yaw)
+
+
+def quat_to_rotmat(q):
+    """[w, x, y, z] の四元数 (N,4) → 回転行列 (N,3,3)。"""
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    R = np.empty(q.shape[:-1] + (3, 3), dtype=np.float64)
+    R[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    R[..., 0, 1] = 2 * (x * y - z * w)
+    R[..., 0, 2] = 2 * (x * z + y * w)
+    R[..., 1, 0] = 2 * (x * y + z * w)
+    R[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    R[..., 1, 2] = 2 * (y * z - x * w)
+    R[..., 2, 0] = 2 * (x * z - y * w)
+    R[..., 2, 1] = 2 * (y * z + x * w)
+    R[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return R
+
+
+def slerp(q0, q1, t):
+    """(N,4) の四元数同士を t (N,) で球面線形補間（ベクトル化）。"""
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.array(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[:, None]
+    dot = np.sum(q0 * q1, axis=1)
+    # 短い方の弧を通る
+    neg = dot < 0
+    q1[neg] *= -1
+    dot = np.abs(dot)[:, None]
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    near = sin_theta < 1e-6
+    safe = np.where(near, 1.0, sin_theta)
+    w0 = np.where(near, 1.0 - t, np.sin((1.0 - t) * theta) / safe)
+    w1 = np.where(near, t, np.sin(t * theta) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+class ColumnBuffer:
+    """
+    tick ごとの値を列ごとの NumPy 配列へ追記するバッファの共通部分（_ts[us] は昇順に積む前提）。
+    容量が足りなくなったら倍に広げる。長時間の撮影では window() で区間を切り出し、
+    discard_before() で古い行を捨てて大きさを一定に保つ。
+    """
+    _COLUMNS = ("_ts",)
+
+    def __len__(self):
+        return self.n
+
+    def _alloc(self, capacity, columns):
+        """columns: {属性名: (行あたりの形, dtype)}"""
+        self.n = 0
+        for name, (shape, dtype) in columns.items():
+            setattr(self, name, np.empty((capacity,) + shape, dtype=dtype))
+
+    def _grow(self, need=0):
+        cap = max(16, need, self._ts.shape[0] * 2)
+        for name in self._COLUMNS:
+            old = getattr(self, name)
+            new = np.empty((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def window(self, t0_us, t1_us):
+        """t0 <= ts <= t1 の行だけを持つコピー（元のバッファとは配列を共有しない）"""
+        ts = self._ts[:self.n]
+        lo = int(np.searchsorted(ts, t0_us, side="left"))
+        hi = int(np.searchsorted(ts, t1_us, side="right"))
+        out = copy.copy(self)
+        for name in self._COLUMNS:
+            setattr(out, name, getattr(self, name)[lo:hi].copy())
+        out.n = hi - lo
+        return out
+
+    def discard_before(self, ts_us):
+        """ts < ts_us の行を捨てる（残りを先頭に詰める）。"""
+        k = int(np.searchsorted(self._ts[:self.n], ts_us, side="left"))
+        if k == 0:
+            return
+        for name in self._COLUMNS:
+            arr = getattr(self, name)
+            arr[:self.n - k] = arr[k:self.n]
+        self.n -= k
+
+
+class EgoPoseBuffer(ColumnBuffer):
+    """
+    自車の transform / velocity を tick ごとに NumPy 配列へ追記するバッファ。
+    1 tick ごとに dict を作らない（容量は DURATION_SEC / SYNC_FIXED_DELTA から見積もり、足りなければ倍に広げる）。
+    値は CARLA 座標のまま持ち、nuScenes への変換は interpolate() でまとめて行う。
+    """
+    _COLUMNS = ("_ts", "_xyz", "_rpy", "_vel")
+
+    def __init__(self, capacity=None):
+        if capacity is None:
+            delta = getattr(config, "SYNC_FIXED_DELTA", None) or 0.05
+            duration = getattr(config, "SEGMENT_SEC", None) or config.DURATION_SEC
+            capacity = int(duration / delta) + 16
+        self._alloc(capacity, {
+            "_ts": ((), np.int64),          # [us]
+            "_xyz": ((3,), np.float64),     # CARLA x, y, z
+            "_rpy": ((3,), np.float64),     # CARLA roll, pitch, yaw [deg]
+            "_vel": ((3,), np.float64),     # CARLA vx, vy, vz [m/s]
+        })
+
+    def append(self, ts_us, loc, rot, vel):
+        if self.n == self._ts.shape[0]:
+            self._grow()
+        i = self.n
+        self._ts[i] = ts_us
+        self._xyz[i] = (loc.x, loc.y, loc.z)
+        self._rpy[i] = (rot.roll, rot.pitch, rot.yaw)
+        self._vel[i] = (vel.x, vel.y, vel.z)
+        self.n = i + 1
+
+    def extend(self, ts_us, xyz, rpy, vel):
+        """配列でまとめて追記する（マニフェストからの復元用）。"""
+        ts_us = np.asarray(ts_us, dtype=np.int64)
+        k = ts_us.shape[0]
+        if self.n + k > self._ts.shape[0]:
+            self._grow(self.n + k)
+        sl = slice(self.n, self.n + k)
+        self._ts[sl] = ts_us
+        self._xyz[sl] = xyz
+        self._rpy[sl] = rpy
+        self._vel[sl] = vel
+        self.n += k
+
+    def record(self, snapshot, actor):
+        """
+        world.on_tick / run_sync_capture の on_tick から呼ぶ。
+        姿勢は snapshot の中の actor の状態から取る（actor.get_transform() はコールバック時点の値で、
+        snapshot.timestamp とずれる）。snapshot に actor が居なければ何もせず False を返す。
+        """
+        state = snapshot.find(actor.id)
+        if state is None:
+            return False
+        tf = state.get_transform()
+        self.append(int(snapshot.timestamp.elapsed_seconds * 1e6), tf.location, tf.rotation, state.get_velocity())
+        return True
+
+    def row(self, i=-1):
+        """i 行目の (ts[us], xyz, rpy, vel)。CARLA 座標のまま（マニフェストに書く用）"""
+        i = range(self.n)[i]
+        return int(self._ts[i]), self._xyz[i].tolist(), self._rpy[i].tolist(), self._vel[i].tolist()
+
+    @property
+    def timestamps(self):
+        return self._ts[:self.n]
+
+    def interpolate(self, timestamps):
+        """
+        任意の timestamp[us] 列での自車姿勢を nuScenes 座標で返す（範囲外は端の値）。
+        戻り値: translation (N,3), rotation [w,x,y,z] (N,4), velocity (N,3)
+        """
+        if self.n == 0:
+            raise ValueError("ego pose が1つも記録されていません")
+        q_t = np.asarray(timestamps, dtype=np.int64)
+        ts = self._ts[:self.n]
+        if self.n == 1:
+            i0 = i1 = np.zeros(q_t.shape, dtype=np.int64)
+            alpha = np.zeros(q_t.shape)
+        else:
+            i0 = np.clip(np.searchsorted(ts, q_t, side="right") - 1, 0, self.n - 2)
+            i1 = i0 + 1
+            span = (ts[i1] - ts[i0]).astype(np.float64)
+            alpha = np.clip((q_t - ts[i0]) / np.where(span > 0, span, 1.0), 0.0, 1.0)
+        a = alpha[:, None]
+
+        xyz = self._xyz[i0] * (1 - a) + self._xyz[i1] * a
+        vel = self._vel[i0] * (1 - a) + self._vel[i1] * a
+        # CARLA (y右+) → nuScenes (y左+)
+        xyz[:, 1] *= -1
+        vel[:, 1] *= -1
+
+        q0 = carla_rpy_to_nus_quat(*self._rpy[i0].T)
+        q1 = carla_rpy_to_nus_quat(*self._rpy[i1].T)
+        return xyz, slerp(q0, q1, alpha), vel
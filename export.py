@@ -0,0 +1,336 @@
+"""
+撮った記録（captured_*）からの出力: サンプル時刻 → キーフレームを samples/ に置く → テーブルを書く。
+main からは撮影の最後（区切り撮影なら区間ごと）に呼ばれる。
+
+CARLA 無しで撮影済みの sweeps/ から出力し直す（撮影が途中で落ちたときや、サンプル間隔・キーフレームの
+決め方・テーブル形式を変えたとき）:
+  python export.py [--dataroot ./data/nuScenes] [--version v1.0-test] [--workers 8] [--prune-samples]
+                   [--manifest capture_manifest.jsonl | --index v1.0-test] [--set SAMPLE_INTERVAL_US=250000] [--force]
+
+- sweeps/<channel> をチャンネルごとにスレッドで os.scandir し、ファイル名から timestamp を引く
+  （撮影マニフェスト（MANIFEST_ENABLED = True で撮ったとき）か、--index で前に出力した sample_data.json）
+- move で samples/ に移したキーフレームは sweeps/ に戻してから選び直す
+- アクターの箱は残っていないのでアノテーションは付かない。アノテーションのあるバージョンへの上書きは --force が要る
+"""
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import config
+from timeline import plan_sample_times, pick_keyframes_and_copy, format_coverage, sample_path_for
+from nuscenes_writer import write_nuscenes_jsons
+from utils import capture_date
+from lidar_sweeps import aggregate_lidar_sweeps, is_aggregate_name
+from lidar_codec import compact_name
+import metrics
+
+
+def export_scene(captured_images, captured_radar, captured_lidar, ego_poses, actor_boxes,
+                 samples_dir, sweeps_dir, scene_name=None, version=None, duration_sec=None, date_captured=None):
+    """
+    撮った記録からサンプル時刻を決め、キーフレームを samples/ に置いてテーブルを書く。
+    date_captured: log.json の日付（撮影開始時刻から utils.capture_date で作ったもの）
+    戻り値: {channel: {sample index: キーフレームの元（sweeps/）パス}}
+    """
+    # サンプル時刻
+    with metrics.timer("plan_sample_times"):
+        sample_times = plan_sample_times(captured_images, captured_lidar, captured_radar,
+                                         duration_sec=duration_sec)
+
+    # keyframesコピー（チャンネルごとの取りこぼし・キーフレームのずれも集計）
+    coverage = {}
+    with metrics.timer("pick_keyframes_and_copy", modality="camera"):
+        key_img_for_idx = pick_keyframes_and_copy(captured_images, sample_times, sweeps_dir, samples_dir,
+                                                  report=coverage)
+    with metrics.timer("pick_keyframes_and_copy", modality="radar"):
+        key_radar_for_idx = pick_keyframes_and_copy(captured_radar, sample_times, sweeps_dir, samples_dir,
+                                                    report=coverage)
+    key_lidar_for_idx = {}
+    if captured_lidar:
+        # LIDAR_TOPについては各idxごとに最も近いものを samples/ にコピー
+        from timeline import pick_keyframes_and_copy as _pick
+        # 便宜的にdict化して再利用
+        _tmp = {"LIDAR_TOP": captured_lidar}
+        with metrics.timer("pick_keyframes_and_copy", modality="lidar"):
+            copied = _pick(_tmp, sample_times, sweeps_dir, samples_dir, report=coverage)
+        key_lidar_for_idx = {idx: src for idx, src in copied["LIDAR_TOP"].items()}
+
+    print("[COVERAGE]\n" + format_coverage(coverage))
+    report_name = f"coverage_report_{version}.json" if version else "coverage_report.json"
+    with open(os.path.join(config.BASE_DIR, report_name), "w") as f:
+        json.dump(coverage, f, indent=2)
+
+    # JSON出力
+    write_nuscenes_jsons(
+        base_dir=config.BASE_DIR,
+        sample_times=sample_times,
+        key_img_for_idx=key_img_for_idx,
+        key_radar_for_idx=key_radar_for_idx,
+        key_lidar_for_idx=key_lidar_for_idx,
+        captured_images=captured_images,
+        captured_radar=captured_radar,
+        captured_lidar=captured_lidar,
+        ego_poses=ego_poses,
+        actor_boxes=actor_boxes,
+        scene_name=scene_name,
+        version=version,
+        duration_sec=duration_sec,
+        date_captured=date_captured,
+    )
+
+    # キーフレームごとのマルチスイープ LiDAR（LIDAR_AGGREGATE_SWEEPS > 0 のとき）
+    if captured_lidar and getattr(config, "LIDAR_AGGREGATE_SWEEPS", 0):
+        with metrics.timer("aggregate_lidar_sweeps"):
+            aggregate_lidar_sweeps(config.BASE_DIR, version or config.VERSION)
+    return {**key_img_for_idx, **key_radar_for_idx, config.LIDAR_NAME: key_lidar_for_idx}
+
+
+# ---- CARLA 無しでの出力し直し ----
+class SweepIndex:
+    """
+    sweeps/ のファイル名 → (frame, timestamp) の対応と自車姿勢。
+    撮影マニフェスト（from_manifest）か、前に出力したバージョンの sample_data / ego_pose（from_tables）から作る。
+    """
+
+    def __init__(self, entries, ego_poses, scene_name, capture_config, source, date_captured=None):
+        self.entries = entries              # {(channel, ファイル名): (frame or None, timestamp, バイト数 or None)}
+        self.ego_poses = ego_poses
+        self.scene_name = scene_name
+        self.capture_config = capture_config
+        self.source = source
+        self.date_captured = date_captured
+
+    @classmethod
+    def from_manifest(cls, dataroot, path=None):
+        from manifest import load_manifest
+        # move で samples/ に移ったキーフレームもあるので、ファイルの有無とサイズは scan_channel で見る
+        contents = load_manifest(path, base_dir=dataroot, check_files=False)
+        entries = {}
+        for ch, recs in _channels(contents.captured_images, contents.captured_radar, contents.captured_lidar):
+            for r in recs:
+                entries[(ch, os.path.basename(r["path"]))] = (r["frame"], r["timestamp"], r["bytes"])
+        started = contents.header.get("started")
+        return cls(entries, contents.ego_poses, contents.header.get("scene"), contents.header.get("config", {}),
+                   f"manifest ({contents.stats['records']} records)",
+                   capture_date(started) if started is not None else None)
+
+    @classmethod
+    def from_tables(cls, dataroot, version):
+        from dataset_reader import NuScenesLite
+        from ego_pose import EgoPoseBuffer, nus_quat_to_carla_rpy
+        nusc = NuScenesLite(dataroot, version)
+        entries = {}
+        capture_config = {}
+        for sd in nusc.sample_data:
+            ch = nusc.channel_of(sd)
+            name = os.path.basename(sd["filename"])
+            if sd["is_key_frame"]:
+                # compact のキーフレームは samples/ に decode した .pcd.bin が載っているので、sweeps/ の元に引き直す
+                compact = compact_name(name)
+                if compact and os.path.exists(os.path.join(dataroot, "sweeps", ch, compact)):
+                    name = compact
+            entries[(ch, name)] = (None, sd["timestamp"], None)
+            if ch in config.CAM_NAMES and not capture_config:
+                capture_config = {"IMG_W": sd["width"], "IMG_H": sd["height"], "CAM_ENCODER": sd["fileformat"]}
+        ego_poses = None
+        rows = sorted(nusc.ego_pose, key=lambda r: r["timestamp"])
+        if rows:
+            # ego_pose は nuScenes 座標なので EgoPoseBuffer の持ち方（CARLA 座標）に戻す
+            xyz = np.array([r["translation"] for r in rows], dtype=np.float64)
+            xyz[:, 1] *= -1
+            rpy = np.stack(nus_quat_to_carla_rpy([r["rotation"] for r in rows]), axis=1)
+            ego_poses = EgoPoseBuffer(capacity=len(rows))
+            ego_poses.extend([r["timestamp"] for r in rows], xyz, rpy, np.zeros_like(xyz))
+        scene_name = nusc.scene[0]["name"] if nusc.scene else None
+        date_captured = nusc.log[0]["date_captured"] if nusc.log else None
+        return cls(entries, ego_poses, scene_name, capture_config, f"{version}/sample_data.json", date_captured)
+
+
+def _channels(captured_images, captured_radar, captured_lidar):
+    yield from captured_images.items()
+    yield from captured_radar.items()
+    yield config.LIDAR_NAME, captured_lidar
+
+
+def _frame_from_name(name):
+    """CAM_FRONT_123.png → 123"""
+    try:
+        return int(name.split(".", 1)[0].rsplit("_", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def scan_channel(dataroot, channel, index):
+    """
+    sweeps/<channel> を os.scandir で1回だけ見て、index で timestamp を付けた records（時刻順）を返す。
+    samples/<channel> にだけあるファイル（KEYFRAME_MATERIALIZE="move" で移したキーフレーム）は sweeps/ に戻す
+    （sweeps/ に compact の元がある .pcd.bin は decode したコピーなので戻さない）。
+    index にバイト数があれば（マニフェスト）、サイズが違うファイル（書きかけで落ちたもの）は使わない。
+    """
+    sweeps = os.path.join(dataroot, "sweeps", channel)
+    samples = os.path.join(dataroot, "samples", channel)
+    stats = {"restored": 0, "unindexed": 0, "bad_size": 0}
+
+    def size_ok(entry):
+        hit = index.get((channel, entry.name))
+        return hit is None or hit[2] is None or entry.stat().st_size == hit[2]
+
+    files = {}
+    if os.path.isdir(sweeps):
+        with os.scandir(sweeps) as it:
+            files = {e.name: e for e in it if e.is_file()}
+    if os.path.isdir(samples):
+        with os.scandir(samples) as it:
+            moved = [e for e in it if e.is_file() and e.name not in files and (channel, e.name) in index
+                     and compact_name(e.name) not in files]
+        if moved:
+            os.makedirs(sweeps, exist_ok=True)
+        for e in moved:
+            if not size_ok(e):
+                stats["bad_size"] += 1
+                continue
+            os.replace(e.path, os.path.join(sweeps, e.name))
+            files[e.name] = None
+            stats["restored"] += 1
+    records = []
+    for name, entry in files.items():
+        hit = index.get((channel, name))
+        if hit is None:
+            stats["unindexed"] += 1
+            continue
+        if entry is not None and not size_ok(entry):
+            stats["bad_size"] += 1
+            continue
+        frame, ts, _ = hit
+        records.append({"frame": frame if frame is not None else _frame_from_name(name),
+                        "path": os.path.join(sweeps, name), "timestamp": ts})
+    records.sort(key=lambda r: r["timestamp"])
+    return channel, records, stats
+
+
+def prune_samples(dataroot, keyframes):
+    """
+    samples/<channel> のうち今回のキーフレームでないファイル（前回の出力の残り）を消す。
+    キーフレームのマルチスイープ点群（lidar_sweeps）は元のキーフレームが残るなら残す。
+    """
+    removed = 0
+    for ch, picked in keyframes.items():
+        keep = {os.path.basename(sample_path_for(src)) for src in picked.values()}
+        keep_stems = {name.split(".", 1)[0] for name in keep}
+        samples = os.path.join(dataroot, "samples", ch)
+        if not os.path.isdir(samples):
+            continue
+        with os.scandir(samples) as it:
+            stale = [e.path for e in it if e.is_file() and e.name not in keep
+                     and not (is_aggregate_name(e.name) and e.name.split(".", 1)[0] in keep_stems)]
+        for path in stale:
+            os.remove(path)
+        removed += len(stale)
+    return removed
+
+
+def _has_annotations(dataroot, version):
+    """<version>/sample_annotation.json に1行でもあるか（先頭だけ見る）"""
+    try:
+        with open(os.path.join(dataroot, version, "sample_annotation.json"), "rb") as f:
+            head = f.read(16).lstrip()
+    except OSError:
+        return False
+    return bool(head) and not head.startswith(b"[]")
+
+
+def reexport(dataroot=None, version=None, manifest=None, index_version=None, scene_name=None,
+             workers=None, prune=False, keep_config=(), force=False):
+    """
+    撮影済みの sweeps/ から、今の config（サンプル間隔・キーフレームの決め方・テーブル形式など）で
+    samples/ とテーブルを作り直す。シミュレータは使わない。
+    timestamp は manifest（既定）か index_version の sample_data.json から引く。アノテーションは付かない。
+    keep_config: 撮影時の config（画像サイズ等）で上書きしない config 名（--set で指定したもの）
+    force: アノテーションのあるバージョンでも上書きする（アノテーションは消える）
+    """
+    dataroot = dataroot or config.BASE_DIR
+    if not force and _has_annotations(dataroot, version or config.VERSION):
+        # マニフェストにも sweeps/ にもアクターの箱は無いので、上書きすると作り直せない
+        raise SystemExit(f"{version or config.VERSION} には sample_annotation があり、出力し直すと消えます。"
+                         f"別の --version に出すか、消してよければ --force を付けてください")
+    config.BASE_DIR = dataroot
+    workers = workers or getattr(config, "EXPORT_WORKERS", 1)
+    t0 = time.time()
+    if index_version is not None:
+        index = SweepIndex.from_tables(dataroot, index_version)
+    else:
+        from manifest import manifest_path
+        manifest = manifest or manifest_path(dataroot)
+        if not os.path.exists(manifest):
+            raise SystemExit(f"撮影マニフェスト {manifest} がありません。"
+                             f"前に出力したバージョンを --index で指定するか、MANIFEST_ENABLED = True で撮ってください")
+        index = SweepIndex.from_manifest(dataroot, manifest)
+    # 画像サイズなど撮影時の値に戻す
+    for key, value in index.capture_config.items():
+        if key not in keep_config:
+            setattr(config, key, value)
+
+    channels = list(config.CAM_NAMES) + list(config.RADAR_NAMES) + [config.LIDAR_NAME]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        scanned = list(ex.map(lambda ch: scan_channel(dataroot, ch, index.entries), channels))
+    by_channel = {ch: records for ch, records, _ in scanned}
+    totals = {k: sum(st[k] for _, _, st in scanned) for k in ("restored", "unindexed", "bad_size")}
+    print(f"[REEXPORT] index: {index.source}, frames={sum(len(r) for r in by_channel.values())} "
+          + " ".join(f"{k}={n}" for k, n in totals.items()) + f" ({time.time() - t0:.1f}s)")
+
+    captured_images = {ch: by_channel[ch] for ch in config.CAM_NAMES}
+    captured_radar = {ch: by_channel[ch] for ch in config.RADAR_NAMES}
+    captured_lidar = by_channel[config.LIDAR_NAME]
+    cam = [recs for recs in captured_images.values() if recs]
+    if not cam:
+        raise SystemExit("sweeps/ にカメラのフレームが見つかりません")
+    duration_sec = (max(r[-1]["timestamp"] for r in cam) - min(r[0]["timestamp"] for r in cam)) / 1e6
+    keyframes = export_scene(captured_images, captured_radar, captured_lidar, index.ego_poses, None,
+                             os.path.join(dataroot, "samples"), os.path.join(dataroot, "sweeps"),
+                             scene_name=scene_name or index.scene_name, version=version,
+                             duration_sec=duration_sec, date_captured=index.date_captured)
+    if prune:
+        print(f"[REEXPORT] 古いキーフレーム {prune_samples(dataroot, keyframes)} 件を samples/ から消しました")
+    print(f"[REEXPORT] {time.time() - t0:.1f}s")
+    return keyframes
+
+
+def _apply_overrides(items):
+    keys = []
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            setattr(config, key, json.loads(value))
+        except json.JSONDecodeError:
+            setattr(config, key, value)
+        keys.append(key)
+    return keys
+
+
+def main():
+    ap = argparse.ArgumentParser(description="撮影済みの sweeps/ からキーフレームとテーブルを出力し直す（CARLA 不要）")
+    ap.add_argument("--dataroot", default=config.BASE_DIR)
+    ap.add_argument("--version", default=None, help="出力するバージョン（既定は config.VERSION）")
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--manifest", default=None, help="timestamp の出所（既定は <dataroot>/MANIFEST_NAME）")
+    src.add_argument("--index", default=None, metavar="VERSION",
+                     help="マニフェストの代わりに、前に出力したこのバージョンの sample_data.json を使う")
+    ap.add_argument("--scene", default=None, help="scene 名（既定はマニフェストのヘッダ / 元の scene）")
+    ap.add_argument("--workers", type=int, default=None, help="走査・コピーのスレッド数（既定は config.EXPORT_WORKERS）")
+    ap.add_argument("--prune-samples", action="store_true", help="キーフレームでなくなった samples/ のファイルを消す")
+    ap.add_argument("--force", action="store_true",
+                    help="アノテーションのあるバージョンにも上書きする（sample_annotation / instance は空になる）")
+    ap.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                    help="config を上書き（VALUE は JSON として解釈）")
+    args = ap.parse_args()
+    overridden = _apply_overrides(args.set)
+    reexport(args.dataroot, args.version, manifest=args.manifest, index_version=args.index,
+             scene_name=args.scene, workers=args.workers, prune=args.prune_samples, keep_config=overridden,
+             force=args.force)
+    print("✅ NuScenes形式の出力が完了しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+"""
+CARLA サーバ無しで取得パイプラインを動かすための最小スタンドイン。
+
+`install()` を呼ぶと sys.modules["carla"] にこのモジュールが入るので、
+その後に sensors / carla_setup / main を import すれば本物の代わりに使われる。
+同期モード（world.tick() 駆動）と非同期モード（内部スレッドで自走）の両方に対応し、
+各センサは sensor_tick に従って CARLA と同じ形式の raw_data を別スレッドから届ける。
+"""
+import sys
+import math
+import time
+import queue
+import fnmatch
+import threading
+import itertools
+
+import numpy as np
+
+
+# ========== 基本型 ==========
+class Vector3D:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = float(x), float(y), float(z)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(x={self.x:.3f}, y={self.y:.3f}, z={self.z:.3f})"
+
+
+class Location(Vector3D):
+    pass
+
+
+class Rotation:
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch, self.yaw, self.roll = float(pitch), float(yaw), float(roll)
+
+    def __repr__(self):
+        return f"Rotation(pitch={self.pitch:.3f}, yaw={self.yaw:.3f}, roll={self.roll:.3f})"
+
+
+class Transform:
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def get_forward_vector(self):
+        yaw = math.radians(self.rotation.yaw)
+        pitch = math.radians(self.rotation.pitch)
+        return Vector3D(math.cos(pitch) * math.cos(yaw), math.cos(pitch) * math.sin(yaw), math.sin(pitch))
+
+
+class BoundingBox:
+    def __init__(self, location=None, extent=None):
+        self.location = location if location is not None else Location()
+        self.extent = extent if extent is not None else Vector3D()
+
+
+class WeatherParameters:
+    def __init__(self, name="Default"):
+        self.name = name
+
+
+for _name in ("Default", "ClearNoon", "CloudyNoon", "WetNoon", "HardRainNoon",
+              "ClearSunset", "CloudySunset", "WetSunset", "ClearNight"):
+    setattr(WeatherParameters, _name, WeatherParameters(_name))
+
+
+class LaneType:
+    Driving = 2
+    Any = -2
+
+
+class VehicleControl:
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False):
+        self.throttle, self.steer, self.brake = throttle, steer, brake
+        self.hand_brake, self.reverse = hand_brake, reverse
+
+
+class WorldSettings:
+    def __init__(self, synchronous_mode=False, fixed_delta_seconds=None, no_rendering_mode=False):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.no_rendering_mode = no_rendering_mode
+
+
+class Timestamp:
+    def __init__(self, frame, elapsed_seconds, delta_seconds):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = time.time()
+
+
+class ActorSnapshot:
+    """tick 時点のアクターの状態（CARLA の ActorSnapshot と同じく後から動いても変わらない）"""
+
+    def __init__(self, actor_id, transform, velocity):
+        self.id = actor_id
+        self._transform = transform
+        self._velocity = velocity
+
+    def get_transform(self):
+        return self._transform
+
+    def get_velocity(self):
+        return self._velocity
+
+    def get_angular_velocity(self):
+        return Vector3D()
+
+    def get_acceleration(self):
+        return Vector3D()
+
+
+class WorldSnapshot:
+    def __init__(self, timestamp, actors=()):
+        self.timestamp = timestamp
+        self.frame = timestamp.frame
+        self._actors = {a.id: a for a in actors}
+
+    def __len__(self):
+        return len(self._actors)
+
+    def __iter__(self):
+        return iter(self._actors.values())
+
+    def has_actor(self, actor_id):
+        return actor_id in self._actors
+
+    def find(self, actor_id):
+        return self._actors.get(actor_id)
+
+
+# ========== ブループリント ==========
+class ActorBlueprint:
+    def __init__(self, type_id, **attributes):
+        self.id = type_id
+        self.tags = type_id.split(".")
+        self._attrs = {k: str(v) for k, v in attributes.items()}
+
+    def has_attribute(self, key):
+        return key in self._attrs
+
+    def set_attribute(self, key, value):
+        self._attrs[key] = str(value)
+
+    def get(self, key, default=None):
+        return self._attrs.get(key, default)
+
+
+_BLUEPRINTS = {
+    "sensor.camera.rgb": dict(image_size_x=800, image_size_y=600, fov=90, sensor_tick=0.0),
+    "sensor.other.radar": dict(horizontal_fov=30, vertical_fov=30, range=100,
+                               points_per_second=1500, sensor_tick=0.0),
+    "sensor.lidar.ray_cast": dict(range=10, channels=32, points_per_second=56000,
+                                  rotation_frequency=10, horizontal_fov=360,
+                                  upper_fov=10, lower_fov=-30, sensor_tick=0.0),
+    "vehicle.audi.tt": dict(),
+    "vehicle.audi.a2": dict(),
+    "vehicle.tesla.model3": dict(),
+    "vehicle.lincoln.mkz_2020": dict(),
+    "vehicle.nissan.micra": dict(),
+    "walker.pedestrian.0001": dict(),
+    "walker.pedestrian.0003": dict(),
+}
+
+
+class BlueprintLibrary:
+    def find(self, type_id):
+        if type_id not in _BLUEPRINTS:
+            raise RuntimeError(f"blueprint '{type_id}' not found")
+        return ActorBlueprint(type_id, **_BLUEPRINTS[type_id])
+
+    def filter(self, pattern):
+        return [self.find(k) for k in _BLUEPRINTS if fnmatch.fnmatch(k, pattern)]
+
+
+# ========== アクター ==========
+_ACTOR_IDS = itertools.count(100)
+
+_EXTENTS = {
+    "vehicle": Vector3D(2.3, 1.0, 0.75),
+    "walker": Vector3D(0.25, 0.25, 0.9),
+}
+
+
+class Actor:
+    def __init__(self, world, blueprint, transform, parent=None):
+        self.id = next(_ACTOR_IDS)
+        self.type_id = blueprint.id
+        self.attributes = dict(blueprint._attrs)
+        self.parent = parent
+        self.is_alive = True
+        self._world = world
+        self._transform = transform
+        self._velocity = Vector3D()
+        self._autopilot = False
+        kind = self.type_id.split(".")[0]
+        extent = _EXTENTS.get(kind, Vector3D())
+        self.bounding_box = BoundingBox(Location(0.0, 0.0, extent.z), Vector3D(extent.x, extent.y, extent.z))
+
+    def get_transform(self):
+        if self.parent is None:
+            return self._transform
+        return _compose(self.parent.get_transform(), self._transform)
+
+    def get_location(self):
+        return self.get_transform().location
+
+    def get_velocity(self):
+        return self._velocity
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        self._autopilot = bool(enabled)
+
+    def apply_control(self, control):
+        pass
+
+    def destroy(self):
+        self.is_alive = False
+        self._world._remove(self)
+        return True
+
+    def _step(self, dt):
+        # オートパイロット中は向いている方向へ一定速度で進める
+        if not self._autopilot or self.parent is not None:
+            return
+        speed = 8.0
+        yaw = math.radians(self._transform.rotation.yaw)
+        self._velocity = Vector3D(speed * math.cos(yaw), speed * math.sin(yaw), 0.0)
+        loc = self._transform.location
+        self._transform = Transform(
+            Location(loc.x + self._velocity.x * dt, loc.y + self._velocity.y * dt, loc.z),
+            self._transform.rotation,
+        )
+
+
+def _compose(parent_tf, child_tf):
+    yaw = math.radians(parent_tf.rotation.yaw)
+    c, s = math.cos(yaw), math.sin(yaw)
+    lx, ly, lz = child_tf.location.x, child_tf.location.y, child_tf.location.z
+    loc = Location(parent_tf.location.x + c * lx - s * ly,
+                   parent_tf.location.y + s * lx + c * ly,
+                   parent_tf.location.z + lz)
+    rot = Rotation(pitch=parent_tf.rotation.pitch + child_tf.rotation.pitch,
+                   yaw=parent_tf.rotation.yaw + child_tf.rotation.yaw,
+                   roll=parent_tf.rotation.roll + child_tf.rotation.roll)
+    return Transform(loc, rot)
+
+
+# ========== センサデータ ==========
+class SensorData:
+    def __init__(self, frame, timestamp, transform):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.transform = transform
+
+
+class Image(SensorData):
+    def __init__(self, frame, timestamp, transform, width, height, fov, raw_data):
+        super().__init__(frame, timestamp, transform)
+        self.width, self.height, self.fov = width, height, fov
+        self.raw_data = raw_data
+
+    def save_to_disk(self, path, color_converter=None):
+        from PIL import Image as PILImage
+        bgra = np.frombuffer(self.raw_data, dtype=np.uint8).reshape(self.height, self.width, 4)
+        PILImage.fromarray(bgra[:, :, [2, 1, 0, 3]]).save(path)
+
+
+class LidarMeasurement(SensorData):
+    def __init__(self, frame, timestamp, transform, channels, raw_data, counts):
+        super().__init__(frame, timestamp, transform)
+        self.channels = channels
+        self.raw_data = raw_data
+        self._counts = counts
+        self.horizontal_angle = 0.0
+
+    def get_point_count(self, channel):
+        return int(self._counts[channel])
+
+    def __len__(self):
+        return len(self.raw_data) // 16
+
+
+class RadarDetection:
+    def __init__(self, velocity, azimuth, altitude, depth):
+        self.velocity, self.azimuth, self.altitude, self.depth = velocity, azimuth, altitude, depth
+
+
+class RadarMeasurement(SensorData):
+    def __init__(self, frame, timestamp, transform, raw_data):
+        super().__init__(frame, timestamp, transform)
+        self.raw_data = raw_data
+
+    def get_detection_count(self):
+        return len(self.raw_data) // 16
+
+    def __len__(self):
+        return self.get_detection_count()
+
+    def __iter__(self):
+        arr = np.frombuffer(self.raw_data, dtype=np.float32).reshape(-1, 4)
+        for v, az, alt, d in arr:
+            yield RadarDetection(float(v), float(az), float(alt), float(d))
+
+
+class Sensor(Actor):
+    def __init__(self, world, blueprint, transform, parent=None):
+        super().__init__(world, blueprint, transform, parent)
+        self.sensor_tick = float(self.attributes.get("sensor_tick", 0.0) or 0.0)
+        self._callback = None
+        self._last_elapsed = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._rng = np.random.default_rng(self.id)
+        self._static = None
+
+    @property
+    def is_listening(self):
+        return self._callback is not None
+
+    def listen(self, callback):
+        self._callback = callback
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+        self._world._ensure_running()
+
+    def stop(self):
+        self._callback = None
+        self._queue.put(None)
+
+    def destroy(self):
+        self.stop()
+        return super().destroy()
+
+    def _dispatch(self):
+        # CARLA と同様、コールバックはシミュレーションとは別スレッドから呼ばれる
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            cb = self._callback
+            if cb is not None:
+                cb(data)
+
+    def _maybe_fire(self, frame, elapsed, delta):
+        if self._callback is None:
+            return
+        if self._last_elapsed is not None and elapsed - self._last_elapsed < self.sensor_tick - 1e-4:
+            return
+        period = delta if self._last_elapsed is None else elapsed - self._last_elapsed
+        self._last_elapsed = elapsed
+        self._queue.put(self._make_data(frame, elapsed, period))
+
+    def _make_data(self, frame, elapsed, period):
+        raise NotImplementedError
+
+
+class CameraSensor(Sensor):
+    def _make_data(self, frame, elapsed, period):
+        w = int(self.attributes["image_size_x"])
+        h = int(self.attributes["image_size_y"])
+        if self._static is None:
+            # 横方向グラデーション + ノイズ（エンコーダが手を抜けない程度の内容）
+            base = np.empty((h, w, 4), dtype=np.uint8)
+            base[:, :, 0] = np.linspace(0, 255, w, dtype=np.uint8)[None, :]
+            base[:, :, 1] = np.linspace(0, 255, h, dtype=np.uint8)[:, None]
+            base[:, :, 2] = self._rng.integers(0, 64, size=(h, w), dtype=np.uint8)
+            base[:, :, 3] = 255
+            self._static = base
+        buf = self._static.copy()
+        buf[:, :, 2] += np.uint8(frame % 64)
+        return Image(frame, elapsed, self.get_transform(), w, h,
+                     float(self.attributes["fov"]), memoryview(buf.reshape(-1)))
+
+
+class LidarSensor(Sensor):
+    def _make_data(self, frame, elapsed, period):
+        channels = int(self.attributes["channels"])
+        pps = float(self.attributes["points_per_second"])
+        upper = float(self.attributes["upper_fov"])
+        lower = float(self.attributes["lower_fov"])
+        rng_max = float(self.attributes["range"])
+        n = max(int(pps * period), channels)
+        per_ch = n // channels
+        n = per_ch * channels
+        ch = np.repeat(np.arange(channels), per_ch)
+        # CARLA と同じく channel 0 が最上段
+        elev = np.radians(upper - (upper - lower) * ch / max(channels - 1, 1))
+        az = self._rng.uniform(-math.pi, math.pi, n)
+        r = self._rng.uniform(2.0, rng_max, n)
+        pts = np.empty((n, 4), dtype=np.float32)
+        pts[:, 0] = r * np.cos(elev) * np.cos(az)
+        pts[:, 1] = r * np.cos(elev) * np.sin(az)
+        pts[:, 2] = r * np.sin(elev)
+        pts[:, 3] = self._rng.uniform(0.0, 1.0, n)
+        counts = np.full(channels, per_ch)
+        return LidarMeasurement(frame, elapsed, self.get_transform(), channels,
+                                memoryview(pts.reshape(-1).view(np.uint8)), counts)
+
+
+class RadarSensor(Sensor):
+    def _make_data(self, frame, elapsed, period):
+        pps = float(self.attributes["points_per_second"])
+        hfov = math.radians(float(self.attributes["horizontal_fov"]))
+        vfov = math.radians(float(self.attributes["vertical_fov"]))
+        rng_max = float(self.attributes["range"])
+        n = int(pps * period)
+        det = np.empty((n, 4), dtype=np.float32)  # velocity, azimuth, altitude, depth
+        det[:, 0] = self._rng.uniform(-15.0, 15.0, n)
+        det[:, 1] = self._rng.uniform(-hfov / 2, hfov / 2, n)
+        det[:, 2] = self._rng.uniform(-vfov / 2, vfov / 2, n)
+        det[:, 3] = self._rng.uniform(1.0, rng_max, n)
+        return RadarMeasurement(frame, elapsed, self.get_transform(),
+                                memoryview(det.reshape(-1).view(np.uint8)))
+
+
+_SENSOR_CLASSES = {
+    "sensor.camera.rgb": CameraSensor,
+    "sensor.lidar.ray_cast": LidarSensor,
+    "sensor.other.radar": RadarSensor,
+}
+
+
+# ========== マップ ==========
+class Waypoint:
+    def __init__(self, transform):
+        self.transform = transform
+
+    def next(self, distance):
+        tf = self.transform
+        yaw = math.radians(tf.rotation.yaw)
+        loc = Location(tf.location.x + distance * math.cos(yaw),
+                       tf.location.y + distance * math.sin(yaw),
+                       tf.location.z)
+        return [Waypoint(Transform(loc, Rotation(yaw=tf.rotation.yaw)))]
+
+
+class Map:
+    def __init__(self, name):
+        self.name = name
+        self._spawn_points = [
+            Transform(Location(x=10.0 * i, y=-5.0 * i, z=0.3), Rotation(yaw=90.0 * (i % 4)))
+            for i in range(16)
+        ]
+
+    def get_spawn_points(self):
+        return list(self._spawn_points)
+
+    def get_waypoint(self, location, project_to_road=True, lane_type=LaneType.Driving):
+        return Waypoint(Transform(Location(location.x, location.y, 0.0), Rotation()))
+
+
+# ========== ワールド / クライアント ==========
+class World:
+    _FRAME0 = 1000
+    _ASYNC_DELTA = 0.05
+
+    def __init__(self, map_name="Town02"):
+        self._map = Map(map_name)
+        self._settings = WorldSettings()
+        self._actors = {}
+        self._lock = threading.RLock()
+        self._frame = self._FRAME0
+        self._elapsed = 0.0
+        self._runner = None
+        self._stop = threading.Event()
+        self._on_tick = []
+        self.weather = WeatherParameters.Default
+
+    # --- 設定 ---
+    def get_settings(self):
+        s = self._settings
+        return WorldSettings(s.synchronous_mode, s.fixed_delta_seconds, s.no_rendering_mode)
+
+    def apply_settings(self, settings):
+        with self._lock:
+            self._settings = WorldSettings(settings.synchronous_mode,
+                                           settings.fixed_delta_seconds,
+                                           settings.no_rendering_mode)
+        if settings.synchronous_mode:
+            self._stop_runner()
+        else:
+            self._ensure_running()
+        return self._frame
+
+    def set_weather(self, weather):
+        self.weather = weather
+
+    def get_weather(self):
+        return self.weather
+
+    def get_map(self):
+        return self._map
+
+    def get_blueprint_library(self):
+        return BlueprintLibrary()
+
+    # --- アクター ---
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        cls = _SENSOR_CLASSES.get(blueprint.id, Actor)
+        actor = cls(self, blueprint, transform, parent=attach_to)
+        with self._lock:
+            self._actors[actor.id] = actor
+        return actor
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        try:
+            return self.spawn_actor(blueprint, transform, attach_to)
+        except RuntimeError:
+            return None
+
+    def get_actors(self):
+        with self._lock:
+            return ActorList(self._actors.values())
+
+    def _remove(self, actor):
+        with self._lock:
+            self._actors.pop(actor.id, None)
+
+    # --- 時間 ---
+    def get_snapshot(self):
+        with self._lock:
+            actors = list(self._actors.values())
+            timestamp = Timestamp(self._frame, self._elapsed, self._delta())
+        return WorldSnapshot(timestamp, [ActorSnapshot(a.id, a.get_transform(), a.get_velocity()) for a in actors])
+
+    def on_tick(self, callback):
+        cb_id = next(_ACTOR_IDS)
+        self._on_tick.append((cb_id, callback))
+        return cb_id
+
+    def remove_on_tick(self, cb_id):
+        self._on_tick = [(i, cb) for i, cb in self._on_tick if i != cb_id]
+
+    def tick(self, seconds=10.0):
+        if not self._settings.synchronous_mode:
+            raise RuntimeError("tick() は同期モードでのみ呼べます")
+        return self._advance()
+
+    def wait_for_tick(self, seconds=10.0):
+        frame = self._frame
+        deadline = time.time() + seconds
+        while self._frame == frame:
+            if time.time() > deadline:
+                raise RuntimeError("time-out while waiting for the simulator")
+            time.sleep(0.001)
+        return self.get_snapshot()
+
+    def _delta(self):
+        d = self._settings.fixed_delta_seconds
+        return float(d) if d else self._ASYNC_DELTA
+
+    def _advance(self):
+        with self._lock:
+            delta = self._delta()
+            self._frame += 1
+            self._elapsed += delta
+            frame, elapsed = self._frame, self._elapsed
+            actors = list(self._actors.values())
+        for a in actors:
+            a._step(delta)
+        snapshot = self.get_snapshot()
+        for _, cb in list(self._on_tick):
+            cb(snapshot)
+        for a in actors:
+            if isinstance(a, Sensor):
+                a._maybe_fire(frame, elapsed, delta)
+        return frame
+
+    def _ensure_running(self):
+        # 非同期モードではサーバ同様に実時間で勝手に進む
+        if self._settings.synchronous_mode or self._runner is not None:
+            return
+        self._stop.clear()
+        self._runner = threading.Thread(target=self._run_async, daemon=True)
+        self._runner.start()
+
+    def _stop_runner(self):
+        if self._runner is None:
+            return
+        self._stop.set()
+        self._runner.join()
+        self._runner = None
+
+    def _run_async(self):
+        while not self._stop.is_set():
+            self._advance()
+            time.sleep(self._delta())
+
+
+class ActorList(list):
+    def filter(self, pattern):
+        return ActorList(a for a in self if fnmatch.fnmatch(a.type_id, pattern))
+
+    def find(self, actor_id):
+        for a in self:
+            if a.id == actor_id:
+                return a
+        return None
+
+
+class TrafficManager:
+    def __init__(self, port):
+        self.port = port
+        self.synchronous = False
+
+    def set_synchronous_mode(self, enabled):
+        self.synchronous = bool(enabled)
+
+    def get_port(self):
+        return self.port
+
+
+class Client:
+    def __init__(self, host="127.0.0.1", port=2000, worker_threads=0):
+        self.host, self.port = host, port
+        self._world = World()
+        self._tms = {}
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def load_world(self, map_name):
+        self._world._stop_runner()
+        self._world = World(map_name)
+        return self._world
+
+    def get_world(self):
+        return self._world
+
+    def get_trafficmanager(self, port=8000):
+        return self._tms.setdefault(port, TrafficManager(port))
+
+
+def install():
+    """sys.modules に 'carla' として登録する（既に本物が import 済みなら上書きしない）。"""
+    mod = sys.modules[__name__]
+    sys.modules.setdefault("carla", mod)
+    return sys.modules["carla"]
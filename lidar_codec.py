@@ -0,0 +1,121 @@
+"""
+LiDAR スイープの保存形式（config.LIDAR_SWEEP_ENCODING / LIDAR_VOXEL_SIZE）。
+
+- "float"  : nuScenes 標準の .pcd.bin（(x, y, z, intensity, ring)[float32]、1点 20 バイト）
+- "compact": .pcd.q16（1点 8 バイト）。16 バイトのヘッダ（magic, scale, 点数）に続けて
+             xyz を scale[m] 刻みの int16、intensity を 0..255 の uint8、ring を uint8 で並べる
+             （sample_data.json の fileformat は "q16"）
+voxel_downsample は voxel ごとに1点だけ残す（実際の返りの値と ring をそのまま使うため平均はとらない）。
+キーフレームは samples/ に置くとき decode して標準の .pcd.bin にする（timeline.materialize）。
+"""
+import os
+import numpy as np
+import config
+
+COMPACT_EXT = ".pcd.q16"
+FLOAT_EXT = ".pcd.bin"
+COMPACT_FILEFORMAT = "q16"     # sample_data.json の fileformat（decode したキーフレームは "pcd" のまま）
+COMPACT_MAGIC = b"LQ16"
+COMPACT_HEADER_DTYPE = np.dtype([("magic", "S4"), ("scale", "<f4"), ("n", "<u4"), ("reserved", "<u4")])
+COMPACT_DTYPE = np.dtype([("xyz", "<i2", (3,)), ("intensity", "u1"), ("ring", "u1")])
+ENCODINGS = ("float", "compact")
+
+
+def sweep_ext(encoding=None):
+    enc = encoding or getattr(config, "LIDAR_SWEEP_ENCODING", "float")
+    if enc not in ENCODINGS:
+        raise ValueError(f"unknown lidar encoding: {enc} (choose from {ENCODINGS})")
+    return COMPACT_EXT if enc == "compact" else FLOAT_EXT
+
+
+def compact_name(name):
+    """LIDAR_TOP_123.pcd.bin → LIDAR_TOP_123.pcd.q16（.pcd.bin でなければ None）。samples/ のキーフレーム → sweeps/ の元"""
+    if not name.endswith(FLOAT_EXT):
+        return None
+    return name[:-len(FLOAT_EXT)] + COMPACT_EXT
+
+
+def compact_scale():
+    """int16 の刻み[m]。未指定なら LIDAR_RANGE が収まる一番細かい刻み"""
+    scale = getattr(config, "LIDAR_COMPACT_SCALE", None)
+    if scale:
+        return float(scale)
+    return float(config.LIDAR_RANGE) * 1.01 / np.iinfo(np.int16).max
+
+
+def voxel_downsample(pts, voxel_size):
+    """(N, C) の点群を voxel_size[m] の格子で間引く（voxel ごとに1点、元の順序のまま）。"""
+    if not voxel_size or pts.shape[0] == 0:
+        return pts
+    keys = np.floor(pts[:, :3] * np.float32(1.0 / voxel_size)).astype(np.int64)
+    keys -= keys.min(axis=0)
+    span = keys.max(axis=0) + 1
+    flat = (keys[:, 0] * span[1] + keys[:, 1]) * span[2] + keys[:, 2]
+    # np.unique(return_index=True) は安定ソートで遅いので、普通の argsort で境目だけ拾う
+    order = np.argsort(flat)
+    sorted_keys = flat[order]
+    head = np.empty(sorted_keys.shape[0], dtype=bool)
+    head[0] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=head[1:])
+    keep = order[head]
+    keep.sort()
+    return pts[keep]
+
+
+def encode_compact(pts, scale=None):
+    """(N, 5) float32 → (ヘッダ, 本体) の構造化配列（COMPACT_HEADER_DTYPE, COMPACT_DTYPE）"""
+    scale = scale or compact_scale()
+    n = pts.shape[0]
+    body = np.empty(n, dtype=COMPACT_DTYPE)
+    q = np.rint(pts[:, :3] * np.float32(1.0 / scale))
+    np.clip(q, -32767, 32767, out=q)
+    body["xyz"] = q
+    body["intensity"] = np.clip(np.rint(pts[:, 3] * 255.0), 0, 255)
+    body["ring"] = np.clip(pts[:, 4], 0, 255)
+    header = np.array([(COMPACT_MAGIC, scale, n, 0)], dtype=COMPACT_HEADER_DTYPE)
+    return header, body
+
+
+def write_compact(path, pts, scale=None):
+    header, body = encode_compact(pts, scale)
+    with open(path, "wb") as f:
+        header.tofile(f)
+        body.tofile(f)
+
+
+def read_compact_raw(path):
+    """(scale, COMPACT_DTYPE の memmap) を返す（decode しない）"""
+    header = np.fromfile(path, dtype=COMPACT_HEADER_DTYPE, count=1)
+    if header.shape[0] != 1 or header["magic"][0] != COMPACT_MAGIC:
+        raise ValueError(f"{path}: compact LiDAR ではありません")
+    n = int(header["n"][0])
+    if n == 0:
+        return float(header["scale"][0]), np.zeros(0, dtype=COMPACT_DTYPE)
+    body = np.memmap(path, dtype=COMPACT_DTYPE, mode="r", offset=COMPACT_HEADER_DTYPE.itemsize, shape=(n,))
+    return float(header["scale"][0]), body
+
+
+def decode_compact(path, out=None):
+    """.pcd.q16 → (N, 5) float32（x, y, z, intensity, ring）"""
+    scale, body = read_compact_raw(path)
+    n = body.shape[0]
+    if out is None:
+        out = np.empty((n, 5), dtype=np.float32)
+    np.multiply(body["xyz"], np.float32(scale), out=out[:, :3], casting="unsafe")
+    np.multiply(body["intensity"], np.float32(1.0 / 255.0), out=out[:, 3], casting="unsafe")
+    out[:, 4] = body["ring"]
+    return out
+
+
+def read_lidar(path):
+    """拡張子を見て (N, 5) float32 を返す（.pcd.bin は memmap、.pcd.q16 は decode した配列）。"""
+    if path.endswith(COMPACT_EXT):
+        return decode_compact(path)
+    if os.path.getsize(path) == 0:
+        return np.zeros((0, 5), dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, 5)
+
+
+def decode_to_float(src, dst):
+    """compact のスイープを標準の .pcd.bin として書く（キーフレーム用）"""
+    decode_compact(src).tofile(dst)
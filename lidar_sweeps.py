@@ -0,0 +1,205 @@
+"""
+キーフレームごとの LiDAR マルチスイープ点群を前もって作る（config.LIDAR_AGGREGATE_SWEEPS）。
+
+  python lidar_sweeps.py [--dataroot ./data/nuScenes] [--version v1.0-test] [--nsweeps 10] [--workers 4]
+
+samples/LIDAR_TOP の各キーフレームについて、それ自身を含む直前 nsweeps 枚のスイープを
+自車姿勢で補正してキーフレーム時刻のセンサ座標に揃え、キーフレームの隣に
+<キーフレーム名>.sweeps<K>.bin（(x, y, z, intensity, ring, time_lag[s])[float32] の6列）として書く。
+time_lag = キーフレーム時刻 - スイープ時刻。devkit の LidarPointCloud.from_file_multisweep とは形が違う
+（あちらは (x, y, z, intensity) の4行と別配列の times を返し、ring は無い）ので、devkit で読むときは
+[:, :4].T と [:, 5] に分けて使う。
+
+- スイープごとの変換 inv(S) inv(E_key) E_i S はまとめて (N, 4, 4) で作る
+- 元スイープのファイル（size / mtime）と姿勢・取り付けのハッシュを <version>/.cache に残し、
+  変わっていないキーフレームは作り直さない
+- 区切り撮影（SEGMENT_SEC）ではセグメントごとに作るので、セグメントの先頭付近のキーフレームは
+  前のセグメントのスイープを使えず nsweeps 枚に満たない（まとめたバージョンに対してこのスクリプトを
+  もう一度流せば、つながった時系列で作り直せる）
+"""
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import config
+from dataset_reader import NuScenesLite, CACHE_DIRNAME
+from ego_pose import quat_to_rotmat
+from lidar_codec import compact_name
+
+AGG_COLUMNS = 6
+
+
+def aggregate_filename(keyframe_filename, nsweeps):
+    """samples/LIDAR_TOP/LIDAR_TOP_123.pcd.bin → samples/LIDAR_TOP/LIDAR_TOP_123.sweeps10.bin"""
+    d, base = os.path.split(keyframe_filename)
+    return os.path.join(d, f"{base.split('.', 1)[0]}.sweeps{nsweeps}.bin")
+
+
+def is_aggregate_name(name):
+    parts = name.split(".")
+    return len(parts) == 3 and parts[1].startswith("sweeps") and parts[2] == "bin"
+
+
+def pose_matrices(translations, rotations):
+    """translation (N,3) と [w,x,y,z] (N,4) → 4x4 の同次変換 (N,4,4)"""
+    t = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+    T = np.zeros((t.shape[0], 4, 4), dtype=np.float64)
+    T[:, :3, :3] = quat_to_rotmat(np.asarray(rotations, dtype=np.float64).reshape(-1, 4))
+    T[:, :3, 3] = t
+    T[:, 3, 3] = 1.0
+    return T
+
+
+def invert_rigid(T):
+    """剛体変換 (N,4,4) の逆行列（R^T, -R^T t）"""
+    inv = np.zeros_like(T)
+    Rt = np.swapaxes(T[:, :3, :3], 1, 2)
+    inv[:, :3, :3] = Rt
+    inv[:, :3, 3] = -np.einsum("nij,nj->ni", Rt, T[:, :3, 3])
+    inv[:, 3, 3] = 1.0
+    return inv
+
+
+class LidarSweepAggregator:
+    def __init__(self, dataroot=None, version=None, nsweeps=None, channel=None):
+        self.nusc = NuScenesLite(dataroot, version)
+        self.nsweeps = int(nsweeps or getattr(config, "LIDAR_AGGREGATE_SWEEPS", 10))
+        self.channel = channel or config.LIDAR_NAME
+        self.cache_path = os.path.join(self.nusc.table_root, CACHE_DIRNAME, f"lidar_sweeps{self.nsweeps}.json")
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, digests):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(digests, f)
+        os.replace(tmp, self.cache_path)
+
+    def plan(self):
+        """キーフレームごとの (キーフレーム行, 使うスイープの行リスト[古い順])"""
+        nusc = self.nusc
+        ts, rows = nusc.timeline(self.channel)
+        sd = nusc.table("sample_data")
+        out = []
+        for pos, r in enumerate(rows.tolist()):
+            if sd[r]["is_key_frame"]:
+                lo = max(0, pos - self.nsweeps + 1)
+                out.append((r, rows[lo:pos + 1].tolist()))
+        return out
+
+    def _digest(self, key_row, sweep_rows):
+        nusc = self.nusc
+        sd = nusc.table("sample_data")
+        h = hashlib.sha1()
+        for r in [key_row] + sweep_rows:
+            rec = sd[r]
+            path = os.path.join(nusc.dataroot, rec["filename"])
+            # copy で置いたキーフレームは出力し直すたびに mtime が変わるので、sweeps/ に元があればそちらを見る
+            # （compact なら samples/ の .pcd.bin の元は sweeps/ の .pcd.q16）
+            src = path.replace(os.sep + "samples" + os.sep, os.sep + "sweeps" + os.sep)
+            st = os.stat(next((p for p in (src, compact_name(src)) if p and os.path.exists(p)), path))
+            ego = nusc.get("ego_pose", rec["ego_pose_token"])
+            cal = nusc.get("calibrated_sensor", rec["calibrated_sensor_token"])
+            h.update(json.dumps([rec["filename"], rec["timestamp"], st.st_size, st.st_mtime_ns,
+                                 ego["translation"], ego["rotation"], cal["translation"], cal["rotation"]]).encode())
+        return h.hexdigest()
+
+    def transforms(self, key_row, sweep_rows):
+        """各スイープの点 → キーフレーム時刻のセンサ座標 への変換 (K,4,4)"""
+        nusc = self.nusc
+        sd = nusc.table("sample_data")
+        recs = [sd[r] for r in sweep_rows]
+        key = sd[key_row]
+        egos = [nusc.get("ego_pose", r["ego_pose_token"]) for r in recs]
+        cals = [nusc.get("calibrated_sensor", r["calibrated_sensor_token"]) for r in recs]
+        key_ego = nusc.get("ego_pose", key["ego_pose_token"])
+        key_cal = nusc.get("calibrated_sensor", key["calibrated_sensor_token"])
+        E = pose_matrices([e["translation"] for e in egos], [e["rotation"] for e in egos])
+        S = pose_matrices([c["translation"] for c in cals], [c["rotation"] for c in cals])
+        to_key = invert_rigid(pose_matrices([key_cal["translation"]], [key_cal["rotation"]])) @ \
+            invert_rigid(pose_matrices([key_ego["translation"]], [key_ego["rotation"]]))
+        return to_key @ E @ S
+
+    def aggregate(self, key_row, sweep_rows):
+        """(N, 6) float32 の点群を返す（古いスイープから順に連結）"""
+        nusc = self.nusc
+        sd = nusc.table("sample_data")
+        M = self.transforms(key_row, sweep_rows).astype(np.float32)
+        key_ts = sd[key_row]["timestamp"]
+        clouds = [nusc.load_lidar(sd[r]["token"]) for r in sweep_rows]
+        n = sum(c.shape[0] for c in clouds)
+        out = np.empty((n, AGG_COLUMNS), dtype=np.float32)
+        i = 0
+        for cloud, m, r in zip(clouds, M, sweep_rows):
+            k = cloud.shape[0]
+            dst = out[i:i + k]
+            np.matmul(cloud[:, :3], m[:3, :3].T, out=dst[:, :3])
+            dst[:, :3] += m[:3, 3]
+            dst[:, 3:5] = cloud[:, 3:5]
+            dst[:, 5] = (key_ts - sd[r]["timestamp"]) * 1e-6
+            i += k
+        return out
+
+    def _write_one(self, job):
+        key_row, sweep_rows, digest = job
+        sd = self.nusc.table("sample_data")
+        path = os.path.join(self.nusc.dataroot, aggregate_filename(sd[key_row]["filename"], self.nsweeps))
+        pts = self.aggregate(key_row, sweep_rows)
+        tmp = path + ".tmp"
+        pts.tofile(tmp)
+        os.replace(tmp, path)
+        return pts.nbytes
+
+    def run(self, workers=None, force=False):
+        """作り直しが要るキーフレームだけ書く。戻り値: {"written", "cached", "bytes"}"""
+        nusc = self.nusc
+        sd = nusc.table("sample_data")
+        cache = {} if force else self._load_cache()
+        digests = {}
+        jobs = []
+        for key_row, sweep_rows in self.plan():
+            name = aggregate_filename(sd[key_row]["filename"], self.nsweeps)
+            digest = self._digest(key_row, sweep_rows)
+            digests[name] = digest
+            if cache.get(name) == digest and os.path.exists(os.path.join(nusc.dataroot, name)):
+                continue
+            jobs.append((key_row, sweep_rows, digest))
+        workers = workers or getattr(config, "EXPORT_WORKERS", 1)
+        if workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                sizes = list(ex.map(self._write_one, jobs))
+        else:
+            sizes = [self._write_one(j) for j in jobs]
+        self._save_cache(digests)
+        return {"written": len(jobs), "cached": len(digests) - len(jobs), "bytes": int(sum(sizes))}
+
+
+def aggregate_lidar_sweeps(dataroot=None, version=None, nsweeps=None, workers=None, force=False):
+    agg = LidarSweepAggregator(dataroot, version, nsweeps)
+    stats = agg.run(workers=workers, force=force)
+    print(f"[LIDAR_SWEEPS] nsweeps={agg.nsweeps} written={stats['written']} cached={stats['cached']} "
+          f"({stats['bytes'] / 1e6:.1f} MB)")
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="キーフレームごとの LiDAR マルチスイープ点群を作る")
+    ap.add_argument("--dataroot", default=config.BASE_DIR)
+    ap.add_argument("--version", default=config.VERSION)
+    ap.add_argument("--nsweeps", type=int, default=None, help="キーフレームを含むスイープ数（既定は config.LIDAR_AGGREGATE_SWEEPS）")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--force", action="store_true", help="キャッシュを無視して全部作り直す")
+    args = ap.parse_args()
+    aggregate_lidar_sweeps(args.dataroot, args.version, args.nsweeps, args.workers, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
 import time
 import os
+import shutil
 from PIL import Image
 import config
-from utils import make_directory
+from utils import make_directory, capture_date
 from carla_setup import init_world, spawn_vehicle, spawn_npc_ahead   # ★ 追加
 from sensors import attach_cameras, attach_radars, attach_lidar
-from timeline import compute_sample_times, pick_keyframes_and_copy
-from nuscenes_writer import write_nuscenes_jsons
+from export import export_scene
+from merge_datasets import merge_datasets
+from manifest import CaptureManifest
+from segments import SegmentedCapture
+from capture import FrameSync, register_default_sensors, synchronous_mode, run_sync_capture
+from sensor_writer import SensorWriter
+from ego_pose import EgoPoseBuffer
+from annotations import ActorBoxBuffer
+import metrics
 import carla
 
 def ensure_dirs():
@@ -26,73 +34,138 @@ def ensure_dirs():
 def main():
     # CARLA
     client, world, bl = init_world()
+    if getattr(config, "SYNC_MODE", False):
+        # 同期モード: tick をこちらで回し、全センサが揃ってから次へ進む
+        with synchronous_mode(client, world, config.SYNC_FIXED_DELTA):
+            run_scene(world, bl)
+    else:
+        run_scene(world, bl)
+
+def run_scene(world, bl):
+    # 計測（METRICS_ENABLED のときだけ。センサを付ける前に始める）
+    run_metrics = metrics.start()
     prius = spawn_vehicle(world, bl)
     ego_spawn_tf = prius.get_transform() 
 
-    # ★ 前方NPCを必要ならスポーン
+    # ここから先で例外になっても、付けたセンサと出したアクターは finally で必ず消す
     npc_actor = None
     pedestrian = None
-    blueprint_library = world.get_blueprint_library()
-    pedestrian_bp = blueprint_library.find('walker.pedestrian.0003')
-    spawn_points_ped = carla.Transform(carla.Location(x=-6.45, y=157.19, z=1), carla.Rotation(yaw=0))
-    # pedestrian = world.spawn_actor(pedestrian_bp, spawn_points_ped)
-    pedestrian = world.try_spawn_actor(pedestrian_bp, spawn_points_ped)
-    if getattr(config, "NPC_ENABLED", False):
-        npc_actor = spawn_npc_ahead(
-            world, bl, prius,
-            distance_m=config.NPC_AHEAD_METERS,
-            autopilot=config.NPC_AUTOPILOT,
-            z_offset=getattr(config, "NPC_SPAWN_Z_OFFSET", 0.5),
-        )
-        loc = npc_actor.get_transform().location
-        # print(f"[EGO] spawned at x={loc.x:.2f}, y={loc.y:.2f}, z={loc.z:.2f}")
+    cam_actors, radar_actors, lidar_actor = [], [], None
+    writer = manifest = tick_cb = None
+    try:
+        # ★ 前方NPCを必要ならスポーン
+        blueprint_library = world.get_blueprint_library()
+        pedestrian_bp = blueprint_library.find('walker.pedestrian.0003')
+        spawn_points_ped = carla.Transform(carla.Location(x=-6.45, y=157.19, z=1), carla.Rotation(yaw=0))
+        # pedestrian = world.spawn_actor(pedestrian_bp, spawn_points_ped)
+        pedestrian = world.try_spawn_actor(pedestrian_bp, spawn_points_ped)
+        if getattr(config, "NPC_ENABLED", False):
+            npc_actor = spawn_npc_ahead(
+                world, bl, prius,
+                distance_m=config.NPC_AHEAD_METERS,
+                autopilot=config.NPC_AUTOPILOT,
+                z_offset=getattr(config, "NPC_SPAWN_Z_OFFSET", 0.5),
+            )
+            loc = npc_actor.get_transform().location
+            # print(f"[EGO] spawned at x={loc.x:.2f}, y={loc.y:.2f}, z={loc.z:.2f}")
 
-    samples_dir, sweeps_dir = ensure_dirs()
+        samples_dir, sweeps_dir = ensure_dirs()
 
-    # センサー
-    cam_actors, captured_images = attach_cameras(world, bl, prius, sweeps_dir)
-    radar_actors, captured_radar = attach_radars(world, bl, prius, sweeps_dir)
-    lidar_actor, captured_lidar = attach_lidar(world, bl, prius, sweeps_dir)
+        # センサー
+        sync = getattr(config, "SYNC_MODE", False)
+        frame_sync = register_default_sensors(FrameSync()) if sync else None
+        on_frame = frame_sync.notify if sync else None
+        writer = SensorWriter() if getattr(config, "WRITER_WORKERS", 0) > 0 else None
+        # 書き終えたフレームをマニフェストにも追記（途中で落ちても export.py で出力できるように）
+        manifest = CaptureManifest() if getattr(config, "MANIFEST_ENABLED", False) else None
+        # log.json の日付（マニフェストのヘッダと同じ時刻から作るので、出力し直しても変わらない）
+        date_captured = capture_date(manifest.started if manifest is not None else time.time())
+        sensor_kw = dict(on_frame=on_frame, writer=writer, manifest=manifest)
+        cam_actors, captured_images = attach_cameras(world, bl, prius, sweeps_dir, **sensor_kw)
+        radar_actors, captured_radar = attach_radars(world, bl, prius, sweeps_dir, **sensor_kw)
+        lidar_actor, captured_lidar = attach_lidar(world, bl, prius, sweeps_dir, **sensor_kw)
 
-    # 走行＆撮影
-    prius.set_autopilot(True)
-    time.sleep(config.DURATION_SEC)
+        # 自車姿勢と周囲の車両・歩行者の箱（tick ごと）
+        ego_poses = EgoPoseBuffer()
+        actor_boxes = ActorBoxBuffer(world, exclude_ids={prius.id}) if getattr(config, "ANNOTATION_ENABLED", True) else None
 
-    # サンプル時刻
-    sample_times = compute_sample_times(captured_images, captured_lidar)
+        # 区切り撮影: SEGMENT_SEC ごとに切って撮影中に出力する
+        segmenter = None
+        if getattr(config, "SEGMENT_SEC", None):
+            def export_segment(seg):
+                export_scene(seg.captured_images, seg.captured_radar, seg.captured_lidar, seg.ego_poses,
+                             seg.actor_boxes, samples_dir, sweeps_dir,
+                             scene_name=seg.scene_name, version=seg.version, duration_sec=seg.duration_sec,
+                             date_captured=date_captured)
+            segmenter = SegmentedCapture(captured_images, captured_radar, captured_lidar, ego_poses, actor_boxes,
+                                         export_segment)
 
-    # keyframesコピー
-    key_img_for_idx   = pick_keyframes_and_copy(captured_images, sample_times, sweeps_dir, samples_dir)
-    key_radar_for_idx = pick_keyframes_and_copy(captured_radar, sample_times, sweeps_dir, samples_dir)
-    key_lidar_for_idx = {}
-    if captured_lidar:
-        # LIDAR_TOPについては各idxごとに最も近いものを samples/ にコピー
-        from timeline import pick_keyframes_and_copy as _pick
-        # 便宜的にdict化して再利用
-        _tmp = {"LIDAR_TOP": captured_lidar}
-        copied = _pick(_tmp, sample_times, sweeps_dir, samples_dir)
-        key_lidar_for_idx = {idx: src for idx, src in copied["LIDAR_TOP"].items()}
+        def record_tick(snap):
+            if ego_poses.record(snap, prius) and manifest is not None:
+                manifest.add_ego(*ego_poses.row(-1))
+            if actor_boxes is not None:
+                actor_boxes.record(snap)
+            if segmenter is not None:
+                segmenter.on_tick(snap)
 
-    # JSON出力
-    write_nuscenes_jsons(
-        base_dir=config.BASE_DIR,
-        sample_times=sample_times,
-        key_img_for_idx=key_img_for_idx,
-        key_radar_for_idx=key_radar_for_idx,
-        key_lidar_for_idx=key_lidar_for_idx,
-        captured_images=captured_images,
-        captured_radar=captured_radar,
-        captured_lidar=captured_lidar
-    )
+        # 走行＆撮影
+        prius.set_autopilot(True, getattr(config, "TM_PORT", 8000))
+        if sync:
+            t0 = time.time()
+            n_ticks = run_sync_capture(world, frame_sync, config.DURATION_SEC, config.SYNC_FIXED_DELTA,
+                                       on_tick=record_tick)
+            print(f"[SYNC] {n_ticks} ticks ({config.DURATION_SEC}s sim) in {time.time() - t0:.1f}s wall")
+            for a in cam_actors + radar_actors + [lidar_actor]:
+                a.stop()
+        else:
+            tick_cb = world.on_tick(record_tick)
+            time.sleep(config.DURATION_SEC)
+            world.remove_on_tick(tick_cb)
+            tick_cb = None
+            for a in cam_actors + radar_actors + [lidar_actor]:
+                a.stop()
+        if writer is not None:
+            # 書き出し待ちを全部ディスクへ
+            writer.close()
+            print("[WRITER]\n" + writer.format_stats())
+        if manifest is not None:
+            manifest.close()
+            print(f"[MANIFEST] {manifest.records} records, {manifest.flushes} fsyncs → {manifest.path}")
 
-    print("✅ NuScenes形式の出力が完了しました。")
+        if segmenter is not None:
+            # 残りを最後の区間として出し、区間ごとの出力を1つのバージョンにまとめる
+            versions = segmenter.finish()
+            merge_datasets([f"{config.BASE_DIR}:{v}" for v in versions], config.BASE_DIR, config.VERSION,
+                           files_mode="none")
+            if not getattr(config, "SEGMENT_KEEP_PARTS", False):
+                for v in versions:
+                    shutil.rmtree(os.path.join(config.BASE_DIR, v), ignore_errors=True)
+        else:
+            export_scene(captured_images, captured_radar, captured_lidar, ego_poses, actor_boxes,
+                         samples_dir, sweeps_dir, date_captured=date_captured)
 
-    # 後片付け
-    for a in cam_actors: a.destroy()
-    for a in radar_actors: a.destroy()
-    if lidar_actor: lidar_actor.destroy()
-    if npc_actor: npc_actor.destroy()     # ★ 追加
-    prius.destroy()
+        print("✅ NuScenes形式の出力が完了しました。")
+        if run_metrics is not None:
+            out_dir = getattr(config, "METRICS_DIR", None) or config.BASE_DIR
+            json_path, prom_path = run_metrics.write_reports(out_dir)
+            print("[METRICS]\n" + run_metrics.format_summary())
+            print(f"[METRICS] {json_path} / {prom_path}")
+    finally:
+        # 後片付け（途中で落ちてもサーバにアクターを残さない）
+        if tick_cb is not None:
+            world.remove_on_tick(tick_cb)
+        sensors = [a for a in cam_actors + radar_actors + [lidar_actor] if a is not None]
+        for a in sensors:
+            if a.is_listening:
+                a.stop()
+        if writer is not None:
+            writer.close()
+        if manifest is not None:
+            manifest.close()
+        for a in sensors: a.destroy()
+        if npc_actor: npc_actor.destroy()     # ★ 追加
+        if pedestrian: pedestrian.destroy()
+        prius.destroy()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,189 @@
+"""
+撮影マニフェスト（config.MANIFEST_ENABLED）。書き終えたセンサフレームと tick ごとの自車姿勢を
+<BASE_DIR>/<MANIFEST_NAME> に1行1レコードの JSON で追記していく。
+
+  {"manifest": 1, "scene": ..., "started": ..., "config": {"IMG_W": ...}}            ← 先頭行（ヘッダ）
+  {"ch": "CAM_FRONT", "frame": 123, "ts": 4100000, "path": "sweeps/CAM_FRONT/...", "bytes": 81234}
+  {"ch": "EGO", "ts": 4100000, "xyz": [...], "rpy": [...], "vel": [...]}             ← CARLA 座標のまま
+
+- 追記はメモリに溜めて MANIFEST_FLUSH_RECORDS 件 / MANIFEST_FLUSH_SEC 秒ごとにまとめて write + fsync する
+- クライアントが落ちても、最後に fsync した所までは load_manifest() で captured_* と自車姿勢に戻せる
+  （書きかけの最終行・ファイルが無いかサイズが合わないフレームは捨てる）
+- アクターの箱は記録しないので、マニフェストからの出力には sample_annotation が付かない
+"""
+import os
+import json
+import time
+import threading
+import numpy as np
+import config
+from ego_pose import EgoPoseBuffer
+
+MANIFEST_VERSION = 1
+EGO_CHANNEL = "EGO"
+# 撮影時の値がテーブルの中身に効く config（ヘッダに残し、出力し直すときに戻す）
+CAPTURE_CONFIG_KEYS = ("IMG_W", "IMG_H", "CAM_ENCODER", "SYNC_MODE", "SYNC_FIXED_DELTA",
+                       "CAM_SENSOR_TICK", "LIDAR_SENSOR_TICK")
+
+
+def manifest_path(base_dir=None):
+    return os.path.join(base_dir or config.BASE_DIR, getattr(config, "MANIFEST_NAME", "capture_manifest.jsonl"))
+
+
+class CaptureManifest:
+    def __init__(self, path=None, base_dir=None, flush_records=None, flush_sec=None):
+        self.base_dir = base_dir or config.BASE_DIR
+        self.path = path or manifest_path(self.base_dir)
+        self.flush_records = flush_records or getattr(config, "MANIFEST_FLUSH_RECORDS", 256)
+        self.flush_sec = flush_sec if flush_sec is not None else getattr(config, "MANIFEST_FLUSH_SEC", 1.0)
+        self._lock = threading.Lock()       # _pending の出し入れ
+        self._io_lock = threading.Lock()    # write + fsync（ここで待つ間もコールバック側は積める）
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self.records = 0
+        self.flushes = 0
+        self.started = time.time()
+        # 1 run に1ファイル（同じ BASE_DIR で撮り直したら作り直す）
+        self._f = open(self.path, "wb")
+        header = {"manifest": MANIFEST_VERSION, "scene": getattr(config, "SCENE_NAME", "scene_1"),
+                  "version": config.VERSION, "started": self.started,
+                  "config": {k: getattr(config, k) for k in CAPTURE_CONFIG_KEYS if hasattr(config, k)}}
+        self._f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+        self._sync()
+
+    def add(self, channel, rec):
+        """書き終えたセンサフレーム（sensors の rec）を積む。"""
+        path = rec["path"]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self._append({"ch": channel, "frame": rec["frame"], "ts": rec["timestamp"],
+                      "path": os.path.relpath(path, self.base_dir), "bytes": size})
+
+    def add_ego(self, ts_us, xyz, rpy, vel):
+        self._append({"ch": EGO_CHANNEL, "ts": ts_us, "xyz": xyz, "rpy": rpy, "vel": vel})
+
+    def _append(self, row):
+        line = json.dumps(row, separators=(",", ":")).encode() + b"\n"
+        with self._lock:
+            self._pending.append(line)
+            if (len(self._pending) < self.flush_records
+                    and time.monotonic() - self._last_flush < self.flush_sec):
+                return
+            lines, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        self._write(lines)
+
+    def _write(self, lines):
+        with self._io_lock:
+            self._f.write(b"".join(lines))
+            self._sync()
+            self.records += len(lines)
+            self.flushes += 1
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def flush(self):
+        with self._lock:
+            lines, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        if lines:
+            self._write(lines)
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.flush()
+        self._f.close()
+
+
+class ManifestContents:
+    """load_manifest の戻り値。captured_* は sensors の attach_* と同じ形。"""
+
+    def __init__(self, header, captured_images, captured_radar, captured_lidar, ego_poses, stats):
+        self.header = header
+        self.captured_images = captured_images
+        self.captured_radar = captured_radar
+        self.captured_lidar = captured_lidar
+        self.ego_poses = ego_poses
+        self.stats = stats
+
+    @property
+    def duration_sec(self):
+        stamps = [recs[0]["timestamp"] for recs in self.captured_images.values() if recs]
+        ends = [recs[-1]["timestamp"] for recs in self.captured_images.values() if recs]
+        return (max(ends) - min(stamps)) / 1e6 if stamps else 0.0
+
+
+def load_manifest(path=None, base_dir=None, check_files=True):
+    """
+    マニフェストから captured_images / captured_radar / captured_lidar / 自車姿勢を組み立て直す。
+    base_dir: path 列の基準（省略時はマニフェストのあるディレクトリ）
+    check_files: True ならファイルが無い・サイズが記録と違うフレームを捨てる（書き出し途中で落ちた分）
+    """
+    path = path or manifest_path(base_dir)
+    base_dir = base_dir or os.path.dirname(os.path.abspath(path))
+    captured_images = {name: [] for name in config.CAM_NAMES}
+    captured_radar = {name: [] for name in config.RADAR_NAMES}
+    captured_lidar = []
+    ego_ts, ego_xyz, ego_rpy, ego_vel = [], [], [], []
+    stats = {"records": 0, "frames": 0, "ego": 0, "missing": 0, "unknown_channel": 0, "truncated": False}
+    header = {}
+
+    with open(path, "rb") as f:
+        for n, line in enumerate(f):
+            if not line.endswith(b"\n"):
+                # fsync 前に落ちた書きかけの行
+                stats["truncated"] = True
+                break
+            try:
+                row = json.loads(line)
+            except ValueError:
+                stats["truncated"] = True
+                break
+            if n == 0 and "manifest" in row:
+                header = row
+                continue
+            stats["records"] += 1
+            ch = row["ch"]
+            if ch == EGO_CHANNEL:
+                ego_ts.append(row["ts"])
+                ego_xyz.append(row["xyz"])
+                ego_rpy.append(row["rpy"])
+                ego_vel.append(row["vel"])
+                continue
+            if ch in captured_images:
+                items = captured_images[ch]
+            elif ch in captured_radar:
+                items = captured_radar[ch]
+            elif ch == config.LIDAR_NAME:
+                items = captured_lidar
+            else:
+                stats["unknown_channel"] += 1
+                continue
+            full = os.path.join(base_dir, row["path"])
+            if check_files:
+                try:
+                    ok = os.path.getsize(full) == row["bytes"]
+                except OSError:
+                    ok = False
+                if not ok:
+                    stats["missing"] += 1
+                    continue
+            items.append({"frame": row["frame"], "path": full, "timestamp": row["ts"], "bytes": row["bytes"]})
+            stats["frames"] += 1
+
+    # ワーカーの書き終わり順で積まれているので時刻順に直す
+    for items in list(captured_images.values()) + list(captured_radar.values()) + [captured_lidar]:
+        items.sort(key=lambda r: r["timestamp"])
+    ego_poses = None
+    if ego_ts:
+        order = np.argsort(np.asarray(ego_ts, dtype=np.int64), kind="stable")
+        ego_poses = EgoPoseBuffer(capacity=len(ego_ts))
+        ego_poses.extend(np.asarray(ego_ts, dtype=np.int64)[order], np.asarray(ego_xyz)[order],
+                         np.asarray(ego_rpy)[order], np.asarray(ego_vel)[order])
+        stats["ego"] = len(ego_ts)
+    return ManifestContents(header, captured_images, captured_radar, captured_lidar, ego_poses, stats)
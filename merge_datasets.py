@@ -0,0 +1,225 @@
+"""
+複数 run の出力（それぞれ1シーンの v1.0-*）を1つの nuScenes バージョンにまとめる。
+
+  python merge_datasets.py ./data/batch/scene_0001 ./data/batch/scene_0002 ... --out ./data/merged --version v1.0-trainval
+
+入力は dataroot か dataroot:version（version 省略時は config.VERSION）。
+- sensor / calibrated_sensor / category / attribute / visibility は中身で重複を除き、token を最初の run のものに寄せる
+- run ごとのテーブル（log, scene, sample, sample_data, ego_pose, instance, sample_annotation, map）は
+  run ごとにワーカープロセスで変換して一時ファイルに書き、最後に入力順に連結する
+  （全 run の sample_data.json を同時にメモリに載せない）
+- scene 名が重複する run は token を uuid5(run ラベル, 元token) に付け替え、scene 名にもラベルを付ける
+- 出力 dataroot が入力と別なら、ファイルを <sub>/<channel>/<ラベル>__<元の名前> に置き（--files）filename を書き換える
+同じ入力で何度実行しても同じ出力になる。
+"""
+import os
+import json
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+from utils import make_directory, save_json, JsonTableWriter, make_token
+from timeline import materialize, MATERIALIZE_MODES
+
+SHARED_TABLES = ["sensor", "calibrated_sensor", "category", "attribute", "visibility"]
+RUN_TABLES = ["log", "scene", "sample", "sample_data", "ego_pose", "instance", "sample_annotation", "map"]
+
+# 共有テーブルを指すフィールド → テーブル名
+SHARED_FIELDS = {
+    "sensor_token": "sensor",
+    "calibrated_sensor_token": "calibrated_sensor",
+    "category_token": "category",
+    "attribute_tokens": "attribute",
+    "visibility_token": "visibility",
+}
+
+
+def parse_input(spec):
+    root, sep, version = spec.rpartition(":")
+    if not sep or os.sep in version or not version.startswith("v"):
+        return spec, config.VERSION
+    return root, version
+
+
+def _load_table(dataroot, version, table):
+    path = os.path.join(dataroot, version, table + ".json")
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        return json.load(f)
+
+
+def _labels(inputs):
+    """run ごとのラベル（dataroot の名前。かぶれば version、それでもかぶれば番号を付ける）"""
+    labels = [os.path.basename(os.path.normpath(root)) for root, _ in inputs]
+    if len(set(labels)) != len(labels):
+        labels = [f"{l}_{v}" for l, (_, v) in zip(labels, inputs)]
+    if len(set(labels)) != len(labels):
+        labels = [f"{i:04d}_{l}" for i, l in enumerate(labels)]
+    return labels
+
+
+def _shared_key(table, row, sensor_key):
+    """重複判定に使う中身（token 以外）"""
+    if table == "sensor":
+        return ("sensor", row["channel"], row["modality"])
+    if table == "calibrated_sensor":
+        return ("calibrated_sensor", sensor_key[row["sensor_token"]],
+                json.dumps([row["translation"], row["rotation"], row["camera_intrinsic"]]))
+    return (table, row.get("name", row.get("level")))
+
+
+def merge_shared_tables(inputs):
+    """
+    全 run の共有テーブルを中身で統合する（小さいので親プロセスで読む）。
+    戻り値: (tables, maps)  maps[i][table][元token] = 統合後 token
+    """
+    merged = {t: [] for t in SHARED_TABLES}
+    canon = {}  # 中身 → token
+    maps = []
+    for root, version in inputs:
+        m = {t: {} for t in SHARED_TABLES}
+        sensor_key = {}
+        for table in SHARED_TABLES:
+            for row in _load_table(root, version, table):
+                if table == "sensor":
+                    sensor_key[row["token"]] = (row["channel"], row["modality"])
+                key = _shared_key(table, row, sensor_key)
+                if key not in canon:
+                    canon[key] = row["token"]
+                    row = dict(row)
+                    if table == "calibrated_sensor":
+                        row["sensor_token"] = m["sensor"][row["sensor_token"]]
+                    merged[table].append(row)
+                m[table][row["token"]] = canon[key]
+        maps.append(m)
+    return merged, maps
+
+
+def _remap_row(row, run_tok, shared):
+    out = {}
+    for k, v in row.items():
+        if k in SHARED_FIELDS:
+            m = shared[SHARED_FIELDS[k]]
+            out[k] = [m.get(t, t) for t in v] if isinstance(v, list) else (m.get(v, v) if v else v)
+        elif k in ("token", "prev", "next") or k.endswith("_token") or k.endswith("_tokens"):
+            out[k] = [run_tok(t) for t in v] if isinstance(v, list) else run_tok(v)
+        else:
+            out[k] = v
+    return out
+
+
+def _new_filename(filename, label):
+    d, base = os.path.split(filename)
+    return os.path.join(d, f"{label}__{base}")
+
+
+def _convert_run(job):
+    """1 run 分の run テーブルを変換して part ファイル（1行1レコード）に書く。ワーカープロセスで動く。"""
+    i, root, version, label, rename, shared, out_root, files_mode, part_dir = job
+    if rename:
+        def run_tok(t):
+            return make_token("merge", label, t) if t else t
+    else:
+        def run_tok(t):
+            return t
+    same_root = os.path.abspath(root) == os.path.abspath(out_root)
+    counts = {}
+    n_files = 0
+    for table in RUN_TABLES:
+        rows = _load_table(root, version, table)
+        with open(os.path.join(part_dir, f"{i:05d}_{table}.jsonl"), "w") as f:
+            for row in rows:
+                row = _remap_row(row, run_tok, shared)
+                if table == "scene" and rename:
+                    row["name"] = f"{label}_{row['name']}"
+                if "filename" in row and row["filename"] and not same_root:
+                    src = os.path.join(root, row["filename"])
+                    row["filename"] = _new_filename(row["filename"], label)
+                    if files_mode != "none" and os.path.exists(src):
+                        # 入力を壊さないよう move は使わない
+                        materialize(src, os.path.join(out_root, row["filename"]), files_mode)
+                        n_files += 1
+                f.write(json.dumps(row, separators=(",", ":")))
+                f.write("\n")
+        counts[table] = len(rows)
+        del rows
+    return i, counts, n_files
+
+
+def merge_datasets(input_specs, out_root, version=None, workers=None, files_mode="hardlink", validate=True):
+    version = version or config.VERSION
+    if files_mode == "move":
+        raise ValueError("merge では move は使えません（入力を壊さないため）")
+    inputs = [parse_input(s) for s in input_specs]
+    labels = _labels(inputs)
+    out_dir = os.path.join(out_root, version)
+    make_directory(out_dir)
+
+    # scene 名が重複する run だけ token を付け替える
+    scene_names = [[s["name"] for s in _load_table(r, v, "scene")] for r, v in inputs]
+    seen = {}
+    for names in scene_names:
+        for n in names:
+            seen[n] = seen.get(n, 0) + 1
+    rename = [any(seen[n] > 1 for n in names) for names in scene_names]
+
+    shared_tables, shared_maps = merge_shared_tables(inputs)
+    for table, rows in shared_tables.items():
+        save_json(os.path.join(out_dir, table + ".json"), rows)
+
+    with tempfile.TemporaryDirectory(dir=out_root) as part_dir:
+        jobs = [(i, root, v, labels[i], rename[i], shared_maps[i], out_root, files_mode, part_dir)
+                for i, (root, v) in enumerate(inputs)]
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                done = list(ex.map(_convert_run, jobs))
+        else:
+            done = [_convert_run(j) for j in jobs]
+        for i, counts, n_files in done:
+            print(f"  [{labels[i]}] " + " ".join(f"{t}={n}" for t, n in counts.items() if n)
+                  + (f" files={n_files}" if n_files else "") + (" (renamed)" if rename[i] else ""))
+
+        # 入力順に連結（1行ずつ流すだけ）
+        for table in RUN_TABLES:
+            tokens = set() if validate else None
+            with JsonTableWriter(os.path.join(out_dir, table + ".json")) as w:
+                for i in range(len(inputs)):
+                    with open(os.path.join(part_dir, f"{i:05d}_{table}.jsonl"), "rb") as f:
+                        for line in f:
+                            rec = None
+                            if tokens is not None or not w.compact:
+                                rec = json.loads(line)
+                            if tokens is not None:
+                                if rec["token"] in tokens:
+                                    raise ValueError(f"{table}: token {rec['token']} が重複しています ({labels[i]})")
+                                tokens.add(rec["token"])
+                            if w.compact:
+                                w.write_raw(line.rstrip(b"\n"), rec["token"] if rec is not None else None)
+                            else:
+                                w.write(rec)
+
+    # maps/ 以外のディレクトリも作っておく（devkit が dataroot 構成を前提にするため）
+    for sub in ("samples", "sweeps", "maps"):
+        make_directory(os.path.join(out_root, sub))
+    print(f"✅ merged {len(inputs)} runs → {out_dir}")
+    return out_dir
+
+
+def main():
+    ap = argparse.ArgumentParser(description="複数 run の nuScenes 出力を1つのバージョンに統合")
+    ap.add_argument("inputs", nargs="+", help="dataroot または dataroot:version")
+    ap.add_argument("--out", required=True, help="出力 dataroot")
+    ap.add_argument("--version", default=None, help=f"出力 version（既定: {config.VERSION}）")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--files", default="hardlink", choices=[m for m in MATERIALIZE_MODES if m != "move"] + ["none"],
+                    help="出力 dataroot へのファイルの置き方（none で filename の書き換えだけ）")
+    ap.add_argument("--no-validate", action="store_true", help="token 重複チェックを省く")
+    args = ap.parse_args()
+    merge_datasets(args.inputs, args.out, args.version, args.workers, args.files, not args.no_validate)
+
+
+if __name__ == "__main__":
+    main()
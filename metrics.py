@@ -0,0 +1,203 @@
+"""
+取得中のホットパス計測（config.METRICS_ENABLED）。
+
+- センサごとのヒストグラム: コールバック時間 / 書き出し時間 / 書いたバイト数 / フレーム間隔（センサの timestamp から）
+- 段階ごとのタイマー: plan_sample_times / pick_keyframes_and_copy / write_nuscenes_jsons の各テーブル / aggregate_lidar_sweeps
+- 撮影の終わりに metrics.json と Prometheus テキスト形式の metrics.prom を書く
+
+無効なときは wrap_callback / wrap_write が渡された関数をそのまま返し、timer は何もしない
+コンテキストを返すだけなので、コールバックの中には計測コードが入らない。
+"""
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+from collections import defaultdict
+import config
+
+PROM_PREFIX = "carla_nuscenes"
+
+# ヒストグラムの上限（le）。秒とバイトで別のバケット
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BYTES_BUCKETS = tuple(2 ** k for k in range(10, 27, 2))  # 1 KiB .. 64 MiB
+
+# name -> (バケット, 説明)
+HISTOGRAMS = {
+    "callback_seconds": (SECONDS_BUCKETS, "Time spent inside the sensor callback"),
+    "write_seconds": (SECONDS_BUCKETS, "Time to encode and write one sensor frame"),
+    "write_bytes": (BYTES_BUCKETS, "Bytes written per sensor frame"),
+    "frame_interval_seconds": (SECONDS_BUCKETS, "Simulation time between consecutive frames of a sensor"),
+    "stage_seconds": (SECONDS_BUCKETS, "Wall time of an export stage"),
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "min", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def to_dict(self):
+        return {
+            "count": self.count, "sum": self.sum,
+            "min": self.min if self.count else None, "max": self.max if self.count else None,
+            "mean": self.sum / self.count if self.count else None,
+            "buckets": {str(b): c for b, c in zip(list(self.bounds) + ["+Inf"], self.counts)},
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist = {}                       # (name, labels) -> Histogram
+        self._last_ts = {}                    # channel -> 直前フレームの timestamp [s]
+        self.started = time.time()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = Histogram(HISTOGRAMS[name][0])
+            h.observe(value)
+
+    def frame(self, channel, timestamp):
+        """フレーム間隔（シミュレーション時刻）を記録する。"""
+        with self._lock:
+            last = self._last_ts.get(channel)
+            self._last_ts[channel] = timestamp
+        if last is not None and timestamp > last:
+            self.observe("frame_interval_seconds", timestamp - last, channel=channel)
+
+    @contextlib.contextmanager
+    def timer(self, name="stage_seconds", **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    # ---- 出力 ----
+    def to_dict(self):
+        by_name = defaultdict(list)
+        with self._lock:
+            for (name, labels), h in sorted(self._hist.items()):
+                by_name[name].append({"labels": dict(labels), **h.to_dict()})
+        return {"started": self.started, "finished": time.time(), "histograms": dict(by_name)}
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            items = sorted(self._hist.items())
+        done = set()
+        for (name, labels), h in items:
+            metric = f"{PROM_PREFIX}_{name}"
+            if name not in done:
+                lines.append(f"# HELP {metric} {HISTOGRAMS[name][1]}")
+                lines.append(f"# TYPE {metric} histogram")
+                done.add(name)
+            base = ",".join(f'{k}="{v}"' for k, v in labels)
+            sep = "," if base else ""
+            acc = 0
+            for b, c in zip(list(h.bounds) + ["+Inf"], h.counts):
+                acc += c
+                lines.append(f'{metric}_bucket{{{base}{sep}le="{b}"}} {acc}')
+            lines.append(f"{metric}_sum{{{base}}} {h.sum!r}")
+            lines.append(f"{metric}_count{{{base}}} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_reports(self, out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+        json_path = os.path.join(out_dir, "metrics.json")
+        with open(json_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        prom_path = os.path.join(out_dir, "metrics.prom")
+        with open(prom_path, "w") as f:
+            f.write(self.to_prometheus())
+        return json_path, prom_path
+
+    def format_summary(self):
+        lines = []
+        for name, rows in self.to_dict()["histograms"].items():
+            if name == "write_bytes":
+                continue
+            for r in rows:
+                label = ",".join(str(v) for v in r["labels"].values())
+                lines.append(f"  {name:<24} {label:<28} n={r['count']:>6} "
+                             f"mean={r['mean'] * 1e3:>8.2f}ms max={r['max'] * 1e3:>8.2f}ms")
+        return "\n".join(lines)
+
+
+_current = None
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def start():
+    """撮影1回ぶんの計測を始める（無効なら None）。"""
+    global _current
+    _current = Metrics() if getattr(config, "METRICS_ENABLED", False) else None
+    return _current
+
+
+def get():
+    return _current
+
+
+def timer(stage, **labels):
+    """段階の wall 時間を計る（無効なら何もしない）。"""
+    m = _current
+    if m is None:
+        return _NULL_TIMER
+    return m.timer("stage_seconds", stage=stage, **labels)
+
+
+def wrap_callback(channel, callback):
+    """センサコールバックに時間とフレーム間隔の計測を付ける（無効なら callback そのもの）。"""
+    m = _current
+    if m is None:
+        return callback
+    perf_counter = time.perf_counter
+
+    def instrumented(data):
+        t0 = perf_counter()
+        try:
+            return callback(data)
+        finally:
+            m.observe("callback_seconds", perf_counter() - t0, channel=channel)
+            m.frame(channel, data.timestamp)
+    return instrumented
+
+
+def wrap_write(channel, write):
+    """write(data, rec) に書き出し時間とバイト数の計測を付ける（無効なら write そのもの）。"""
+    m = _current
+    if m is None:
+        return write
+    perf_counter = time.perf_counter
+
+    def instrumented(data, rec):
+        t0 = perf_counter()
+        write(data, rec)
+        m.observe("write_seconds", perf_counter() - t0, channel=channel)
+        try:
+            m.observe("write_bytes", os.path.getsize(rec["path"]), channel=channel)
+        except OSError:
+            pass
+    return instrumented
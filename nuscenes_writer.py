@@ -1,9 +1,13 @@
 import os
-import uuid
 import math
-from datetime import datetime
+import numpy as np
 import config
-from utils import save_json, link_prev_next
+from utils import (save_json, JsonTableWriter, link_prev_next_stream, camera_fileformat, make_token,
+                   format_table_status, capture_date)
+from timeline import nearest_indices, sample_path_for
+from annotations import build_annotation_tables
+from lidar_codec import COMPACT_EXT, COMPACT_FILEFORMAT
+import metrics
 
 
 def _yaw_deg_to_quat_wxyz(yaw_deg: float):
@@ -44,21 +48,37 @@ def write_nuscenes_jsons(base_dir,
                          key_lidar_for_idx,
                          captured_images,
                          captured_radar,
-                         captured_lidar):
-    version = config.VERSION
+                         captured_lidar,
+                         ego_poses=None,
+                         actor_boxes=None,
+                         scene_name=None,
+                         version=None,
+                         duration_sec=None,
+                         date_captured=None):
+    """
+    ego_poses: ego_pose.EgoPoseBuffer。与えると sample_data の timestamp ごとに補間した ego_pose を書く
+               （None なら従来どおり固定の1件）
+    actor_boxes: annotations.ActorBoxBuffer。ego_poses と両方あれば instance / sample_annotation を書く
+    scene_name / version / duration_sec: 省略時は config.SCENE_NAME / VERSION / DURATION_SEC
+                                         （区切り撮影ではセグメントごとに渡す）
+    date_captured: log.json の日付（"YYYY-MM-DD"）。出力し直しても変わらないよう撮影開始時刻から
+                   utils.capture_date で作って渡す（省略時は今日）
+    """
+    version = version or config.VERSION
     out_dir = os.path.join(base_dir, version)
     os.makedirs(out_dir, exist_ok=True)
 
-    # tokens
-    log_token = str(uuid.uuid4())
-    scene_token = str(uuid.uuid4())
-    ego_pose_token = str(uuid.uuid4())
+    # tokens（決定的: 同じキャプチャを出し直せば同じ token になる）
+    scene_name = scene_name or getattr(config, "SCENE_NAME", "scene_1")
+    log_token = make_token(scene_name, "log")
+    scene_token = make_token(scene_name, "scene")
+    ego_pose_token = make_token(scene_name, "ego_pose")
 
     # sample.json
     sample_json = []
     prev = ""
     for st in sample_times:
-        tok = str(uuid.uuid4())
+        tok = make_token(scene_name, "sample", int(st))
         sample_json.append({
             "token": tok,
             "scene_token": scene_token,
@@ -73,7 +93,7 @@ def write_nuscenes_jsons(base_dir,
     # scene.json
     scene_json = [{
         "token": scene_token,
-        "name": "scene_1",
+        "name": scene_name,
         "description": "Evaluation scene",
         "log_token": log_token,
         "nbr_samples": len(sample_json),
@@ -81,7 +101,7 @@ def write_nuscenes_jsons(base_dir,
         "last_sample_token": sample_json[-1]["token"]
     }]
 
-    # ego_pose.json（固定）
+    # ego_pose.json（記録が無いときの固定値）
     ego_pose_json = [{
         "token": ego_pose_token,
         "timestamp": sample_times[0],
@@ -95,8 +115,7 @@ def write_nuscenes_jsons(base_dir,
 
     # ---- カメラ: config.CAM_CONFIGS をそのまま出力 ----
     for cam_name in config.CAM_NAMES:
-        s_token, c_token = str(uuid.uuid4()), str(uuid.uuid4())
-        per_cam_tokens[cam_name] = (s_token, c_token)
+        s_token = make_token("sensor", cam_name)
         sensor_json.append({
             "token": s_token, "modality": "camera",
             "name": cam_name, "channel": cam_name
@@ -112,6 +131,9 @@ def write_nuscenes_jsons(base_dir,
         #   同じ hfov を使って K を再計算して書き出す。
         hfov = hfov_from_intrinsics(cal["intrinsic"], config.IMG_W)
         K_out = _k_from_carla_fov(config.IMG_W, config.IMG_H, hfov)
+        # calibrated_sensor は中身から token を作る（同じ取り付けなら run が違っても同じ token）
+        c_token = make_token("calibrated_sensor", cam_name, t, q, K_out)
+        per_cam_tokens[cam_name] = (s_token, c_token)
 
         calib_json.append({
         "token": c_token, "sensor_token": s_token,
@@ -121,8 +143,7 @@ def write_nuscenes_jsons(base_dir,
     # ---- レーダ（従来どおり；必要なら RADAR_CALIB に移行可能）----
     per_radar_tokens = {}
     for rname in config.RADAR_NAMES:
-        s_token, c_token = str(uuid.uuid4()), str(uuid.uuid4())
-        per_radar_tokens[rname] = (s_token, c_token)
+        s_token = make_token("sensor", rname)
         sensor_json.append({
             "token": s_token, "modality": "radar",
             "name": rname, "channel": rname
@@ -131,6 +152,8 @@ def write_nuscenes_jsons(base_dir,
         # nuScenes 値をそのまま
         t = [float(v) for v in config.RADAR_CONFIGS[rname]["translation"]]
         q = [float(v) for v in config.RADAR_CONFIGS[rname]["rotation_wxyz"]]
+        c_token = make_token("calibrated_sensor", rname, t, q)
+        per_radar_tokens[rname] = (s_token, c_token)
 
         calib_json.append({
             "token": c_token, "sensor_token": s_token,
@@ -139,7 +162,7 @@ def write_nuscenes_jsons(base_dir,
             "camera_intrinsic": []
         })
 
-    lidar_s_token, lidar_c_token = str(uuid.uuid4()), str(uuid.uuid4())
+    lidar_s_token = make_token("sensor", config.LIDAR_NAME)
     sensor_json.append({
         "token": lidar_s_token, "modality": "lidar",
         "name": config.LIDAR_NAME, "channel": config.LIDAR_NAME
@@ -147,6 +170,7 @@ def write_nuscenes_jsons(base_dir,
 
     t_lidar = [float(v) for v in config.LIDAR_CONFIGS[config.LIDAR_NAME]["translation"]]
     q_lidar = [float(v) for v in config.LIDAR_CONFIGS[config.LIDAR_NAME]["rotation_wxyz"]]
+    lidar_c_token = make_token("calibrated_sensor", config.LIDAR_NAME, t_lidar, q_lidar)
 
     calib_json.append({
         "token": lidar_c_token, "sensor_token": lidar_s_token,
@@ -154,148 +178,155 @@ def write_nuscenes_jsons(base_dir,
         "camera_intrinsic": []
     })
 
-    # sample_data.json
-    sample_data_json = []
+    # sample_data.json（センサごとに timestamp 順で1行ずつ作って書き出す。全体をリストに溜めない）
+    cam_fmt = camera_fileformat()
+    base_prefix = config.BASE_DIR + os.sep
 
-    def add_sd(sample_idx, sensor_tokens, src_path, fileformat, width=0, height=0, base_dir=config.BASE_DIR):
-        sample_token = sample_json[sample_idx]["token"]
-        s_token, c_token = sensor_tokens
-        rel = src_path.replace(os.sep + "sweeps" + os.sep, os.sep + "samples" + os.sep)
-        rel = rel.replace(base_dir + os.sep, "")
+    def keyframe_filename(src_path, fileformat):
+        rel = sample_path_for(src_path).replace(base_prefix, "")
         if fileformat == "pcd":
             # If already .pcd.bin keep it. If plain .bin, change to .pcd
             if rel.endswith(".pcd.bin"):
                 pass
             elif rel.endswith(".bin"):
                 rel = rel[:-4] + ".pcd"
-        sample_data_json.append({
-            "token": str(uuid.uuid4()),
-            "sample_token": sample_token,
-            "ego_pose_token": ego_pose_token,
-            "calibrated_sensor_token": c_token,
-            "sensor_token": s_token,
-            "filename": rel,
-            "fileformat": fileformat,
-            "is_key_frame": True,
-            "timestamp": int(sample_times[sample_idx]),
-            "width": width,
-            "height": height
-        })
-
-    # keyframes: camera
-    for cam_name in config.CAM_NAMES:
-        s_token, c_token = per_cam_tokens[cam_name]
-        for idx in range(len(sample_times)):
-            src = key_img_for_idx.get(cam_name, {}).get(idx)
-            if src: add_sd(idx, (s_token, c_token), src, "png", width=config.IMG_W, height=config.IMG_H)
-
-    # keyframes: radar
-    for rname in config.RADAR_NAMES:
-        s_token, c_token = per_radar_tokens[rname]
-        for idx in range(len(sample_times)):
-            src = key_radar_for_idx.get(rname, {}).get(idx)
-            if src: add_sd(idx, (s_token, c_token), src, "pcd")
-
-    # keyframes: lidar
-    for idx in range(len(sample_times)):
-        src = key_lidar_for_idx.get(idx)
-        if src:
-            add_sd(idx, (lidar_s_token, lidar_c_token), src, "pcd")
-
-    # sweeps: 非keyframe
-    def nearest_sample_index(ts):
-        return min(range(len(sample_times)), key=lambda i: abs(sample_times[i] - ts))
-
-    # camera sweeps
-    for cam_name, imgs in captured_images.items():
-        s_token, c_token = per_cam_tokens[cam_name]
-        for img in imgs:
-            idx = nearest_sample_index(img["timestamp"])
-            if key_img_for_idx.get(cam_name, {}).get(idx) == img["path"]:
-                continue
-            rel = img["path"].replace(config.BASE_DIR + os.sep, "")
-            sample_data_json.append({
-                "token": str(uuid.uuid4()),
-                "sample_token": sample_json[idx]["token"],
-                "ego_pose_token": ego_pose_token,
-                "calibrated_sensor_token": c_token,
-                "sensor_token": s_token,
-                "filename": rel,
-                "fileformat": "png",
-                "is_key_frame": False,
-                "timestamp": img["timestamp"],
-                "width": config.IMG_W,
-                "height": config.IMG_H
-            })
-
-    # radar sweeps（.pcdに差し替え）
-    for rname, meas_list in captured_radar.items():
-        s_token, c_token = per_radar_tokens[rname]
-        for meas in meas_list:
-            idx = nearest_sample_index(meas["timestamp"])
-            if key_radar_for_idx.get(rname, {}).get(idx) == meas["path"]:
-                continue
-            rel = meas["path"].replace(config.BASE_DIR + os.sep, "")
-            rel_pcd = rel.replace(".bin", ".pcd")
-            sample_data_json.append({
-                "token": str(uuid.uuid4()),
+        return rel
+
+    def sweep_filename(path, fileformat):
+        rel = path.replace(base_prefix, "")
+        if fileformat == "pcd" and not rel.endswith(".pcd.bin"):
+            rel = rel.replace(".bin", ".pcd")
+        return rel
+
+    # 各 sweep を最も近い sample に割り当てる（searchsorted で一括。遠すぎるものは -1）
+    sample_ts = np.asarray(sample_times, dtype=np.int64)
+    sweep_max_offset = getattr(config, "SWEEP_MAX_OFFSET_US", None)
+
+    def nearest_sample_indices(items):
+        ts = np.fromiter((it["timestamp"] for it in items), dtype=np.int64, count=len(items))
+        return nearest_indices(sample_ts, ts, sweep_max_offset).tolist()
+
+    # ego_pose は sample_data の timestamp ごとに1件（同じ時刻のセンサ同士で共有）
+    use_ego_poses = ego_poses is not None and len(ego_poses) > 0
+    ego_timestamps = set()
+
+    def ego_token_for(ts):
+        if not use_ego_poses:
+            return ego_pose_token
+        ego_timestamps.add(ts)
+        return make_token(scene_name, "ego_pose", ts)
+
+    def sensor_rows(channel, sensor_tokens, key_for_idx, items, fileformat, width=0, height=0):
+        """1センサ分の sample_data 行を timestamp 順に返す（prev/next は link_prev_next_stream で埋める）"""
+        s_token, c_token = sensor_tokens
+        # (timestamp, is_key_frame, sample index, path)。キーフレームが先、sweep が後で安定ソート
+        # キーフレームの timestamp はサンプル時刻ではなく元フレームの撮影時刻（ego_pose もその時刻で引く）
+        src_ts = {it["path"]: it["timestamp"] for it in items}
+        rows = [(int(src_ts.get(src, sample_times[idx])), True, idx, src) for idx, src in sorted(key_for_idx.items())]
+        # キーフレームに使ったフレームは samples/ 側の行だけにする
+        # （KEYFRAME_MATERIALIZE="move" なら sweeps/ にはもう無い）
+        key_srcs = set(key_for_idx.values())
+        for it, idx in zip(items, nearest_sample_indices(items)):
+            if idx >= 0 and it["path"] not in key_srcs:
+                rows.append((it["timestamp"], False, idx, it["path"]))
+        rows.sort(key=lambda r: r[0])
+        for ts, is_key, idx, path in rows:
+            filename = keyframe_filename(path, fileformat) if is_key else sweep_filename(path, fileformat)
+            yield {
+                "token": make_token(scene_name, "sample_data", channel, ts, filename),
                 "sample_token": sample_json[idx]["token"],
-                "ego_pose_token": ego_pose_token,
+                "ego_pose_token": ego_token_for(ts),
                 "calibrated_sensor_token": c_token,
                 "sensor_token": s_token,
-                "filename": rel_pcd,
-                "fileformat": "pcd",
-                "is_key_frame": False,
-                "timestamp": meas["timestamp"],
-                "width": 0,
-                "height": 0
-            })
-
-    # lidar sweeps
-    for meas in captured_lidar:
-        idx = nearest_sample_index(meas["timestamp"])
-        rel = meas["path"].replace(config.BASE_DIR + os.sep, "")
-        sample_data_json.append({
-            "token": str(uuid.uuid4()),
-            "sample_token": sample_json[idx]["token"],
-            "ego_pose_token": ego_pose_token,
-            "calibrated_sensor_token": lidar_c_token,
-            "sensor_token": lidar_s_token,
-            "filename": rel,
-            "fileformat": "pcd",
-            "is_key_frame": False,
-            "timestamp": meas["timestamp"],
-            "width": 0,
-            "height": 0
-        })
-
-    # prev/next
-    link_prev_next(sample_data_json)
+                "filename": filename,
+                "fileformat": COMPACT_FILEFORMAT if filename.endswith(COMPACT_EXT) else fileformat,
+                "is_key_frame": is_key,
+                "timestamp": ts,
+                "width": width,
+                "height": height
+            }
+
+    with metrics.timer("write_table", table="sample_data.json"), \
+            JsonTableWriter(os.path.join(out_dir, "sample_data.json")) as sd_writer:
+        # camera
+        for cam_name in config.CAM_NAMES:
+            sd_writer.write_all(link_prev_next_stream(sensor_rows(
+                cam_name, per_cam_tokens[cam_name], key_img_for_idx.get(cam_name, {}),
+                captured_images.get(cam_name, []), cam_fmt, width=config.IMG_W, height=config.IMG_H)))
+        # radar（.pcd）
+        for rname in config.RADAR_NAMES:
+            sd_writer.write_all(link_prev_next_stream(sensor_rows(
+                rname, per_radar_tokens[rname], key_radar_for_idx.get(rname, {}),
+                captured_radar.get(rname, []), "pcd")))
+        # lidar
+        sd_writer.write_all(link_prev_next_stream(sensor_rows(
+            config.LIDAR_NAME, (lidar_s_token, lidar_c_token), key_lidar_for_idx, captured_lidar, "pcd")))
 
     # log.json / map.json
     log_json = [{
         "token": log_token,
         "location": "eval",
-        "date_captured": datetime.now().strftime("%Y-%m-%d"),
+        "date_captured": date_captured or capture_date(),
         "logfile": "eval.log",
-        "duration": float(config.DURATION_SEC)
+        "duration": float(duration_sec if duration_sec is not None else config.DURATION_SEC)
     }]
 
     map_json = [{
-        "token": str(uuid.uuid4()),
+        "token": make_token(scene_name, "map"),
         "filename": "maps/eval_map.png",
         "log_tokens": [log_token],
         "layer_names": ["road_segment","lane","stop_line"]
     }]
 
-    # 保存
-    save_json(os.path.join(out_dir, "log.json"), log_json)
-    save_json(os.path.join(out_dir, "scene.json"), scene_json)
-    save_json(os.path.join(out_dir, "ego_pose.json"), ego_pose_json)
-    save_json(os.path.join(out_dir, "sensor.json"), sensor_json)
-    save_json(os.path.join(out_dir, "calibrated_sensor.json"), calib_json)
-    save_json(os.path.join(out_dir, "sample.json"), sample_json)
-    save_json(os.path.join(out_dir, "sample_data.json"), sample_data_json)
-    for n in ["category.json","attribute.json","visibility.json","sample_annotation.json","instance.json"]:
-        save_json(os.path.join(out_dir, n), [])
-    save_json(os.path.join(out_dir, "map.json"), map_json)
+    # 保存（テーブルごとに時間を計る）
+    tables = {"sample_data.json": sd_writer}
+
+    def save(name, rows):
+        with metrics.timer("write_table", table=name):
+            tables[name] = save_json(os.path.join(out_dir, name), rows)
+
+    save("log.json", log_json)
+    save("scene.json", scene_json)
+    if use_ego_poses:
+        # 記録した姿勢をまとめて補間（nuScenes 座標・四元数 [w,x,y,z]）
+        ego_ts = np.array(sorted(ego_timestamps), dtype=np.int64)
+        ego_xyz, ego_quat, _ = ego_poses.interpolate(ego_ts)
+        with metrics.timer("write_table", table="ego_pose.json"), \
+                JsonTableWriter(os.path.join(out_dir, "ego_pose.json")) as ego_writer:
+            for ts, xyz, q in zip(ego_ts.tolist(), ego_xyz.tolist(), ego_quat.tolist()):
+                ego_writer.write({
+                    "token": make_token(scene_name, "ego_pose", ts),
+                    "timestamp": ts,
+                    "rotation": q,
+                    "translation": xyz
+                })
+        tables["ego_pose.json"] = ego_writer
+    else:
+        save("ego_pose.json", ego_pose_json)
+    save("sensor.json", sensor_json)
+    save("calibrated_sensor.json", calib_json)
+    save("sample.json", sample_json)
+    # アノテーション（category / attribute / visibility / instance / sample_annotation）
+    with metrics.timer("build_annotations"):
+        # 点数を数えるキーフレーム点群は、それぞれの撮影時刻の自車姿勢で global へ移す
+        key_srcs = set(key_lidar_for_idx.values())
+        for key_for_idx in key_radar_for_idx.values():
+            key_srcs.update(key_for_idx.values())
+        key_timestamps = {it["path"]: it["timestamp"]
+                          for items in [captured_lidar] + list(captured_radar.values())
+                          for it in items if it["path"] in key_srcs}
+        category_json, attribute_json, visibility_json, instance_json, ann_json = build_annotation_tables(
+            scene_name, sample_json, sample_times, actor_boxes, ego_poses, key_lidar_for_idx, key_radar_for_idx,
+            key_timestamps)
+    save("category.json", category_json)
+    save("attribute.json", attribute_json)
+    save("visibility.json", visibility_json)
+    save("instance.json", instance_json)
+    save("sample_annotation.json", ann_json)
+    save("map.json", map_json)
+
+    if getattr(config, "EXPORT_INCREMENTAL", False):
+        print(f"[EXPORT] {out_dir}")
+        for name, w in tables.items():
+            print(format_table_status(name, w))
+    return tables
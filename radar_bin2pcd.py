@@ -1,6 +1,8 @@
 import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import struct
 from tqdm import tqdm
 
 # ===== PCD ヘッダ（nuScenes radar と完全一致）=====
@@ -20,10 +22,16 @@ _PCD_HEADER = (
     "DATA binary\n"
 )
 
-# 1点のパック形式（合計 43 bytes/point）
-# <fff  B   H   f   f   f   f   f   B  B  B  B  B  B  B  B
-#  x,y,z dyn id  rcs vx  vy  vx_c vy_c iq as xr yr inv pd vxr vyr
-_PACK = struct.Struct('<fff B H f f f f f B B B B B B B B').pack
+# 1点のパック形式（合計 43 bytes/point、パディング無し）。_PCD_HEADER の FIELDS/SIZE/TYPE と同順
+RADAR_PCD_DTYPE = np.dtype([
+    ("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+    ("dyn_prop", "u1"), ("id", "<u2"), ("rcs", "<f4"),
+    ("vx", "<f4"), ("vy", "<f4"), ("vx_comp", "<f4"), ("vy_comp", "<f4"),
+    ("is_quality_valid", "u1"), ("ambig_state", "u1"),
+    ("x_rms", "u1"), ("y_rms", "u1"), ("invalid_state", "u1"),
+    ("pdh0", "u1"), ("vx_rms", "u1"), ("vy_rms", "u1"),
+])
+assert RADAR_PCD_DTYPE.itemsize == 43
 
 
 def _carla_polar_to_nuscenes_xyz(depth, az, alt):
@@ -45,17 +53,26 @@ def convert_bin_to_nuscenes_pcd(bin_path: str, pcd_path: str, vel_abs_limit: flo
     速度列が破綻している場合は自動で vx, vy を 0 にフォールバック。
     """
     scan = np.fromfile(bin_path, dtype=np.float32)
-    if scan.size == 0:
-        # 空でもヘッダは正規に作っておく
-        with open(pcd_path, 'wb') as f:
-            f.write(_PCD_HEADER.format(n=0).encode('ascii'))
-            f.write(b'\n')
-        return
     if scan.size % 4 != 0:
         raise ValueError(f"{bin_path}: float32の数が4の倍数ではありません（{scan.size}）")
 
     pts = scan.reshape(-1, 4)
     depth, az, alt, vel_guess = pts.T
+    write_nuscenes_radar_pcd(pcd_path, depth, az, alt, vel_guess, vel_abs_limit)
+
+
+def write_nuscenes_radar_pcd(pcd_path: str, depth, az, alt, vel_guess, vel_abs_limit: float = 250.0) -> None:
+    """
+    CARLA radar の検出（depth, azimuth[rad], altitude[rad], velocity[m/s] の各配列）
+      -> nuScenes互換 PCD(binary, 18 fields)
+    sensors.attach_radars のコールバックから raw_data を直接渡して使う。
+    """
+    if depth.size == 0:
+        # 空でもヘッダは正規に作っておく
+        with open(pcd_path, 'wb') as f:
+            f.write(_PCD_HEADER.format(n=0).encode('ascii'))
+            f.write(b'\n')
+        return
 
     # --- 速度列の妥当性チェック（破綻検知） ---
     invalid_mask = ~np.isfinite(vel_guess) | (np.abs(vel_guess) > vel_abs_limit)
@@ -66,57 +83,124 @@ def convert_bin_to_nuscenes_pcd(bin_path: str, pcd_path: str, vel_abs_limit: flo
     x, y, z = _carla_polar_to_nuscenes_xyz(depth, az, alt)
     n = x.shape[0]
 
+    # 列ごとに構造化配列へ詰める（未設定の列は 0）
+    pts = np.zeros(n, dtype=RADAR_PCD_DTYPE)
+    pts["x"], pts["y"], pts["z"] = x, y, z
     # 速度（視線速度を平面へ投影。yは左+系に合わせて符号反転）
-    vx = (vel * np.cos(az) * np.cos(alt)).astype(np.float32)
-    vy = (-vel * np.sin(az) * np.cos(alt)).astype(np.float32)
-    vx_comp = vx.copy()
-    vy_comp = vy.copy()
-
-    # 残りのフィールド（unsigned で作成）
-    dyn_prop = np.zeros(n, dtype=np.uint8)
-    ids      = np.arange(n, dtype=np.uint16)
-    rcs      = np.zeros(n, dtype=np.float32)
-    is_quality_valid = np.ones(n, dtype=np.uint8)
-    ambig_state      = np.full(n, 3, dtype=np.uint8)
-    x_rms = y_rms = invalid_state = pdh0 = vx_rms = vy_rms = np.zeros(n, dtype=np.uint8)
+    pts["vx"] = vel * np.cos(az) * np.cos(alt)
+    pts["vy"] = -vel * np.sin(az) * np.cos(alt)
+    pts["vx_comp"] = pts["vx"]
+    pts["vy_comp"] = pts["vy"]
+    pts["id"] = np.arange(n, dtype=np.uint16)
+    pts["is_quality_valid"] = 1
+    pts["ambig_state"] = 3
 
     # 出力
     with open(pcd_path, 'wb') as f:
         f.write(_PCD_HEADER.format(n=n).encode('ascii'))
-        for i in range(n):
-            f.write(_PACK(
-                float(x[i]), float(y[i]), float(z[i]),
-                int(dyn_prop[i]), int(ids[i]), float(rcs[i]),
-                float(vx[i]), float(vy[i]), float(vx_comp[i]), float(vy_comp[i]),
-                int(is_quality_valid[i]), int(ambig_state[i]),
-                int(x_rms[i]), int(y_rms[i]), int(invalid_state[i]),
-                int(pdh0[i]), int(vx_rms[i]), int(vy_rms[i])
-            ))
+        f.write(pts.tobytes())
         # nuScenesの読み出し実装が < を使う環境があるため、末尾に1バイト追加
         f.write(b'\n')
 
 
-def batch_convert_radar(bin_root: str) -> None:
+def _read_radar_pcd_header(f, pcd_path):
+    """DATA 行まで読み、点数を返す（f はデータ先頭に位置する）。"""
+    n = None
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError(f"{pcd_path}: DATA 行がありません")
+        key, _, val = line.decode('ascii').strip().partition(' ')
+        if key == "POINTS":
+            n = int(val)
+        elif key == "DATA":
+            if val != "binary":
+                raise ValueError(f"{pcd_path}: DATA {val} には未対応です")
+            return n
+
+
+def read_nuscenes_radar_pcd(pcd_path: str) -> np.ndarray:
+    """
+    write_nuscenes_radar_pcd が書いた PCD を RADAR_PCD_DTYPE の構造化配列で返す。
+    """
+    with open(pcd_path, 'rb') as f:
+        n = _read_radar_pcd_header(f, pcd_path)
+        return np.fromfile(f, dtype=RADAR_PCD_DTYPE, count=n)
+
+
+def memmap_nuscenes_radar_pcd(pcd_path: str) -> np.ndarray:
+    """read_nuscenes_radar_pcd の np.memmap 版（読み込み専用・コピーなし）。"""
+    with open(pcd_path, 'rb') as f:
+        n = _read_radar_pcd_header(f, pcd_path)
+        offset = f.tell()
+    if n == 0:
+        return np.zeros(0, dtype=RADAR_PCD_DTYPE)
+    return np.memmap(pcd_path, dtype=RADAR_PCD_DTYPE, mode='r', offset=offset, shape=(n,))
+
+
+def _scan_radar_bins(root: str, in_radar: bool = False):
+    """root 以下の RADAR_* ディレクトリにある .bin を (path, stat) で列挙（os.scandir で1回ずつ stat）。"""
+    with os.scandir(root) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _scan_radar_bins(e.path, in_radar or e.name.startswith("RADAR_"))
+            elif in_radar and e.name.endswith(".bin") and e.is_file():
+                yield e.path, e.stat()
+
+
+def _convert_job(job):
+    src, dst = job
+    convert_bin_to_nuscenes_pcd(src, dst)
+    return src
+
+
+def batch_convert_radar(bin_root: str, workers: int = None, force: bool = False) -> dict:
     """
     bin_root 配下の RADAR_* ディレクトリにある .bin を .pcd へ変換（同ディレクトリに出力）。
+    .pcd が .bin より新しければスキップ（force=True で全部やり直し）。
+    workers > 1 ならプロセスプールで並列変換。戻り値は集計 dict。
     """
-    for root, _, files in os.walk(bin_root):
-        rel = os.path.relpath(root, bin_root)
-        parts = [p for p in rel.split(os.sep) if p and p != '.']
-        if not any(p.startswith("RADAR_") for p in parts):
-            continue
-        targets = [f for f in files if f.endswith(".bin")]
-        for fname in tqdm(targets, desc=f"Converting {rel}"):
-            src = os.path.join(root, fname)
-            dst = os.path.join(root, fname[:-4] + ".pcd")
-            convert_bin_to_nuscenes_pcd(src, dst)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    t0 = time.perf_counter()
+    jobs, skipped, nbytes = [], 0, 0
+    for src, st in _scan_radar_bins(bin_root):
+        dst = src[:-4] + ".pcd"
+        if not force:
+            try:
+                if os.stat(dst).st_mtime_ns >= st.st_mtime_ns:
+                    skipped += 1
+                    continue
+            except FileNotFoundError:
+                pass
+        jobs.append((src, dst))
+        nbytes += st.st_size
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            chunk = max(1, len(jobs) // (workers * 8))
+            for _ in tqdm(ex.map(_convert_job, jobs, chunksize=chunk), total=len(jobs), desc=f"Converting {bin_root}"):
+                pass
+    else:
+        for job in tqdm(jobs, desc=f"Converting {bin_root}"):
+            _convert_job(job)
+
+    dt = max(time.perf_counter() - t0, 1e-9)
+    stats = {"converted": len(jobs), "skipped": skipped, "bytes": nbytes, "seconds": dt}
+    print(f"  {len(jobs)} converted, {skipped} up to date, "
+          f"{len(jobs) / dt:.1f} files/s, {nbytes / dt / 1e6:.2f} MB/s ({dt:.2f}s, workers={workers})")
+    return stats
 
 
 if __name__ == "__main__":
-    base = "./data/nuScenes"
+    ap = argparse.ArgumentParser(description="RADAR_* の .bin → nuScenes互換 .pcd 変換")
+    ap.add_argument("base", nargs="?", default="./data/nuScenes")
+    ap.add_argument("--workers", type=int, default=None, help="並列数（既定: CPU数, 1 で直列）")
+    ap.add_argument("--force", action="store_true", help=".pcd が新しくても変換し直す")
+    args = ap.parse_args()
     for sub in ("sweeps", "samples"):
-        d = os.path.join(base, sub)
+        d = os.path.join(args.base, sub)
         if os.path.isdir(d):
             print(f"▶ RADAR_* in {sub}: .bin → .pcd")
-            batch_convert_radar(d)
+            batch_convert_radar(d, workers=args.workers, force=args.force)
     print("✅ RADAR_* の .bin → .pcd 変換完了（nuScenes完全互換・Y反転・アンビギュイティ対策・末尾1Bパディング）")
@@ -0,0 +1,125 @@
+"""
+区切り撮影（config.SEGMENT_SEC）。長時間の撮影を SEGMENT_SEC 秒ごとのシーンに切り、
+区切りごとにキーフレーム選択とテーブル出力をバックグラウンドで行って、そのぶんの記録をメモリから外す。
+
+- 区切りはシミュレーション時刻で判定する（tick コールバックから on_tick を呼ぶ）。
+  書き出しワーカーの遅れを見込んで、区切りから SEGMENT_GRACE_SEC 経ってから切る
+- 切り出した区間の captured_* / 自車姿勢 / アクターの箱は export_fn(segment) に渡し、
+  export は SEGMENT_EXPORT_WORKERS 本のスレッドで撮影と並行に走る
+- 区切りより前の時刻のレコードが切った後に届いたら（書き出しがそれ以上遅れたら）捨てて数える
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+
+class Segment:
+    def __init__(self, index, start_us, end_us, captured_images, captured_radar, captured_lidar,
+                 ego_poses, actor_boxes):
+        self.index = index
+        self.start_us = start_us
+        self.end_us = end_us
+        self.captured_images = captured_images
+        self.captured_radar = captured_radar
+        self.captured_lidar = captured_lidar
+        self.ego_poses = ego_poses
+        self.actor_boxes = actor_boxes
+
+    @property
+    def duration_sec(self):
+        return (self.end_us - self.start_us) / 1e6
+
+    @property
+    def version(self):
+        return f"{config.VERSION}-seg{self.index:04d}"
+
+    @property
+    def scene_name(self):
+        return f"{getattr(config, 'SCENE_NAME', 'scene_1')}_{self.index:04d}"
+
+
+class SegmentedCapture:
+    def __init__(self, captured_images, captured_radar, captured_lidar, ego_poses, actor_boxes, export_fn,
+                 segment_sec=None, grace_sec=None, workers=None):
+        self.captured_images = captured_images
+        self.captured_radar = captured_radar
+        self.captured_lidar = captured_lidar
+        self.ego_poses = ego_poses
+        self.actor_boxes = actor_boxes
+        self.export_fn = export_fn
+        self.segment_us = int((segment_sec or config.SEGMENT_SEC) * 1e6)
+        self.grace_us = int((grace_sec if grace_sec is not None else getattr(config, "SEGMENT_GRACE_SEC", 1.0)) * 1e6)
+        workers = workers or getattr(config, "SEGMENT_EXPORT_WORKERS", 1)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="segment-export")
+        self._futures = []
+        self.start_us = None
+        self.index = 0
+        self.late = 0        # 切った後に届いた、前の区間のレコード数
+
+    def _take(self, items, end_us):
+        """items から start <= ts < end のレコードを取り出す（それ以降のものは残す）。"""
+        n = len(items)
+        taken = items[:n]
+        # 書き出しワーカーは末尾に append するだけなので、先頭 n 件の削除と先頭への差し戻しは衝突しない
+        del items[:n]
+        seg, keep = [], []
+        for rec in taken:
+            ts = rec["timestamp"]
+            if end_us is not None and ts >= end_us:
+                keep.append(rec)
+            elif ts >= self.start_us:
+                seg.append(rec)
+            else:
+                self.late += 1
+        if keep:
+            items[0:0] = keep
+        return seg
+
+    def on_tick(self, snapshot):
+        """tick ごとに呼ぶ。区切りを過ぎていれば切ってバックグラウンドで出力する。"""
+        now = int(snapshot.timestamp.elapsed_seconds * 1e6)
+        if self.start_us is None:
+            self.start_us = now
+        end = self.start_us + self.segment_us
+        if now >= end + self.grace_us:
+            self._cut(end)
+
+    def _cut(self, end_us):
+        start = self.start_us
+        images = {ch: self._take(items, end_us) for ch, items in self.captured_images.items()}
+        radar = {ch: self._take(items, end_us) for ch, items in self.captured_radar.items()}
+        lidar = self._take(self.captured_lidar, end_us)
+        if end_us is None:
+            stamps = [r["timestamp"] for recs in list(images.values()) + list(radar.values()) + [lidar] for r in recs]
+            end_us = max(stamps) + 1 if stamps else start
+        # 補間用に前後 grace ぶん余分に渡す。捨てるのは次の区間で要らなくなった分だけ
+        ego = self.ego_poses.window(start - self.grace_us, end_us + self.grace_us)
+        self.ego_poses.discard_before(end_us - self.grace_us)
+        boxes = None
+        if self.actor_boxes is not None:
+            boxes = self.actor_boxes.window(start - self.grace_us, end_us + self.grace_us)
+            self.actor_boxes.discard_before(end_us - self.grace_us)
+        segment = Segment(self.index, start, end_us, images, radar, lidar, ego, boxes)
+        if any(images.values()):
+            self._futures.append(self._pool.submit(self._export, segment))
+        else:
+            print(f"[SEGMENT] {self.index:04d}: カメラのフレームが無いので出力しません")
+        self.index += 1
+        self.start_us = end_us
+
+    def _export(self, segment):
+        t0 = time.time()
+        self.export_fn(segment)
+        print(f"[SEGMENT] {segment.index:04d} {segment.duration_sec:.1f}s → {segment.version} "
+              f"({time.time() - t0:.1f}s)")
+        return segment.version
+
+    def finish(self):
+        """撮影後（センサ停止・書き出し完了後）に呼ぶ。残りを最後の区間として出し、全部の出力を待つ。"""
+        if self.start_us is not None:
+            self._cut(None)
+        versions = [f.result() for f in self._futures]
+        self._pool.shutdown()
+        if self.late:
+            print(f"[SEGMENT] 区切り後に届いたレコード {self.late} 件は捨てました（SEGMENT_GRACE_SEC を増やしてください）")
+        return versions
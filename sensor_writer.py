@@ -0,0 +1,129 @@
+import threading
+from collections import deque, defaultdict
+import config
+
+
+class SensorWriter:
+    """
+    センサコールバック用の書き出しプール。
+    コールバック側は submit() で「書き出し関数 + 生データ + メタ情報」を積むだけにして、
+    エンコードやディスク I/O はワーカースレッドで行う（CARLA のコールバックスレッドを止めない）。
+
+    キューが満杯のときの動作（policy）:
+      "block"       : 空くまで待つ（フレームは落とさない）
+      "drop_oldest" : 一番古い未処理ジョブを捨てて積む
+      "drop_newest" : 今来たジョブを捨てる
+    """
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, workers=None, max_queue=None, policy=None):
+        self.workers = int(workers if workers is not None else getattr(config, "WRITER_WORKERS", 4))
+        self.max_queue = int(max_queue if max_queue is not None else getattr(config, "WRITER_QUEUE_SIZE", 64))
+        self.policy = policy if policy is not None else getattr(config, "WRITER_FULL_POLICY", "block")
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"unknown writer policy: {self.policy} (choose from {self.POLICIES})")
+        if self.workers < 1 or self.max_queue < 1:
+            raise ValueError("workers と max_queue は 1 以上にしてください")
+
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._busy = 0
+        self._closed = False
+        self._depth = defaultdict(int)      # channel -> 未処理ジョブ数
+        self._max_depth = defaultdict(int)
+        self._written = defaultdict(int)
+        self._dropped = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"sensor-writer-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, channel, fn, *args):
+        """ジョブを積む。捨てた場合は False を返す。"""
+        with self._cond:
+            if self._closed:
+                # 停止後に遅れて届いたフレーム
+                self._dropped[channel] += 1
+                return False
+            if len(self._jobs) >= self.max_queue:
+                if self.policy == "drop_newest":
+                    self._dropped[channel] += 1
+                    return False
+                if self.policy == "drop_oldest":
+                    old_channel, _, _ = self._jobs.popleft()
+                    self._depth[old_channel] -= 1
+                    self._dropped[old_channel] += 1
+                else:
+                    self._cond.wait_for(lambda: len(self._jobs) < self.max_queue or self._closed)
+                    if self._closed:
+                        # 待っている間に close された（積んでももう誰も書かない）
+                        self._dropped[channel] += 1
+                        return False
+            self._jobs.append((channel, fn, args))
+            self._depth[channel] += 1
+            self._max_depth[channel] = max(self._max_depth[channel], self._depth[channel])
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._jobs or self._closed)
+                if not self._jobs:
+                    return
+                channel, fn, args = self._jobs.popleft()
+                self._busy += 1
+                self._cond.notify_all()
+            ok = True
+            try:
+                fn(*args)
+            except Exception as e:
+                ok = False
+                print(f"[WRITER] {channel}: {e!r}")
+            with self._cond:
+                self._busy -= 1
+                self._depth[channel] -= 1
+                if ok:
+                    self._written[channel] += 1
+                else:
+                    self._errors[channel] += 1
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """積まれているジョブが全部書き終わるまで待つ。"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._jobs and self._busy == 0, timeout=timeout)
+
+    def close(self):
+        """残りを書き切ってからワーカーを止める。"""
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def stats(self):
+        """channel -> {queued, max_queued, written, dropped, errors}"""
+        with self._cond:
+            channels = set(self._depth) | set(self._dropped)
+            return {
+                ch: {
+                    "queued": self._depth[ch],
+                    "max_queued": self._max_depth[ch],
+                    "written": self._written[ch],
+                    "dropped": self._dropped[ch],
+                    "errors": self._errors[ch],
+                }
+                for ch in sorted(channels)
+            }
+
+    def format_stats(self):
+        lines = []
+        for ch, s in self.stats().items():
+            lines.append(f"  {ch:<18} written={s['written']:>6} dropped={s['dropped']:>5} "
+                         f"errors={s['errors']:>3} max_queued={s['max_queued']:>4}")
+        return "\n".join(lines)
@@ -1,10 +1,15 @@
 import os
 import numpy as np
 import shutil
+import threading
 import carla
 import config
-from utils import make_directory
+from utils import make_directory, camera_fileformat
+from radar_bin2pcd import write_nuscenes_radar_pcd
+from lidar_codec import sweep_ext, compact_scale, voxel_downsample, write_compact, COMPACT_EXT
+import metrics
 import math
+from PIL import Image
 
 def _set_camera_attr(bp, fov: float):
     bp.set_attribute('image_size_x', str(config.IMG_W))
@@ -66,20 +71,61 @@ def hfov_from_intrinsics(K, img_w):
     fx = float(K[0][0])
     return math.degrees(2.0 * math.atan(img_w / (2.0 * fx)))
 
-def attach_cameras(world, bl, vehicle, sweeps_dir):
+def camera_bgra_view(image):
+    """carla.Image.raw_data をコピーせず (H, W, 4) の BGRA 配列として見る。"""
+    return np.frombuffer(image.raw_data, dtype=np.uint8).reshape(image.height, image.width, 4)
+
+def encode_camera_frame(bgra, path, encoder=None):
+    """
+    BGRA 配列を config.CAM_ENCODER の形式で path に書く。
+      png: 可逆（CAM_PNG_COMPRESS_LEVEL）/ jpg: nuScenes と同じ形式（CAM_JPEG_QUALITY）
+      npy: BGRA をそのまま保存（エンコードは後回し）
+    """
+    fmt = camera_fileformat(encoder)
+    if fmt == "npy":
+        with open(path, "wb") as f:
+            np.save(f, bgra)
+        return
+    h, w = bgra.shape[:2]
+    # BGRX → RGB の並べ替えは PIL のデコーダ内で1回だけ
+    img = Image.frombuffer("RGB", (w, h), bgra, "raw", "BGRX", 0, 1)
+    if fmt == "jpg":
+        img.save(path, format="JPEG", quality=getattr(config, "CAM_JPEG_QUALITY", 95))
+    else:
+        img.save(path, format="PNG", compress_level=getattr(config, "CAM_PNG_COMPRESS_LEVEL", 6))
+
+def _dispatch(writer, channel, job, *args):
+    """writer があれば書き出しジョブを積むだけ、無ければその場で書く。"""
+    if writer is None:
+        job(*args)
+    else:
+        writer.submit(channel, job, *args)
+
+def attach_cameras(world, bl, vehicle, sweeps_dir, on_frame=None, writer=None, manifest=None):
     cam_70_bp, cam_110_bp = prepare_camera_bps(bl)
     actors = []
     captured = {name: [] for name in config.CAM_NAMES}
 
+    ext = camera_fileformat()
+
     def make_callback(cam_name):
+        def write(bgra, rec):
+            encode_camera_frame(bgra, rec["path"])
+            captured[cam_name].append(rec)
+            if manifest is not None:
+                manifest.add(cam_name, rec)
+        write = metrics.wrap_write(cam_name, write)
+
         def callback(image: carla.Image):
             ts = int(image.timestamp * 1e6)
             frame = image.frame
-            path = os.path.join(sweeps_dir, cam_name, f"{cam_name}_{frame}.png")
-            make_directory(os.path.dirname(path))
-            image.save_to_disk(path)
-            captured[cam_name].append({"frame": frame, "path": path, "timestamp": ts})
-        return callback
+            path = os.path.join(sweeps_dir, cam_name, f"{cam_name}_{frame}.{ext}")
+            # raw_data のビューが image のバッファを保持するのでコピー不要
+            _dispatch(writer, cam_name, write, camera_bgra_view(image),
+                      {"frame": frame, "path": path, "timestamp": ts})
+            if on_frame is not None:
+                on_frame(cam_name, frame, ts)
+        return metrics.wrap_callback(cam_name, callback)
 
     for name in config.CAM_NAMES:
         cal = config.CAM_CONFIGS[name]
@@ -98,9 +144,9 @@ def attach_cameras(world, bl, vehicle, sweeps_dir):
         bp.set_attribute('sensor_tick', str(config.CAM_SENSOR_TICK))
         
         actor = world.spawn_actor(bp, carla.Transform(loc, rot), attach_to=vehicle)
+        make_directory(os.path.join(sweeps_dir, name))
         actor.listen(make_callback(name))
         actors.append(actor)
-        make_directory(os.path.join(sweeps_dir, name))
 
     return actors, captured
 
@@ -141,21 +187,37 @@ def prepare_radar_bp(bl):
     bp.set_attribute('range', str(config.RADAR_RANGE))
     return bp
 
-def attach_radars(world, bl, vehicle, sweeps_dir):
+def attach_radars(world, bl, vehicle, sweeps_dir, on_frame=None, writer=None, manifest=None):
     bp = prepare_radar_bp(bl)
     actors = []
     captured = {name: [] for name in config.RADAR_NAMES}
 
+    write_bin = getattr(config, "RADAR_WRITE_BIN", False)
+
     def make_callback(radar_name):
+        def write(radar_data, rec):
+            # raw_data は RadarDetection (velocity, azimuth, altitude, depth)[float32] の並び
+            det = np.frombuffer(radar_data.raw_data, dtype=np.float32).reshape(-1, 4)
+            vel, az, alt, depth = det.T
+            if write_bin:
+                # 旧形式 .bin (depth, azimuth, altitude, velocity)。
+                # PCD より先に書く（radar_bin2pcd は .pcd が .bin より古いと作り直す）
+                det[:, [3, 1, 2, 0]].tofile(rec["path"][:-4] + ".bin")
+            # 変換パスを別に回さず、ここで nuScenes 互換 PCD を直接書く
+            write_nuscenes_radar_pcd(rec["path"], depth, az, alt, vel)
+            captured[radar_name].append(rec)
+            if manifest is not None:
+                manifest.add(radar_name, rec)
+        write = metrics.wrap_write(radar_name, write)
+
         def callback(radar_data: carla.RadarMeasurement):
             ts = int(radar_data.timestamp * 1e6)
             frame = radar_data.frame
-            path = os.path.join(sweeps_dir, radar_name, f"{radar_name}_{frame}.bin")
-            make_directory(os.path.dirname(path))
-            pts = np.array([[d.depth, d.azimuth, d.altitude, d.velocity] for d in radar_data], dtype=np.float32)
-            pts.tofile(path)
-            captured[radar_name].append({"frame": frame, "path": path, "timestamp": ts})
-        return callback
+            path = os.path.join(sweeps_dir, radar_name, f"{radar_name}_{frame}.pcd")
+            _dispatch(writer, radar_name, write, radar_data, {"frame": frame, "path": path, "timestamp": ts})
+            if on_frame is not None:
+                on_frame(radar_name, frame, ts)
+        return metrics.wrap_callback(radar_name, callback)
 
     for rname in config.RADAR_NAMES:
         t = config.RADAR_CONFIGS[rname]["translation"]
@@ -164,9 +226,9 @@ def attach_radars(world, bl, vehicle, sweeps_dir):
         trans = carla.Transform(loc, rot)
 
         actor = world.spawn_actor(bp, trans, attach_to=vehicle)
+        make_directory(os.path.join(sweeps_dir, rname))
         actor.listen(make_callback(rname))
         actors.append(actor)
-        make_directory(os.path.join(sweeps_dir, rname))
     return actors, captured
 
 def prepare_lidar_bp(bl):
@@ -206,7 +268,68 @@ def _nus_lidar_to_carla_transform(translation, rotation_wxyz):
     rot = carla.Rotation(roll=roll, pitch=pitch, yaw=yaw)
     return loc, rot
 
-def attach_lidar(world, bl, vehicle, sweeps_dir):
+class LidarPacker:
+    """
+    CARLA LiDAR raw_data (x,y,z,intensity)[float32] → nuScenes 5float (x,y,z,intensity,ring) を
+    使い回しのバッファ上で詰める。1スイープごとの配列確保をしないためのもの。
+
+    バッファは LIDAR_PPS / LIDAR_ROTATION_HZ 点ぶんを確保しておき、書き出しワーカーが
+    複数いても衝突しないよう acquire/release でプールから貸し出す（足りなければ増やす）。
+
+    ring は各点の仰角から求める（Velodyne と同じく一番下のビームが 0）:
+      ring = round((elev - lower_fov) / (upper_fov - lower_fov) * (channels - 1))
+    """
+
+    def __init__(self, channels=None, upper_fov=None, lower_fov=None, points_per_sweep=None):
+        self.channels = int(channels if channels is not None else config.LIDAR_CHANNELS)
+        upper = math.radians(upper_fov if upper_fov is not None else config.LIDAR_UPPER_FOV)
+        lower = math.radians(lower_fov if lower_fov is not None else config.LIDAR_LOWER_FOV)
+        if points_per_sweep is None:
+            points_per_sweep = math.ceil(config.LIDAR_PPS / config.LIDAR_ROTATION_HZ)
+        self.capacity = int(points_per_sweep)
+        # ring = elev * scale - offset
+        self._scale = (self.channels - 1) / (upper - lower) if upper > lower else 0.0
+        self._offset = lower * self._scale
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _new_buffer(self, n):
+        # (出力 (n,5), 作業用 (n,))
+        return np.empty((n, 5), dtype=np.float32), np.empty(n, dtype=np.float32)
+
+    def acquire(self, n):
+        with self._lock:
+            buf = self._free.pop() if self._free else None
+        if buf is None or buf[0].shape[0] < n:
+            size = max(self.capacity, n if n <= self.capacity else int(n * 1.1))
+            self.capacity = max(self.capacity, size)
+            buf = self._new_buffer(size)
+        return buf
+
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+    def pack(self, raw_data):
+        """戻り値: (buf, pts5)。pts5 は buf のビューなので、使い終わったら release(buf)。"""
+        src = np.frombuffer(raw_data, dtype=np.float32).reshape(-1, 4)
+        n = src.shape[0]
+        buf = self.acquire(n)
+        out, tmp = buf[0][:n], buf[1][:n]
+        np.copyto(out[:, :4], src)
+        # nuScenes軸: x前+, y左+, z上+ → y を反転
+        np.negative(out[:, 1], out=out[:, 1])
+
+        ring = out[:, 4]
+        np.hypot(out[:, 0], out[:, 1], out=tmp)
+        np.arctan2(out[:, 2], tmp, out=ring)
+        ring *= self._scale
+        ring -= self._offset
+        np.rint(ring, out=ring)
+        np.clip(ring, 0, self.channels - 1, out=ring)
+        return buf, out
+
+def attach_lidar(world, bl, vehicle, sweeps_dir, on_frame=None, writer=None, manifest=None):
     bp = prepare_lidar_bp(bl)
 
     t = config.LIDAR_CONFIGS[config.LIDAR_NAME]["translation"]
@@ -217,33 +340,45 @@ def attach_lidar(world, bl, vehicle, sweeps_dir):
     actor = world.spawn_actor(bp, trans, attach_to=vehicle)
     captured = []
 
+    packer = LidarPacker()
+    voxel_size = getattr(config, "LIDAR_VOXEL_SIZE", None)
+    ext = sweep_ext()
+    compact = ext == COMPACT_EXT
+    scale = compact_scale() if compact else None
+
+    def write(lidar_data, rec):
+        # CARLA: (x,y,z,intensity)[float32]  →  nuScenes: y 反転 + ring列 の 5float
+        buf, pts5 = packer.pack(lidar_data.raw_data)
+        try:
+            if voxel_size:
+                pts5 = voxel_downsample(pts5, voxel_size)
+            if compact:
+                # int16 xyz + uint8 intensity/ring（キーフレームは samples/ に置くとき 5float に戻す）
+                write_compact(rec["path"], pts5, scale)
+            else:
+                # 5float で保存
+                pts5.tofile(rec["path"])
+        finally:
+            packer.release(buf)
+        captured.append(rec)
+        if manifest is not None:
+            manifest.add(config.LIDAR_NAME, rec)
+    write = metrics.wrap_write(config.LIDAR_NAME, write)
+
     # sensors.py の attach_lidar 内コールバック
     def callback(lidar_data: carla.LidarMeasurement):
         ts = int(lidar_data.timestamp * 1e6)
         frame = lidar_data.frame
-        # nuScenesのLiDARは拡張子が .pcd.bin（中身は5floatバイナリ）
+        # nuScenesのLiDARは拡張子が .pcd.bin（中身は5floatバイナリ）。compact なら .pcd.q16
         path = os.path.join(
             sweeps_dir,
             config.LIDAR_NAME,
-            f"{config.LIDAR_NAME}_{frame}.pcd.bin",
+            f"{config.LIDAR_NAME}_{frame}{ext}",
         )
-        make_directory(os.path.dirname(path))
-
-        # CARLA: (x,y,z,intensity)[float32]  →  nuScenes: y 反転 + ring列追加(0埋め) の 5float
-        pts4 = np.frombuffer(lidar_data.raw_data, dtype=np.float32).reshape(-1, 4).copy()
-        # nuScenes軸: x前+, y左+, z上+ → y を反転
-        pts4[:, 1] *= -1.0
-
-        # 追加: nuScenesが期待する 5floatに合わせて ring=0 列を追加
-        ring = np.zeros((pts4.shape[0], 1), dtype=np.float32)
-        pts5 = np.hstack([pts4, ring]).astype(np.float32)
-
-        # 5float で保存
-        pts5.tofile(path)
-
-        captured.append({"frame": frame, "path": path, "timestamp": ts})
-
+        _dispatch(writer, config.LIDAR_NAME, write, lidar_data, {"frame": frame, "path": path, "timestamp": ts})
+        if on_frame is not None:
+            on_frame(config.LIDAR_NAME, frame, ts)
 
-    actor.listen(callback)
     make_directory(os.path.join(sweeps_dir, config.LIDAR_NAME))
+    actor.listen(metrics.wrap_callback(config.LIDAR_NAME, callback))
     return actor, captured
@@ -0,0 +1,43 @@
+"""
+batch_runner の結果の突き合わせ。時間切れで止めたワーカーが止まる直前に出した結果を、
+同じシーンの次の試行の結果として数えないか。
+"""
+import os
+import sys
+import time
+import signal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_runner import run_batch
+
+
+def _late_result_worker(endpoint, inbox, results, out_root, use_fake):
+    """1回目は止まったふりをして、SIGTERM を受けたら ok を出してから終わる。2回目は失敗を返す。"""
+    marker = os.path.join(out_root, "first_attempt")
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        job_id, spec = item
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+
+            def on_term(signum, frame, job_id=job_id):
+                results.put((endpoint, job_id, True, 0.0, ""))
+                results.close()
+                results.join_thread()
+                os._exit(0)
+
+            signal.signal(signal.SIGTERM, on_term)
+            time.sleep(60)
+        results.put((endpoint, job_id, False, 0.0, "second attempt failed"))
+
+
+def test_late_result_from_stopped_worker_is_ignored(tmp_path):
+    summary = run_batch([{"name": "scene_0001"}], [("127.0.0.1", 2000)], str(tmp_path),
+                        retries=1, poll_sec=0.1, scene_timeout=0.5, worker=_late_result_worker)
+    r = summary["scene_0001"]
+    assert r["attempts"] == 2
+    assert not r["ok"]
+    assert r["error"] == "second attempt failed"
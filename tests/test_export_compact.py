@@ -0,0 +1,51 @@
+"""
+compact（.pcd.q16）で撮ったものを、前に出力したテーブル（--index）から出力し直せるか。
+CARLA の代わりに fake_carla で短く撮る。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_carla
+fake_carla.install()
+
+import config
+import main
+import export
+from dataset_reader import NuScenesLite
+from lidar_codec import COMPACT_EXT, FLOAT_EXT, read_lidar
+
+
+def _lidar_rows(root, version):
+    nusc = NuScenesLite(root, version, cache=False)
+    return sorted((sd["filename"], sd["timestamp"], sd["is_key_frame"]) for sd in nusc.sample_data
+                  if nusc.channel_of(sd) == config.LIDAR_NAME)
+
+
+def test_compact_reexport_from_index(tmp_path, monkeypatch):
+    root = str(tmp_path / "data")
+    for key, value in {"BASE_DIR": root, "DURATION_SEC": 1.0, "IMG_W": 64, "IMG_H": 36,
+                       "CAM_ENCODER": config.CAM_ENCODER, "LIDAR_SWEEP_ENCODING": "compact",
+                       "SEGMENT_SEC": None, "METRICS_ENABLED": False}.items():
+        monkeypatch.setattr(config, key, value)
+    main.main()
+    sweeps = os.path.join(root, "sweeps", config.LIDAR_NAME)
+    before = sorted(os.listdir(sweeps))
+    assert before and all(name.endswith(COMPACT_EXT) for name in before)
+
+    # キーフレームの行（samples/ の .pcd.bin）は sweeps/ の .pcd.q16 に引き直され、samples/ からは何も戻さない
+    index = export.SweepIndex.from_tables(root, config.VERSION)
+    _, records, stats = export.scan_channel(root, config.LIDAR_NAME, index.entries)
+    assert stats == {"restored": 0, "unindexed": 0, "bad_size": 0}
+    assert len(records) == len(before)
+
+    export.reexport(root, "v1.0-reexport", index_version=config.VERSION)
+    assert sorted(os.listdir(sweeps)) == before
+    assert _lidar_rows(root, "v1.0-reexport") == _lidar_rows(root, config.VERSION)
+    nusc = NuScenesLite(root, "v1.0-reexport", cache=False)
+    keyframes = [sd for sd in nusc.sample_data if sd["is_key_frame"] and nusc.channel_of(sd) == config.LIDAR_NAME]
+    assert keyframes
+    for sd in keyframes:
+        assert sd["filename"].endswith(FLOAT_EXT)
+        assert read_lidar(os.path.join(root, sd["filename"])).shape[1] == 5
@@ -0,0 +1,64 @@
+"""
+カメラが長く取りこぼしたとき、同じフレームが2つのサンプルのキーフレームにならないか（sample_data の token 重複）。
+CARLA 無しで sweeps/ にダミーのフレームを置いて export_scene を呼ぶ。
+"""
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import config
+from export import export_scene
+from dataset_reader import NuScenesLite
+from timeline import unique_nearest
+
+
+def _frames(sweeps, channel, ext, stamps, write):
+    os.makedirs(os.path.join(sweeps, channel), exist_ok=True)
+    items = []
+    for frame, ts in enumerate(stamps):
+        path = os.path.join(sweeps, channel, f"{channel}_{frame}.{ext}")
+        write(path)
+        items.append({"frame": frame, "path": path, "timestamp": int(ts)})
+    return items
+
+
+def test_unique_nearest_keeps_the_closest_sample():
+    # フレーム 1 が 3 つのサンプルの最近傍 → 一番近い（2 番目）だけに残す
+    item_ts = [0, 1_000_000]
+    sample_ts = [0, 500_000, 1_100_000, 1_600_000]
+    assert unique_nearest([0, 1, 1, 1], item_ts, sample_ts).tolist() == [0, -1, 1, -1]
+    assert unique_nearest([-1, -1], item_ts, [0, 1]).tolist() == [-1, -1]
+
+
+def test_camera_gap_does_not_duplicate_keyframe_rows(tmp_path, monkeypatch):
+    root = str(tmp_path / "data")
+    sweeps, samples = os.path.join(root, "sweeps"), os.path.join(root, "samples")
+    for key, value in {"BASE_DIR": root, "KEYFRAME_PLANNER": "lidar", "KEYFRAME_TOLERANCE_ACTION": "flag",
+                       "SAMPLE_INTERVAL_US": 500_000, "KEYFRAME_MAX_OFFSET_US": None,
+                       "LIDAR_AGGREGATE_SWEEPS": 0, "CAM_ENCODER": "png"}.items():
+        monkeypatch.setattr(config, key, value)
+
+    cam_ts = np.arange(0, 4_000_001, 50_000)
+    # CAM_FRONT は 1.0s〜2.5s の間に1枚も届かない（サンプル間隔の半分より長い穴）
+    gap_ts = cam_ts[(cam_ts <= 1_000_000) | (cam_ts >= 2_500_000)]
+    png = lambda path: open(path, "wb").write(b"\x89PNG")
+    captured_images = {ch: _frames(sweeps, ch, "png", gap_ts if ch == "CAM_FRONT" else cam_ts, png)
+                       for ch in config.CAM_NAMES}
+    pcd = lambda path: np.zeros((4, 5), dtype=np.float32).tofile(path)
+    captured_lidar = _frames(sweeps, config.LIDAR_NAME, "pcd.bin", cam_ts, pcd)
+    captured_radar = {ch: [] for ch in config.RADAR_NAMES}
+
+    export_scene(captured_images, captured_radar, captured_lidar, None, None, samples, sweeps)
+
+    nusc = NuScenesLite(root, config.VERSION, cache=False)
+    tokens = Counter(sd["token"] for sd in nusc.sample_data)
+    assert max(tokens.values()) == 1
+    front = [sd for sd in nusc.sample_data if nusc.channel_of(sd) == "CAM_FRONT"]
+    assert len({sd["filename"] for sd in front}) == len(front)
+    assert all(sd["prev"] != sd["token"] and sd["next"] != sd["token"] for sd in front)
+    # 穴の中のサンプルには CAM_FRONT のキーフレームが無い（他のカメラにはある）
+    keyed = {sd["sample_token"] for sd in front if sd["is_key_frame"]}
+    assert 0 < len(keyed) < len(nusc.sample)
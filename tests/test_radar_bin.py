@@ -0,0 +1,31 @@
+"""
+RADAR_WRITE_BIN で撮った .bin / .pcd を radar_bin2pcd にかけても、撮ったときの PCD を作り直さないか。
+CARLA の代わりに fake_carla で短く撮る。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_carla
+fake_carla.install()
+
+import config
+import main
+from radar_bin2pcd import batch_convert_radar
+
+
+def test_captured_radar_pcd_is_not_stale(tmp_path, monkeypatch):
+    root = str(tmp_path / "data")
+    for key, value in {"BASE_DIR": root, "DURATION_SEC": 1.0, "IMG_W": 64, "IMG_H": 36,
+                       "RADAR_WRITE_BIN": True, "SEGMENT_SEC": None, "METRICS_ENABLED": False}.items():
+        monkeypatch.setattr(config, key, value)
+    main.main()
+    sweeps = os.path.join(root, "sweeps")
+    bins = [os.path.join(sweeps, ch, name) for ch in config.RADAR_NAMES
+            for name in os.listdir(os.path.join(sweeps, ch)) if name.endswith(".bin")]
+    assert bins
+    for src in bins:
+        assert os.stat(src[:-4] + ".pcd").st_mtime_ns >= os.stat(src).st_mtime_ns
+    stats = batch_convert_radar(sweeps, workers=1)
+    assert stats["skipped"] == len(bins)
@@ -0,0 +1,57 @@
+"""
+JsonTableWriter の差分出力（EXPORT_INCREMENTAL）と、書き出し途中で例外になったときに前のテーブルが残るか。
+"""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from utils import JsonTableWriter, _row_digests_path
+
+
+def _write(path, rows, incremental=True):
+    with JsonTableWriter(path, compact=True, incremental=incremental) as w:
+        w.write_all(rows)
+    return w
+
+
+def test_incremental_status_and_row_diff(tmp_path):
+    path = str(tmp_path / "sample.json")
+    rows = [{"token": "a", "v": 1}, {"token": "b", "v": 2}]
+    assert _write(path, rows).status == "new"
+    mtime = os.stat(path).st_mtime_ns
+    assert _write(path, rows).status == "unchanged"
+    assert os.stat(path).st_mtime_ns == mtime
+    w = _write(path, [{"token": "a", "v": 1}, {"token": "b", "v": 3}, {"token": "c", "v": 4}])
+    assert (w.status, w.diff) == ("updated", (1, 0, 1))
+    w = _write(path, [{"token": "c", "v": 4}])
+    assert (w.status, w.diff) == ("updated", (0, 2, 0))
+    with open(path) as f:
+        assert json.load(f) == [{"token": "c", "v": 4}]
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_exception_keeps_previous_table(tmp_path, incremental):
+    path = str(tmp_path / "sample_data.json")
+    rows = [{"token": "a", "v": 1}, {"token": "b", "v": 2}]
+    _write(path, rows, incremental=incremental)
+    with open(path, "rb") as f:
+        before = f.read()
+    side = _row_digests_path(path)
+    side_before = open(side, "rb").read() if os.path.exists(side) else None
+
+    with pytest.raises(RuntimeError):
+        with JsonTableWriter(path, compact=True, incremental=incremental) as w:
+            w.write({"token": "a", "v": 1})
+            raise RuntimeError("crash while exporting")
+    assert w.status == "aborted"
+    assert not os.path.exists(path + ".tmp")
+    with open(path, "rb") as f:
+        assert f.read() == before
+    assert (open(side, "rb").read() if os.path.exists(side) else None) == side_before
+    # 次の出力は前回のハッシュと比べられる
+    w = _write(path, rows + [{"token": "c", "v": 3}], incremental=incremental)
+    if incremental:
+        assert (w.status, w.diff) == ("updated", (1, 0, 0))
@@ -1,45 +1,350 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import config
+from capture import sensor_tick_for
+from lidar_codec import COMPACT_EXT, FLOAT_EXT, decode_to_float
 
-def compute_sample_times(captured_images, captured_lidar):
+def _channel_timestamps(captured):
+    """{channel: items} → {channel: 昇順の timestamp 配列}（空のチャンネルは除く）"""
+    out = {}
+    for ch, items in captured.items():
+        if items:
+            ts = np.fromiter((it["timestamp"] for it in items), dtype=np.int64, count=len(items))
+            ts.sort()
+            out[ch] = ts
+    return out
+
+
+def compute_sample_times(captured_images, captured_lidar, duration_sec=None):
+    """一番早いカメラ / LiDAR の時刻から DURATION_SEC ぶん、SAMPLE_INTERVAL_US 刻みの格子（KEYFRAME_PLANNER="grid"）"""
     # 何か1つでも画像があるチャンネルを基準に
     any_imgs = [v for v in captured_images.values() if len(v) > 0]
     if not any_imgs:
         raise RuntimeError("画像が記録されていません。")
-    min_ts_candidates = [img["timestamp"] for imgs in captured_images.values() for img in imgs]
+    min_ts = min(int(ts[0]) for ts in _channel_timestamps(captured_images).values())
     if captured_lidar:
-        min_ts_candidates.append(min(m["timestamp"] for m in captured_lidar))
-    min_ts = min(min_ts_candidates)
-    max_ts = min_ts + int(config.DURATION_SEC * 1e6)
+        min_ts = min(min_ts, min(m["timestamp"] for m in captured_lidar))
+    max_ts = min_ts + int((duration_sec if duration_sec is not None else config.DURATION_SEC) * 1e6)
+    return np.arange(min_ts, max_ts + 1, config.SAMPLE_INTERVAL_US, dtype=np.int64).tolist()
+
+
+def plan_sample_times(captured_images, captured_lidar, captured_radar=None, interval_us=None, planner=None,
+                      duration_sec=None):
+    """
+    サンプル時刻を決める（config.KEYFRAME_PLANNER）。
+      "lidar": 本家 nuScenes と同じく LiDAR スイープの時刻そのものをサンプル時刻にする。
+               全チャンネルにデータがある区間 [最も遅い先頭, 最も早い末尾] の中で、
+               interval_us 刻みの格子に最も近いスイープを選ぶ（重複は1つに）。
+      "grid" : 従来の compute_sample_times（duration_sec はこちらだけで使う）
+    LiDAR が無ければ同じ区間の格子にする。
+    """
+    planner = planner or getattr(config, "KEYFRAME_PLANNER", "grid")
+    if planner == "grid":
+        return compute_sample_times(captured_images, captured_lidar, duration_sec)
+    if planner != "lidar":
+        raise ValueError(f"unknown keyframe planner: {planner}")
+    interval_us = int(interval_us or config.SAMPLE_INTERVAL_US)
+    channels = _channel_timestamps(captured_images)
+    if not channels:
+        raise RuntimeError("画像が記録されていません。")
+    channels.update(_channel_timestamps(captured_radar or {}))
+    lidar_ts = _channel_timestamps({config.LIDAR_NAME: captured_lidar}).get(config.LIDAR_NAME)
+    if lidar_ts is not None:
+        channels[config.LIDAR_NAME] = lidar_ts
+    start = max(int(ts[0]) for ts in channels.values())
+    end = min(int(ts[-1]) for ts in channels.values())
+    if end < start:
+        raise RuntimeError("全チャンネルが揃っている区間がありません。")
+    anchors = lidar_ts[(lidar_ts >= start) & (lidar_ts <= end)] if lidar_ts is not None else None
+    if anchors is None or anchors.size == 0:
+        return np.arange(start, end + 1, interval_us, dtype=np.int64).tolist()
+
+    # 各スイープで他チャンネルの最近傍までのずれを同期窓で割ったものの最大（小さいほど揃っている）
+    score = np.zeros(anchors.shape, dtype=np.float64)
+    for ch, ts in channels.items():
+        if ch == config.LIDAR_NAME:
+            continue
+        dist = np.abs(ts[nearest_indices(ts, anchors)] - anchors)
+        window = keyframe_tolerance_us(ch) or interval_us
+        np.maximum(score, dist / window, out=score)
+    # interval_us 刻みの格子点の ±interval_us/4 にあるスイープを候補にし（サンプル間隔は interval_us/2 以上になる）、
+    # 格子点ごとに「揃っている → 格子点に近い」順で1つ選ぶ
+    slot = np.rint((anchors - anchors[0]) / interval_us).astype(np.int64)
+    off_grid = np.abs(anchors - (anchors[0] + slot * interval_us))
+    cand = np.flatnonzero(off_grid <= interval_us // 4)
+    order = cand[np.lexsort((off_grid[cand], score[cand], slot[cand]))]
+    _, first = np.unique(slot[order], return_index=True)
+    return anchors[order[first]].tolist()
 
-    sample_times = []
-    t = min_ts
-    while t <= max_ts:
-        sample_times.append(int(t))
-        t += config.SAMPLE_INTERVAL_US
-    return sample_times
 
-def pick_keyframes_and_copy(captured_dict, sample_times, sweeps_dir, samples_dir):
+def nearest_indices(sorted_ts, query, max_dist=None):
+    """
+    昇順の sorted_ts の中で、query の各時刻に最も近い要素の位置を np.searchsorted でまとめて求める。
+    距離が同じなら前側（= 以前の min() 走査と同じ）。max_dist より離れているものは -1。
+    """
+    sorted_ts = np.asarray(sorted_ts, dtype=np.int64)
+    q = np.asarray(query, dtype=np.int64)
+    n = sorted_ts.shape[0]
+    if n == 0:
+        return np.full(q.shape, -1, dtype=np.int64)
+    right = np.searchsorted(sorted_ts, q, side="left")
+    hi = np.minimum(right, n - 1)
+    lo = np.maximum(right - 1, 0)
+    use_hi = np.abs(sorted_ts[hi] - q) < np.abs(q - sorted_ts[lo])
+    idx = np.where(use_hi, hi, lo)
+    if max_dist is not None:
+        idx[np.abs(sorted_ts[idx] - q) > max_dist] = -1
+    return idx
+
+
+class ChannelIndex:
+    """
+    1チャンネル分の captured レコードを timestamp 昇順の NumPy 配列で持つ索引。
+    nearest() で全サンプル時刻の最近傍を一度に引ける。
+    """
+
+    def __init__(self, items):
+        ts = np.fromiter((it["timestamp"] for it in items), dtype=np.int64, count=len(items))
+        self.items = items
+        self.order = np.argsort(ts, kind="stable")
+        self.timestamps = ts[self.order]
+
+    def __len__(self):
+        return len(self.items)
+
+    def nearest(self, query, max_dist=None):
+        """query 各時刻の最近傍レコードの items 上の位置（max_dist 超は -1）。"""
+        pos = nearest_indices(self.timestamps, query, max_dist)
+        if self.order.size == 0:
+            return pos
+        return np.where(pos >= 0, self.order[np.maximum(pos, 0)], -1)
+
+
+def nearest_per_channel(indexes, query, max_dist=None):
+    """
+    {channel: ChannelIndex} の全チャンネルについて query 各時刻の最近傍を求める（チャンネルごとに searchsorted）。
+    max_dist: {channel: 許容ずれ[us] or None}
+    戻り値: {channel: items 上の位置（len(query),）。無い / 許容外は -1}
+    """
+    q = np.asarray(query, dtype=np.int64)
+    max_dist = max_dist or {}
+    return {ch: index.nearest(q, max_dist.get(ch)) for ch, index in indexes.items()}
+
+
+MATERIALIZE_MODES = ("copy", "hardlink", "reflink", "move")
+
+_FICLONE = 0x40049409  # linux/fs.h
+
+
+def _reflink(src, dst):
+    import fcntl  # Linux 以外では ImportError → 呼び出し側でコピーにフォールバック
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+
+
+def materialize(src, dst, mode="copy"):
+    """
+    src を dst に置く。
+      copy    : 普通にコピー
+      hardlink: ハードリンク（別デバイス等で失敗したらコピー）
+      reflink : CoW クローン（btrfs/xfs 等。非対応ならコピー）
+      move    : 移動（キーフレームは samples/ にだけ残る。本家 nuScenes と同じ配置）
+    compact の LiDAR スイープ（.pcd.q16）は mode によらず decode して標準の .pcd.bin を書く（元は sweeps/ に残す）。
+    戻り値: 実際に使った方法
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f"unknown materialize mode: {mode} (choose from {MATERIALIZE_MODES})")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if src.endswith(COMPACT_EXT):
+        decode_to_float(src, dst)
+        return "decode"
+    if mode == "move":
+        shutil.move(src, dst)
+        return mode
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            pass
+    elif mode == "reflink":
+        try:
+            _reflink(src, dst)
+            return mode
+        except (OSError, ImportError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def sample_path_for(src):
+    """sweeps/ 下のパス → 対応する samples/ 下のパス（compact の LiDAR は標準の .pcd.bin にする）"""
+    dst = src.replace(os.sep + "sweeps" + os.sep, os.sep + "samples" + os.sep)
+    if dst.endswith(COMPACT_EXT):
+        dst = dst[:-len(COMPACT_EXT)] + FLOAT_EXT
+    return dst
+
+
+def modality_of(channel):
+    if channel in config.CAM_NAMES:
+        return "camera"
+    if channel in config.RADAR_NAMES:
+        return "radar"
+    return "lidar"
+
+
+def keyframe_tolerance_us(channel):
+    """config.KEYFRAME_TOLERANCE_US のそのチャンネルのモダリティの値（無ければ None）"""
+    return (getattr(config, "KEYFRAME_TOLERANCE_US", None) or {}).get(modality_of(channel))
+
+
+def frame_gaps(frames, timestamps, sensor_tick, fixed_delta=None):
+    """
+    受信したフレームの frame 番号 / timestamp[us] から取りこぼしを数える（ソート済みでなくてよい）。
+    fixed_delta（同期モードの刻み[s]）があれば frame 番号の飛びで、無ければ timestamp の間隔で判定する。
+      期待間隔: 同期 = sensor_tick を満たす最小の tick 数 / 非同期 = max(sensor_tick, 間隔の中央値)
+    戻り値: (received, dropped, worst_gap_us)
+    """
+    frames = np.asarray(frames, dtype=np.int64)
+    ts = np.asarray(timestamps, dtype=np.int64)
+    n = frames.shape[0]
+    if n < 2:
+        return n, 0, 0
+    order = np.argsort(frames, kind="stable")
+    frames, ts = frames[order], ts[order]
+    dt = np.diff(ts)
+    if fixed_delta:
+        step = max(1, int(np.ceil(sensor_tick / fixed_delta - 1e-3)))
+        missing = np.rint(np.diff(frames) / step) - 1
+    else:
+        period = max(sensor_tick * 1e6, float(np.median(dt)))
+        missing = np.rint(dt / period) - 1 if period > 0 else np.zeros_like(dt, dtype=np.float64)
+    dropped = int(np.clip(missing, 0, None).sum())
+    return n, dropped, int(dt.max())
+
+
+def unique_nearest(nearest, item_ts, sample_times):
+    """
+    同じフレームが複数のサンプル時刻の最近傍になっているとき、一番近いサンプル（同じなら前側）だけに残し、
+    他は -1 にする（キーフレームの sample_data は1フレーム1行。同じフレームを2つの sample に付けると
+    timestamp・filename が同じ行ができて token がぶつかる）。
+    nearest: サンプルごとの items 上の位置（-1 は無し）、item_ts: items の timestamp 配列
+    """
+    nearest = np.asarray(nearest, dtype=np.int64)
+    out = np.full(nearest.shape, -1, dtype=np.int64)
+    idx = np.flatnonzero(nearest >= 0)
+    if idx.size == 0:
+        return out
+    pos = nearest[idx]
+    dist = np.abs(np.asarray(item_ts, dtype=np.int64)[pos] - np.asarray(sample_times, dtype=np.int64)[idx])
+    order = np.lexsort((idx, dist, pos))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = pos[order][1:] != pos[order][:-1]
+    keep = idx[order[first]]
+    out[keep] = nearest[keep]
+    return out
+
+
+def channel_coverage(channel, items, sample_times, nearest, tolerance_us, sensor_tick, fixed_delta=None):
+    """1チャンネル分のカバレッジ（取りこぼし率・最大の穴・キーフレームの最大ずれ）"""
+    frames = np.fromiter((it["frame"] for it in items), dtype=np.int64, count=len(items))
+    ts = np.fromiter((it["timestamp"] for it in items), dtype=np.int64, count=len(items))
+    received, dropped, worst_gap = frame_gaps(frames, ts, sensor_tick, fixed_delta)
+    picked = nearest >= 0
+    offsets = np.abs(ts[nearest[picked]] - np.asarray(sample_times, dtype=np.int64)[picked])
+    over = offsets > tolerance_us if tolerance_us is not None else np.zeros(offsets.shape, dtype=bool)
+    return {
+        "modality": modality_of(channel),
+        "received": received,
+        "dropped": dropped,
+        "drop_rate": dropped / (received + dropped) if received + dropped else 0.0,
+        "worst_gap_ms": worst_gap / 1e3,
+        "samples": len(sample_times),
+        "keyframes": int(picked.sum()),
+        "max_keyframe_offset_ms": float(offsets.max()) / 1e3 if offsets.size else None,
+        "tolerance_ms": tolerance_us / 1e3 if tolerance_us is not None else None,
+        "over_tolerance": int(over.sum()),
+    }
+
+
+def format_coverage(report):
+    lines = [f"  {'channel':<18} {'recv':>6} {'drop':>5} {'rate':>6} {'gap ms':>8} "
+             f"{'key':>4} {'max off ms':>10} {'over':>5}"]
+    for ch, r in report.items():
+        off = f"{r['max_keyframe_offset_ms']:.1f}" if r["max_keyframe_offset_ms"] is not None else "-"
+        lines.append(f"  {ch:<18} {r['received']:>6} {r['dropped']:>5} {r['drop_rate']:>6.1%} "
+                     f"{r['worst_gap_ms']:>8.1f} {r['keyframes']:>4} {off:>10} {r['over_tolerance']:>5}"
+                     + (f"  rejected={r['rejected']}" if r.get("rejected") else "")
+                     + (f"  shared={r['shared']}" if r.get("shared") else ""))
+    return "\n".join(lines)
+
+
+def pick_keyframes_and_copy(captured_dict, sample_times, sweeps_dir, samples_dir, max_offset_us=None, mode=None,
+                            report=None, workers=None):
     """
     captured_dict: {channel: [ {path, timestamp, ...}, ... ]}
-    samples_dir にコピーし、各 sample index で最も近いフレームの元(sweeps)パスを記録
+    samples_dir に置き（mode: config.KEYFRAME_MATERIALIZE）、各 sample index で最も近いフレームの元(sweeps)パスを記録
+    同じフレームが複数の sample index の最近傍になったら（取りこぼしで穴が空いたとき）、一番近い sample だけの
+    キーフレームにし、他の sample はそのチャンネルのキーフレーム無しにする（report の shared に数える）。
+    max_offset_us: 最近傍がこれより離れている sample index はキーフレーム無しにする
+                   （None なら config.KEYFRAME_MAX_OFFSET_US、それも None なら無制限）
+                   KEYFRAME_TOLERANCE_ACTION="reject" ならモダリティごとの KEYFRAME_TOLERANCE_US も効く
+    report: dict を渡すとチャンネルごとのカバレッジ（channel_coverage）を入れる
+    workers: samples/ に置く（コピー等）スレッド数（None なら config.EXPORT_WORKERS）
     戻り値: key_for_idx = {channel: {idx: src_sweeps_path}}
     """
+    if max_offset_us is None:
+        max_offset_us = getattr(config, "KEYFRAME_MAX_OFFSET_US", None)
+    if mode is None:
+        mode = getattr(config, "KEYFRAME_MATERIALIZE", "copy")
+    reject = getattr(config, "KEYFRAME_TOLERANCE_ACTION", "flag") == "reject"
+    fixed_delta = getattr(config, "SYNC_FIXED_DELTA", None) if getattr(config, "SYNC_MODE", False) else None
     key_for_idx = {ch: {} for ch in captured_dict.keys()}
 
-    def nearest_sample_index(ts):
-        return min(range(len(sample_times)), key=lambda i: abs(sample_times[i] - ts))
+    # 全チャンネルの最近傍をまとめて（モダリティごとの許容ずれ付き）
+    indexes = {ch: ChannelIndex(items) for ch, items in captured_dict.items() if items}
+    tolerance = {ch: keyframe_tolerance_us(ch) for ch in indexes}
+    limits = {}
+    for ch in indexes:
+        limit = max_offset_us
+        if reject and tolerance[ch] is not None:
+            limit = tolerance[ch] if limit is None else min(limit, tolerance[ch])
+        limits[ch] = limit
+    nearest_all = nearest_per_channel(indexes, sample_times, limits)
+    unlimited = None
+    if report is not None and reject:
+        # 許容外で落とした分も数える
+        unlimited = nearest_per_channel(indexes, sample_times, {ch: max_offset_us for ch in indexes})
 
-    for ch, items in captured_dict.items():
-        if not items:
-            continue
-        for idx in range(len(sample_times)):
-            # そのサンプル時刻に最も近いもの
-            closest = min(items, key=lambda it: abs(it["timestamp"] - sample_times[idx]))
-            src = closest["path"]
-            dst = src.replace(os.sep + "sweeps" + os.sep, os.sep + "samples" + os.sep)
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            shutil.copyfile(src, dst)
-            key_for_idx[ch][idx] = src
+    for ch, nearest in nearest_all.items():
+        items = captured_dict[ch]
+        all_nearest = nearest
+        nearest = unique_nearest(nearest, [it["timestamp"] for it in items], sample_times)
+        if report is not None:
+            try:
+                tick = sensor_tick_for(ch)
+            except KeyError:
+                tick = 0.0
+            report[ch] = channel_coverage(ch, items, sample_times, nearest, tolerance[ch], tick, fixed_delta)
+            if unlimited is not None:
+                report[ch]["rejected"] = int((unlimited[ch] >= 0).sum() - (all_nearest >= 0).sum())
+            report[ch]["shared"] = int((all_nearest >= 0).sum() - (nearest >= 0).sum())
+        for idx, i in enumerate(nearest.tolist()):
+            if i >= 0:
+                key_for_idx[ch][idx] = items[i]["path"]
+
+    # ファイルを置くのは I/O 待ちなので、全チャンネル分をまとめてスレッドに分ける
+    srcs = sorted({src for picked in key_for_idx.values() for src in picked.values()})
+    workers = workers or getattr(config, "EXPORT_WORKERS", 1)
+    if workers > 1 and len(srcs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda src: materialize(src, sample_path_for(src), mode), srcs))
+    else:
+        for src in srcs:
+            materialize(src, sample_path_for(src), mode)
     return key_for_idx
@@ -1,10 +1,42 @@
 import os
 import json
+import uuid
+import hashlib
+import filecmp
 from datetime import datetime
+import config
+
+try:  # あれば速い JSON 実装を使う（compact モードのみ）
+    import orjson
+except ImportError:
+    orjson = None
+
+# config.CAM_ENCODER → 拡張子（= sample_data.json の fileformat）
+CAM_FILE_EXTS = {"png": "png", "jpg": "jpg", "jpeg": "jpg", "npy": "npy"}
+
+# テーブルの横に置くキャッシュ（dataset_reader の pkl / npz、行ダイジェスト）
+CACHE_DIRNAME = ".cache"
 
 def make_directory(path: str):
     os.makedirs(path, exist_ok=True)
 
+# 決定的 token 用の名前空間（uuid5）
+TOKEN_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "carla_nuscenes")
+
+def make_token(*parts):
+    """parts（scene名, テーブル, チャンネル, timestamp など）から決まる token。同じ入力なら毎回同じ。"""
+    return str(uuid.uuid5(TOKEN_NAMESPACE, "/".join(str(p) for p in parts)))
+
+def capture_date(started=None):
+    """撮影開始時刻（epoch 秒）→ log.json の date_captured（"YYYY-MM-DD"）。None なら今日"""
+    return (datetime.fromtimestamp(started) if started is not None else datetime.now()).strftime("%Y-%m-%d")
+
+def camera_fileformat(encoder=None):
+    enc = (encoder or getattr(config, "CAM_ENCODER", "png")).lower()
+    if enc not in CAM_FILE_EXTS:
+        raise ValueError(f"unknown camera encoder: {enc} (choose from {sorted(CAM_FILE_EXTS)})")
+    return CAM_FILE_EXTS[enc]
+
 def link_prev_next(sample_data_list):
     from collections import defaultdict
     by_sensor = defaultdict(list)
@@ -16,6 +48,169 @@ def link_prev_next(sample_data_list):
             r["prev"] = records[i-1]["token"] if i > 0 else ""
             r["next"] = records[i+1]["token"] if i < len(records)-1 else ""
 
+def link_prev_next_stream(records):
+    """
+    timestamp 順に並んだ1センサ分の records に prev/next を埋めながら1件ずつ返す（1件先読み）。
+    link_prev_next と違って全件をメモリに持たない。
+    """
+    prev = None
+    for rec in records:
+        rec["prev"] = prev["token"] if prev is not None else ""
+        if prev is not None:
+            prev["next"] = rec["token"]
+            yield prev
+        prev = rec
+    if prev is not None:
+        prev["next"] = ""
+        yield prev
+
+class JsonTableWriter:
+    """
+    nuScenes のテーブル（JSON 配列）を1レコードずつ書き出す。
+      compact=False: json.dump(indent=2) と同じ出力
+      compact=True : インデント無し。orjson が入っていて JSON_BACKEND が "auto"/"orjson" ならそれを使う
+    いつも <path>.tmp に書いて close() で置き換える（途中で例外になったら abort() で捨て、前のテーブルを残す）。
+    incremental=True なら既存と中身が同じとき既存ファイルを触らない（mtime も変えない）。
+    書き終わると status に "new" / "unchanged" / "updated" が入り、updated なら
+    diff に token 単位の (追加, 削除, 変更) 行数が入る。
+    行の比較は書きながら取った行ごとのハッシュ（.cache/<テーブル>.rows.json）同士で行い、
+    テーブル本体は読み直さない。前回のハッシュが無い・テーブルと合わないときは diff は None。
+    """
+
+    def __init__(self, path: str, compact=None, incremental=None):
+        if compact is None:
+            compact = getattr(config, "JSON_COMPACT", False)
+        if incremental is None:
+            incremental = getattr(config, "EXPORT_INCREMENTAL", False)
+        self.path = path
+        self.compact = compact
+        self.incremental = incremental
+        self.count = 0
+        self.status = None
+        self.diff = None
+        backend = getattr(config, "JSON_BACKEND", "auto")
+        if backend == "orjson" and orjson is None:
+            raise ImportError("JSON_BACKEND='orjson' ですが orjson がインストールされていません")
+        if compact and orjson is not None and backend in ("auto", "orjson"):
+            self._dumps = orjson.dumps
+        elif compact:
+            self._dumps = lambda rec: json.dumps(rec, separators=(",", ":")).encode()
+        else:
+            self._dumps = lambda rec: json.dumps(rec, indent=2).replace("\n", "\n  ").encode()
+        self._sep = b"," if compact else b",\n  "
+        self._tmp = path + ".tmp"
+        self._rows = [] if incremental else None    # (token, ハッシュ)
+        self._f = open(self._tmp, "wb")
+
+    def write(self, rec):
+        self.write_raw(self._dumps(rec), rec.get("token"))
+
+    def write_raw(self, data: bytes, token=None):
+        """
+        シリアライズ済みの1レコードをそのまま書く（compact=False のときは write() と同じ整形済みであること）。
+        token を省くと diff では行番号で突き合わせる。
+        """
+        if self._rows is not None:
+            self._rows.append((token if token is not None else self.count,
+                               hashlib.blake2b(data, digest_size=8).hexdigest()))
+        if self.count == 0:
+            self._f.write(b"[" if self.compact else b"[\n  ")
+        else:
+            self._f.write(self._sep)
+        self._f.write(data)
+        self.count += 1
+
+    def write_all(self, records):
+        for rec in records:
+            self.write(rec)
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self.count == 0:
+            self._f.write(b"[]")
+        else:
+            self._f.write(b"]" if self.compact else b"\n]")
+        self._f.close()
+        if not self.incremental:
+            os.replace(self._tmp, self.path)
+            self.status = "new"
+        elif not os.path.exists(self.path):
+            os.replace(self._tmp, self.path)
+            self.status = "new"
+        elif filecmp.cmp(self._tmp, self.path, shallow=False):
+            os.remove(self._tmp)
+            self.status = "unchanged"
+        else:
+            old = _load_row_digests(self.path)
+            if old is not None:
+                self.diff = _table_row_diff(old, self._rows)
+            os.replace(self._tmp, self.path)
+            self.status = "updated"
+        if self.incremental:
+            _save_row_digests(self.path, self._rows)
+
+    def abort(self):
+        """書きかけを捨てる（既存のテーブルと行ハッシュはそのまま）"""
+        if self._f.closed:
+            return
+        self._f.close()
+        os.remove(self._tmp)
+        self.status = "aborted"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def _row_digests_path(path):
+    d, name = os.path.split(path)
+    return os.path.join(d, CACHE_DIRNAME, os.path.splitext(name)[0] + ".rows.json")
+
+def _load_row_digests(path):
+    """前回書いたときの行ハッシュ。テーブルがその後書き換えられていたら None"""
+    try:
+        with open(_row_digests_path(path)) as f:
+            saved = json.load(f)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if saved.get("key") != [st.st_mtime_ns, st.st_size]:
+        return None
+    return saved["rows"]
+
+def _save_row_digests(path, rows):
+    side = _row_digests_path(path)
+    os.makedirs(os.path.dirname(side), exist_ok=True)
+    st = os.stat(path)
+    tmp = side + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"key": [st.st_mtime_ns, st.st_size], "rows": rows}, f, separators=(",", ":"))
+    os.replace(tmp, side)
+
+def _table_row_diff(old_rows, new_rows):
+    """(token, ハッシュ) の列2つから token 単位で (追加, 削除, 変更) 行数を返す。"""
+    old, new = dict(map(tuple, old_rows)), dict(new_rows)
+    added = sum(1 for t in new if t not in old)
+    removed = sum(1 for t in old if t not in new)
+    changed = sum(1 for t, h in new.items() if t in old and old[t] != h)
+    return added, removed, changed
+
+def format_table_status(name, w):
+    if w.status == "updated" and w.diff is not None:
+        a, r, c = w.diff
+        return f"  {name:<24} updated (+{a} -{r} ~{c} rows)"
+    return f"  {name:<24} {w.status} ({w.count} rows)"
+
 def save_json(path: str, obj):
+    """list はテーブルとして JsonTableWriter で書く（戻り値は writer。status/diff 参照用）"""
+    if isinstance(obj, list):
+        with JsonTableWriter(path) as w:
+            w.write_all(obj)
+        return w
     with open(path, "w") as f:
         json.dump(obj, f, indent=2)